@@ -0,0 +1,31 @@
+import asyncio
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_redis():
+    """Return the process-wide Redis client for shared state, locks and counters."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
+
+def get_async_redis():
+    """Return the asyncio Redis client for the running event loop (async views and consumers)."""
+    # Connections are bound to the loop that opened them, so keep one client per loop
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        # Bounded, and callers queue for a connection instead of erroring when a
+        # burst of sockets (say a whole server's worth disconnecting) hits at once
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            settings.REDIS_URL, decode_responses=True,
+            max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS, timeout=10,
+        )
+        client = redis.asyncio.Redis(connection_pool=pool)
+        _async_clients[loop] = client
+    return client
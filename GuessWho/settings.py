@@ -123,23 +123,114 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/0')
+# Per event loop; async views and consumers wait for a free connection past this
+REDIS_ASYNC_MAX_CONNECTIONS = env.int('REDIS_ASYNC_MAX_CONNECTIONS', default=50)
+
 ASGI_APPLICATION = 'GuessWho.asgi.application'
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [env('REDIS_URL', default='redis://localhost:6379/0')],
+            'hosts': [REDIS_URL],
         },
     },
 }
 
+# Room state deltas arriving within this many seconds go out as one message (see rooms.state)
+ROOM_DELTA_WINDOW = env.float('ROOM_DELTA_WINDOW', default=0.05)
+
+# Lobby presence (see rooms.presence): a socket counts as connected for this many
+# seconds after its last heartbeat; clients beat at a third of it
+ROOM_PRESENCE_TTL = env.int('ROOM_PRESENCE_TTL', default=30)
+# How often presence is copied into RoomPlayer.connection_state
+ROOM_PRESENCE_FLUSH_INTERVAL = env.float('ROOM_PRESENCE_FLUSH_INTERVAL', default=15.0)
+# A dropped player keeps their seat (and host role) this long before being removed
+ROOM_RECONNECT_GRACE = env.int('ROOM_RECONNECT_GRACE', default=60)
+ROOM_SWEEP_INTERVAL = env.float('ROOM_SWEEP_INTERVAL', default=5.0)
+
+# Free room codes kept ready in Redis (see rooms.codes); refilled in the
+# background once it drops below a quarter of this
+ROOM_CODE_POOL_SIZE = env.int('ROOM_CODE_POOL_SIZE', default=5000)
+
+# Room reaping (rooms.tasks.reap_rooms): lobbies with nobody connected this many
+# seconds are deleted, and finished rooms are archived this long after they end
+ROOM_ABANDONED_AFTER = env.int('ROOM_ABANDONED_AFTER', default=10 * 60)
+ROOM_ARCHIVE_AFTER = env.int('ROOM_ARCHIVE_AFTER', default=60 * 60)
+ROOM_REAP_BATCH = env.int('ROOM_REAP_BATCH', default=500)
+ROOM_REAP_INTERVAL = env.float('ROOM_REAP_INTERVAL', default=60.0)
+
+# Match phases, in seconds (see game.runtime); clients count down from the
+# deadline each phase change carries
+MATCH_START_SECONDS = env.float('MATCH_START_SECONDS', default=3.0)
+MATCH_ANSWER_SECONDS = env.float('MATCH_ANSWER_SECONDS', default=12.0)
+MATCH_REVEAL_SECONDS = env.float('MATCH_REVEAL_SECONDS', default=4.0)
+MATCH_SCOREBOARD_SECONDS = env.float('MATCH_SCOREBOARD_SECONDS', default=3.0)
+# Final results stay up this long before the room's code is recycled
+MATCH_RESULTS_SECONDS = env.float('MATCH_RESULTS_SECONDS', default=60.0)
+# Match clock (run_match_clock): longest sleep between polls of the deadline set
+MATCH_CLOCK_TICK = env.float('MATCH_CLOCK_TICK', default=0.05)
+# Due matches claimed (and moved on together) per batch, and batches in flight per clock
+MATCH_CLOCK_BATCH = env.int('MATCH_CLOCK_BATCH', default=200)
+MATCH_CLOCK_CONCURRENCY = env.int('MATCH_CLOCK_CONCURRENCY', default=4)
+# A claimed match another clock may retry after this long, if its transition never lands
+MATCH_CLOCK_LEASE = env.float('MATCH_CLOCK_LEASE', default=10.0)
+
 # Celery — background task queue
-CELERY_BROKER_URL = env('REDIS_URL', default='redis://localhost:6379/0')
-CELERY_RESULT_BACKEND = env('REDIS_URL', default='redis://localhost:6379/0')
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+# Consume queues in the order a worker lists them (-Q sync_lobby,celery),
+# so syncs for players waiting in a lobby always drain first
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+# Periodic tasks, run by `celery -A GuessWho beat`
+CELERY_BEAT_SCHEDULE = {
+    'flush-room-presence': {
+        'task': 'rooms.tasks.flush_presence',
+        'schedule': ROOM_PRESENCE_FLUSH_INTERVAL,
+    },
+    'sweep-dropped-players': {
+        'task': 'rooms.tasks.sweep_dropped_players',
+        'schedule': ROOM_SWEEP_INTERVAL,
+    },
+    'reap-rooms': {
+        'task': 'rooms.tasks.reap_rooms',
+        'schedule': ROOM_REAP_INTERVAL,
+    },
+}
 
 SPOTIFY_CLIENT_ID = env('SPOTIFY_CLIENT_ID', default='')
 SPOTIFY_CLIENT_SECRET = env('SPOTIFY_CLIENT_SECRET', default='')
 SPOTIFY_REDIRECT_URI = env('SPOTIFY_REDIRECT_URI', default='http://localhost:8000/auth/spotify/callback')
-SPOTIFY_SCOPES = 'user-top-read user-read-recently-played'
\ No newline at end of file
+SPOTIFY_SCOPES = 'user-top-read user-read-recently-played'
+# Overridable so the client can be pointed at a local fake server
+SPOTIFY_API_BASE = env('SPOTIFY_API_BASE', default='https://api.spotify.com/v1')
+SPOTIFY_ACCOUNTS_BASE = env('SPOTIFY_ACCOUNTS_BASE', default='https://accounts.spotify.com')
+
+# Seconds before a single Spotify API request is abandoned
+SPOTIFY_REQUEST_TIMEOUT = env.float('SPOTIFY_REQUEST_TIMEOUT', default=10.0)
+
+# Shared token bucket for all Spotify calls across every process (see spotify_sync.client)
+SPOTIFY_RATE_LIMIT_PER_SECOND = env.float('SPOTIFY_RATE_LIMIT_PER_SECOND', default=10.0)
+SPOTIFY_RATE_LIMIT_BURST = env.int('SPOTIFY_RATE_LIMIT_BURST', default=20)
+# Longest a worker sleeps for the limiter before rescheduling its task instead
+SPOTIFY_RATE_LIMIT_MAX_WAIT = env.float('SPOTIFY_RATE_LIMIT_MAX_WAIT', default=5.0)
+
+# Sync scheduling (see spotify_sync.scheduling)
+SPOTIFY_SYNC_FRESHNESS = env.int('SPOTIFY_SYNC_FRESHNESS', default=15 * 60)
+SPOTIFY_SYNC_DEDUPE_TTL = env.int('SPOTIFY_SYNC_DEDUPE_TTL', default=10 * 60)
+SPOTIFY_SYNC_LOBBY_QUEUE = 'sync_lobby'
+SPOTIFY_SYNC_QUEUE = 'celery'
+
+# Round audio lookups (see spotify_sync.audio): the backend's dotted path,
+# lookups in flight at once, and seconds before one is given up on. No
+# backend means no lookups (rounds play metadata-only); set it to
+# spotify_sync.audio.YtDlpResolver where yt-dlp is installed
+AUDIO_RESOLVER = env('AUDIO_RESOLVER', default='')
+AUDIO_RESOLVER_WORKERS = env.int('AUDIO_RESOLVER_WORKERS', default=8)
+AUDIO_RESOLVER_TIMEOUT = env.float('AUDIO_RESOLVER_TIMEOUT', default=8.0)
+# Most tracks looked up ahead for a player after their sync
+AUDIO_PREWARM_LIMIT = env.int('AUDIO_PREWARM_LIMIT', default=200)
+# Days before a track with no video is looked up again
+AUDIO_MISS_RETRY_DAYS = env.int('AUDIO_MISS_RETRY_DAYS', default=7)
@@ -0,0 +1,6 @@
+def percentile(sorted_values, pct):
+    """The ``pct``-th percentile of an already sorted sequence (nearest rank), or 0.0 when it's empty."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
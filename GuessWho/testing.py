@@ -0,0 +1,38 @@
+"""
+Test helpers shared by the apps' test suites.
+
+FakeRedisMixin swaps the shared Redis clients (GuessWho.redis_client) for an
+in-process fakeredis server, fresh for every test, so tests never touch the
+Redis at REDIS_URL. Tests using it are skipped when fakeredis isn't installed.
+"""
+from unittest import mock
+from GuessWho import redis_client
+
+try:
+    import fakeredis
+except ImportError:  # a test-only dependency
+    fakeredis = None
+
+class _AsyncClients(dict):
+    # Stands in for redis_client._async_clients: one fake client per event loop
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+
+    def get(self, loop, default=None):
+        if loop not in self:
+            self[loop] = fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+        return self[loop]
+
+class FakeRedisMixin:
+    """Give each test its own empty Redis, reachable as ``self.redis``."""
+
+    def setUp(self):
+        super().setUp()
+        if fakeredis is None:
+            self.skipTest('needs fakeredis')
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+        patcher = mock.patch.multiple(redis_client, _client=self.redis, _async_clients=_AsyncClients(server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
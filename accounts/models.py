@@ -21,6 +21,8 @@ class SpotifyAccount(models.Model):
     sync_status = models.CharField(
         max_length=20, choices=SYNC_STATUS_CHOICES, default='not_synced'
     )
+    # Per-source delta cursors: ETag/content hash per top-track range, 'after' for recent
+    sync_cursors = models.JSONField(default=dict, blank=True)
     scopes_granted = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
 
@@ -1,32 +1,67 @@
-import requests
-from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
+from GuessWho.redis_client import get_redis
+from spotify_sync.client import spotify_token_request
+
+# Refresh this long before Spotify's expiry so in-flight calls don't 401
+REFRESH_MARGIN = timedelta(seconds=60)
+TOKEN_FIELDS = ['access_token', 'refresh_token', 'token_expires_at']
+
+def _token_key(spotify_account):
+    return f'spotify:token:{spotify_account.user_id}'
+
+def _token_is_fresh(spotify_account):
+    return bool(
+        spotify_account.token_expires_at
+        and spotify_account.token_expires_at > timezone.now() + REFRESH_MARGIN
+    )
+
+def cache_access_token(spotify_account):
+    """Publish the account's current access token to Redis until it nears expiry."""
+    ttl = (spotify_account.token_expires_at - timezone.now() - REFRESH_MARGIN).total_seconds()
+    if ttl >= 1:
+        get_redis().set(_token_key(spotify_account), spotify_account.access_token, ex=int(ttl))
 
 def refresh_spotify_token(spotify_account):
-    #refreshes account token
-    if (spotify_account.token_expires_at and 
-        spotify_account.token_expires_at > timezone.now() + timedelta(seconds=60)):
-        return spotify_account.access_token
-
-    # Expired — get a new one
-    resp = requests.post(
-        'https://accounts.spotify.com/api/token',
-        data={
+    """
+    Return a live access token for ``spotify_account``.
+
+    The token is read from Redis first. Refreshing is single-flight per
+    account: one caller holds the lock and POSTs to Spotify, and the others
+    wait and reuse its result, so a rotated refresh token is never lost.
+    """
+    r = get_redis()
+    key = _token_key(spotify_account)
+    token = r.get(key)
+    if token:
+        spotify_account.access_token = token
+        return token
+
+    with r.lock(f'spotify:token-lock:{spotify_account.user_id}', timeout=30, blocking_timeout=35):
+        token = r.get(key)
+        if token:
+            # Another caller refreshed while we waited
+            spotify_account.access_token = token
+            return token
+
+        # Our instance may predate a refresh done elsewhere; trust the DB
+        spotify_account.refresh_from_db(fields=TOKEN_FIELDS)
+        if _token_is_fresh(spotify_account):
+            cache_access_token(spotify_account)
+            return spotify_account.access_token
+
+        # Expired — get a new one
+        data = spotify_token_request({
             'grant_type': 'refresh_token',
             'refresh_token': spotify_account.refresh_token,
-        },
-        auth=(settings.SPOTIFY_CLIENT_ID, settings.SPOTIFY_CLIENT_SECRET),
-        headers={'Content-Type': 'application/x-www-form-urlencoded'},
-    )
-    resp.raise_for_status()
-    data = resp.json()
-
-    spotify_account.access_token = data['access_token']
-    spotify_account.token_expires_at = timezone.now() + timedelta(seconds=data['expires_in'])
-    # Spotify sometimes issues a new refresh token; take it if offered
-    if 'refresh_token' in data:
-        spotify_account.refresh_token = data['refresh_token']
-    spotify_account.save()
+        })
+
+        spotify_account.access_token = data['access_token']
+        spotify_account.token_expires_at = timezone.now() + timedelta(seconds=data['expires_in'])
+        # Spotify sometimes issues a new refresh token; take it if offered
+        if 'refresh_token' in data:
+            spotify_account.refresh_token = data['refresh_token']
+        spotify_account.save(update_fields=TOKEN_FIELDS)
+        cache_access_token(spotify_account)
 
     return spotify_account.access_token
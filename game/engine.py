@@ -0,0 +1,214 @@
+"""
+Match precompute: picking a match's rounds from the players' evidence.
+
+The room's evidence is read from the players' taste snapshots in one query
+(spotify_sync.snapshots). Each distinct track gets an 8-bit mask of the seats
+that have it, and filtering, genericness rejection and quota sampling are
+NumPy operations over those masks, so Start stays well under 50 ms for a
+full room (see the bench_engine command).
+"""
+import secrets
+import numpy as np
+
+ROUND_COUNT = 10
+MAX_SEATS = 8  # one bit per seat in a uint8 mask
+
+# Share of rounds by truth-set size: one owner, two owners, three or more
+ROUND_MIX = [(1, 0.50), (2, 0.30), (3, 0.15)]
+# What's left of the mix goes to any bucket
+WILDCARD_SHARE = 0.05
+# Where a short bucket's rounds go instead, nearest size first
+FALLBACK_BUCKETS = {1: [2, 3], 2: [1, 3], 3: [2, 1]}
+
+# A track more than this share of the room has doesn't tell anyone apart
+GENERIC_SHARE = 0.75
+
+# Rounds in a row that may share a truth-set size
+MAX_SHAPE_RUN = 2
+
+# Set bits in every possible mask
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class NotEnoughTracks(Exception):
+    """The players' evidence can't fill a match."""
+
+
+def build_owner_masks(seat_tracks):
+    """
+    Map every track to the seats that have it.
+
+    ``seat_tracks`` holds one buffer of int64 track ids per seat (at most 8),
+    each free of duplicates, as stored in a taste snapshot. Returns
+    ``(track_ids, owners)``: the distinct track ids, sorted, and a uint8 array
+    with bit ``i`` set when seat ``i`` has the track.
+    """
+    if len(seat_tracks) > MAX_SEATS:
+        raise ValueError(f'At most {MAX_SEATS} seats fit in a mask.')
+    seats = [np.frombuffer(tracks, dtype=np.int64) for tracks in seat_tracks]
+    if not seats:
+        return np.empty(0, np.int64), np.empty(0, np.uint8)
+    track_ids, inverse = np.unique(np.concatenate(seats), return_inverse=True)
+    # Seat bits are distinct and a seat lists a track once, so summing is ORing
+    bits = np.repeat(1 << np.arange(len(seats)), [len(s) for s in seats])
+    owners = np.bincount(inverse, weights=bits, minlength=len(track_ids)).astype(np.uint8)
+    return track_ids, owners
+
+
+def plan_rounds(track_ids, owners, seat_count, round_count=ROUND_COUNT, seed=None, exclude=()):
+    """
+    Pick ``round_count`` tracks and their play order.
+
+    Tracks in ``exclude`` are skipped. Returns ``[(track_id, owner_mask), ...]``
+    and raises NotEnoughTracks when the evidence can't fill the match.
+    """
+    rng = np.random.default_rng(seed)
+    counts = POPCOUNT[owners]
+    usable = counts > 0
+    if len(exclude):
+        usable &= ~np.isin(track_ids, np.asarray(exclude, dtype=np.int64))
+    # Two players can only share a track with each other, so keep those
+    informative = usable & (counts <= GENERIC_SHARE * seat_count) if seat_count >= 3 else usable
+    # A thin pool falls back to generic tracks rather than not starting
+    if np.count_nonzero(informative) >= round_count:
+        usable = informative
+    candidates = np.flatnonzero(usable)
+    if len(candidates) < round_count:
+        raise NotEnoughTracks(
+            f'Only {len(candidates)} usable tracks between the players; {round_count} are needed.'
+        )
+
+    masks = owners[candidates]
+    buckets = np.minimum(counts[candidates], 3)
+    keys = rng.random(len(candidates))
+
+    # Rank each track within its truth set, so every owner (and every pair,
+    # ...) comes up once before anyone comes up twice
+    by_mask = np.lexsort((keys, masks))
+    sorted_masks = masks[by_mask]
+    starts = np.flatnonzero(np.r_[True, sorted_masks[1:] != sorted_masks[:-1]])
+    sizes = np.diff(np.r_[starts, len(by_mask)])
+    ranks = np.empty(len(by_mask), dtype=np.int64)
+    ranks[by_mask] = np.arange(len(by_mask)) - np.repeat(starts, sizes)
+
+    # Best pick first within each bucket
+    order = np.lexsort((keys, ranks, buckets))
+    ranked, ranked_buckets = candidates[order], buckets[order]
+    available = {b: int(np.count_nonzero(buckets == b)) for b, _ in ROUND_MIX}
+
+    chosen = np.zeros(len(ranked), dtype=bool)
+    for bucket, quota in _bucket_quotas(round_count, available).items():
+        start = int(np.searchsorted(ranked_buckets, bucket))
+        chosen[start:start + quota] = True
+    # The wildcard rounds come from whatever is left, at random
+    leftover = np.flatnonzero(~chosen)
+    wildcards = round_count - int(np.count_nonzero(chosen))
+    chosen[leftover[np.argsort(keys[order][leftover])[:wildcards]]] = True
+
+    picked = ranked[chosen]
+    return [
+        (int(track_ids[i]), int(owners[i]))
+        for i in _spread_shapes(picked, np.minimum(counts[picked], 3), rng)
+    ]
+
+
+def _bucket_quotas(round_count, available):
+    """
+    Split the rounds over the buckets by ROUND_MIX (largest remainder), moving
+    whatever a bucket can't supply to its fallbacks.
+    """
+    shares = [(bucket, share * round_count) for bucket, share in ROUND_MIX]
+    quotas = {bucket: int(exact) for bucket, exact in shares}
+    # Wildcards round half up: round() would give a 10-round match none
+    wildcards = int(WILDCARD_SHARE * round_count + 0.5)
+    spare = round_count - wildcards - sum(quotas.values())
+    for bucket, exact in sorted(shares, key=lambda s: s[1] - int(s[1]), reverse=True)[:max(spare, 0)]:
+        quotas[bucket] += 1
+
+    for bucket in list(quotas):
+        short = quotas[bucket] - available[bucket]
+        if short <= 0:
+            continue
+        quotas[bucket] = available[bucket]
+        for fallback in FALLBACK_BUCKETS[bucket]:
+            moved = min(short, available[fallback] - quotas[fallback])
+            if moved > 0:
+                quotas[fallback] += moved
+                short -= moved
+    return quotas
+
+
+def _spread_shapes(picked, buckets, rng):
+    """Order the picks so no truth-set size runs more than MAX_SHAPE_RUN rounds."""
+    queues = {}
+    for i in rng.permutation(len(picked)):
+        queues.setdefault(int(buckets[i]), []).append(int(picked[i]))
+    order, last, run = [], None, 0
+    while queues:
+        # The fullest bucket goes next, unless it just had its run
+        choices = sorted(queues, key=lambda b: (len(queues[b]), -b), reverse=True)
+        bucket = next((b for b in choices if b != last or run < MAX_SHAPE_RUN), choices[0])
+        run = run + 1 if bucket == last else 1
+        last = bucket
+        order.append(queues[bucket].pop())
+        if not queues[bucket]:
+            del queues[bucket]
+    return order
+
+
+def create_match(room, players, round_count=ROUND_COUNT, seed=None):
+    """
+    Plan and save a match in ``room`` for ``players``, ``(user_id,
+    display_name)`` pairs in seat order.
+
+    Five queries: the players' snapshots, the chosen tracks' metadata and
+    three inserts. Call inside the transaction that starts the game; raises
+    NotEnoughTracks when the evidence can't fill the match.
+    """
+    from spotify_sync.models import SpotifyTrack
+    from spotify_sync.snapshots import SOURCE_BITS, load_taste_snapshots
+    from .models import Match, MatchPlayer, Round
+
+    user_ids = [user_id for user_id, _ in players]
+    snapshots = load_taste_snapshots(user_ids)
+    empty = (np.empty(0, np.int64), np.empty(0, np.uint8))
+    seats = [snapshots.get(user_id, empty) for user_id in user_ids]
+    track_ids, owners = build_owner_masks([tracks for tracks, _ in seats])
+
+    if seed is None:
+        seed = secrets.randbits(63)
+    exclude = []
+    # Snapshots don't carry metadata; a track without it is swapped for the next pick
+    for _ in range(3):
+        plan = plan_rounds(track_ids, owners, len(user_ids), round_count, seed, exclude)
+        tracks = SpotifyTrack.objects.only('name', 'artist_name').in_bulk([t for t, _ in plan])
+        missing = [t for t, _ in plan if not (tracks[t].name and tracks[t].artist_name)]
+        if not missing:
+            break
+        exclude += missing
+    else:
+        raise NotEnoughTracks('Too many of the players\' tracks are missing song or artist names.')
+
+    match = Match.objects.create(room=room, round_count=round_count, seed=seed)
+    MatchPlayer.objects.bulk_create([
+        MatchPlayer(match=match, user_id=user_id, seat=seat, display_name=display_name)
+        for seat, (user_id, display_name) in enumerate(players)
+    ])
+    rounds = []
+    for index, (track_id, mask) in enumerate(plan):
+        evidence = {}
+        for seat, (seat_tracks, seat_sources) in enumerate(seats):
+            if mask & (1 << seat):
+                found = np.searchsorted(np.frombuffer(seat_tracks, dtype=np.int64), track_id)
+                evidence[str(user_ids[seat])] = [
+                    name for name, bit in SOURCE_BITS.items() if seat_sources[found] & bit
+                ]
+        rounds.append(Round(
+            match=match,
+            round_index=index,
+            track_id=track_id,
+            truth_user_ids=[int(user_id) for user_id in evidence],
+            evidence=evidence,
+        ))
+    Round.objects.bulk_create(rounds)
+    return match
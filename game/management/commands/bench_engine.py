@@ -0,0 +1,116 @@
+import random
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from GuessWho.stats import percentile
+from game.engine import build_owner_masks, create_match, plan_rounds
+from rooms.models import Room
+from spotify_sync.models import SpotifyTrack, UserTasteSnapshot
+from spotify_sync.snapshots import SOURCE_BITS, build_snapshot, unpack_array
+
+User = get_user_model()
+TARGET_MS = 50
+
+
+class Command(BaseCommand):
+    help = (
+        'Time match precompute (game.engine): the in-memory planning step on '
+        'synthetic evidence, then create_match end to end (snapshot load, '
+        'metadata check, inserts) against a throwaway test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=8)
+        parser.add_argument('--tracks', type=int, default=200, help='Evidence tracks per player.')
+        parser.add_argument('--overlap', type=float, default=0.3,
+                            help='Share of each player\'s tracks drawn from a pool common to the room.')
+        parser.add_argument('--iterations', type=int, default=500)
+        parser.add_argument('--skip-db', action='store_true', help='Only time the in-memory step.')
+
+    def handle(self, *args, **options):
+        players, iterations = options['players'], options['iterations']
+        evidence = _synthetic_evidence(players, options['tracks'], options['overlap'])
+        self.stdout.write(
+            f'{players} players x {options["tracks"]} tracks, {iterations} matches '
+            f'(target: well under {TARGET_MS} ms)'
+        )
+
+        seat_tracks = [build_snapshot(rows)[0] for rows in evidence]
+        timings = []
+        for seed in range(iterations):
+            started = time.perf_counter()
+            # Decoding is part of the real path (load_taste_snapshots)
+            track_ids, owners = build_owner_masks([unpack_array('q', blob) for blob in seat_tracks])
+            plan_rounds(track_ids, owners, players, seed=seed)
+            timings.append(time.perf_counter() - started)
+        self._report('masks + plan', timings)
+
+        if not options['skip_db']:
+            self._bench_create_match(evidence, iterations)
+
+    def _bench_create_match(self, evidence, iterations):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            user_ids = _load_fixture(evidence)
+            players = [(user_id, f'Player {user_id}') for user_id in user_ids]
+            room = Room.objects.create(code='BENCH', host_user_id=user_ids[0])
+            queries = []
+            timings = []
+            for seed in range(min(iterations, 200)):
+                count = [0]
+
+                def counter(execute, sql, params, many, context):
+                    count[0] += 1
+                    return execute(sql, params, many, context)
+
+                started = time.perf_counter()
+                with connection.execute_wrapper(counter), transaction.atomic():
+                    create_match(room, players, seed=seed)
+                timings.append(time.perf_counter() - started)
+                queries.append(count[0])
+            self._report('create_match', timings, f', {max(queries)} queries')
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _report(self, name, timings, extra=''):
+        timings.sort()
+        p50, p95 = percentile(timings, 50) * 1000, percentile(timings, 95) * 1000
+        style = self.style.SUCCESS if p95 < TARGET_MS else self.style.WARNING
+        self.stdout.write(style(f'  {name:<14} p50 {p50:6.2f} ms, p95 {p95:6.2f} ms{extra}'))
+
+
+def _synthetic_evidence(players, tracks, overlap):
+    # A common pool gives the room shared tracks; the rest are mostly personal
+    rng = random.Random(0)
+    universe = tracks * players * 4
+    common = rng.sample(range(1, universe + 1), max(1, int(tracks * overlap * 2)))
+    sources = list(SOURCE_BITS)
+    evidence = []
+    for _ in range(players):
+        shared = set(rng.sample(common, min(len(common), int(tracks * overlap))))
+        while len(shared) < tracks:
+            shared.add(rng.randint(1, universe))
+        evidence.append([(track_id, rng.choice(sources)) for track_id in shared])
+    return evidence
+
+
+def _load_fixture(evidence):
+    track_ids = sorted({track_id for rows in evidence for track_id, _ in rows})
+    SpotifyTrack.objects.bulk_create([
+        SpotifyTrack(id=track_id, spotify_track_id=f'bench{track_id}',
+                     name=f'Track {track_id}', artist_name='Bench')
+        for track_id in track_ids
+    ])
+    User.objects.bulk_create([User(username=f'bench-{i}') for i in range(len(evidence))])
+    users = list(User.objects.filter(username__startswith='bench-').order_by('id'))
+    snapshots = []
+    for user, rows in zip(users, evidence):
+        packed_ids, packed_sources, count = build_snapshot(rows)
+        snapshots.append(UserTasteSnapshot(
+            user=user, track_ids=packed_ids, sources=packed_sources, track_count=count,
+        ))
+    UserTasteSnapshot.objects.bulk_create(snapshots)
+    return [user.id for user in users]
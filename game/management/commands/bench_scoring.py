@@ -0,0 +1,123 @@
+import random
+import time
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from game.models import Match, MatchPlayer, Round
+from game.scoring import rank_scores, score_masks, score_round
+from spotify_sync.models import SpotifyTrack
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Time round scoring (game.scoring) for many rooms ending a round at '
+        'once: the workplan\'s set formula per answer against one bitmask pass '
+        'over every answer, then score_round end to end (one bulk write per '
+        'round) against a throwaway test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=1000)
+        parser.add_argument('--players', type=int, default=8)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--db-rounds', type=int, default=100,
+                            help='Rounds to score through the database (0 skips it).')
+
+    def handle(self, *args, **options):
+        rooms, players = options['rooms'], options['players']
+        rng = random.Random(0)
+        truths = [_random_mask(rng, players) or 1 for _ in range(rooms)]
+        guesses = [_random_mask(rng, players) for _ in range(rooms * players)]
+        scores = np.zeros((rooms, players), dtype=np.int64)
+        self.stdout.write(f'{rooms} rooms x {players} players, {rooms * players} answers per round end')
+
+        def per_answer():
+            truth_sets = [_seats(mask) for mask in truths]
+            for i, mask in enumerate(guesses):
+                guess, truth = _seats(mask), truth_sets[i // players]
+                correct, incorrect = len(guess & truth), len(guess - truth)
+                scores.flat[i] += 100 * correct - (0 if len(guess) <= 1 else 75 * incorrect)
+            for row in scores:
+                sorted(row, reverse=True)
+
+        guess_masks = np.array(guesses, dtype=np.uint8)
+        truth_masks = np.repeat(np.array(truths, dtype=np.uint8), players)
+
+        def vectorized():
+            deltas = score_masks(guess_masks, truth_masks)[0]
+            scores.flat[:] += deltas
+            rank_scores(scores)
+
+        baseline = None
+        for name, run in [('set formula per answer', per_answer), ('bitmask, one pass', vectorized)]:
+            cost = _seconds_per_call(run, options['iterations'])
+            baseline = baseline or cost
+            self.stdout.write(
+                f'  {name:<24} {cost * 1000:7.2f} ms/round end, '
+                f'{cost / (rooms * players) * 1e6:5.2f} µs/answer ({baseline / cost:.1f}x)'
+            )
+
+        if options['db_rounds']:
+            self._bench_score_round(options['db_rounds'], players, rng)
+
+    def _bench_score_round(self, count, players, rng):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            User.objects.bulk_create([User(username=f'bench-{i}') for i in range(players)])
+            user_ids = list(User.objects.filter(username__startswith='bench-').values_list('id', flat=True))
+            track = SpotifyTrack.objects.create(spotify_track_id='bench', name='Bench', artist_name='Bench')
+            timings, queries = [], []
+            for _ in range(count):
+                match = Match.objects.create(seed=0)
+                MatchPlayer.objects.bulk_create([
+                    MatchPlayer(match=match, user_id=user_id, seat=seat, display_name=f'Player {seat}')
+                    for seat, user_id in enumerate(user_ids)
+                ])
+                game_round = Round.objects.create(
+                    match=match, round_index=0, track=track, status='active',
+                    truth_user_ids=rng.sample(user_ids, rng.randint(1, 3)),
+                )
+                answers = {
+                    user_id: (rng.sample(user_ids, rng.randint(0, 3)), None, rng.randint(500, 12000))
+                    for user_id in user_ids
+                }
+                count_queries = [0]
+
+                def counter(execute, sql, params, many, context):
+                    count_queries[0] += 1
+                    return execute(sql, params, many, context)
+
+                started = time.perf_counter()
+                with connection.execute_wrapper(counter):
+                    score_round(game_round, answers)
+                timings.append(time.perf_counter() - started)
+                queries.append(count_queries[0])
+            timings.sort()
+            self.stdout.write(
+                f'  score_round              p50 {timings[len(timings) // 2] * 1000:.2f} ms, '
+                f'p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms, '
+                f'{max(queries)} queries for {players} answers'
+            )
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def _random_mask(rng, players):
+    return sum(1 << seat for seat in range(players) if rng.random() < 0.3)
+
+
+def _seats(mask):
+    return {seat for seat in range(8) if mask >> seat & 1}
+
+
+def _seconds_per_call(func, iterations):
+    func()  # warm up
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
@@ -0,0 +1,46 @@
+import asyncio
+import signal
+from django.core.management.base import BaseCommand
+from game.runtime import MatchClock, get_clock_metrics
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a match clock: fires every running match\'s phase transitions '
+        '(game.runtime) from one event loop. Run one per host or more; claims '
+        'keep each transition to a single clock.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stats-interval', type=float, default=60.0,
+                            help='Seconds between lag reports (0 disables them).')
+        parser.add_argument('--metrics', action='store_true',
+                            help='Print the fleet-wide clock metrics and exit.')
+
+    def handle(self, *args, **options):
+        if options['metrics']:
+            for key, value in get_clock_metrics().items():
+                self.stdout.write(f'{key}: {value}')
+            return
+        asyncio.run(self._run(options['stats_interval']))
+
+    async def _run(self, stats_interval):
+        clock = MatchClock()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        async def report():
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=stats_interval)
+                except asyncio.TimeoutError:
+                    self.stdout.write(f'match clock: {clock.summary()}')
+
+        self.stdout.write(f'match clock running (tick {clock.tick}s, lease {clock.lease_ms} ms)')
+        reporter = asyncio.ensure_future(report()) if stats_interval else None
+        await clock.run(stop)
+        if reporter:
+            await reporter
+        self.stdout.write(f'match clock stopped: {clock.summary()}')
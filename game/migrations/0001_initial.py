@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('rooms', '0003_room_reaping'),
+        ('spotify_sync', '0002_usertastesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Match',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('active', 'Active'), ('revealing', 'Revealing'), ('finished', 'Finished'), ('cancelled', 'Cancelled')], default='active', max_length=20)),
+                ('round_count', models.PositiveSmallIntegerField(default=10)),
+                ('current_round_index', models.PositiveSmallIntegerField(default=0)),
+                ('seed', models.BigIntegerField()),
+                ('config', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('room', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='matches', to='rooms.room')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Round',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round_index', models.PositiveSmallIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('active', 'Active'), ('revealed', 'Revealed'), ('closed', 'Closed')], default='pending', max_length=20)),
+                ('truth_user_ids', models.JSONField(default=list)),
+                ('evidence', models.JSONField(default=dict)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('deadline_at', models.DateTimeField(blank=True, null=True)),
+                ('revealed_at', models.DateTimeField(blank=True, null=True)),
+                ('match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rounds', to='game.match')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='spotify_sync.spotifytrack')),
+            ],
+            options={
+                'ordering': ['round_index'],
+                'unique_together': {('match', 'round_index')},
+            },
+        ),
+    ]
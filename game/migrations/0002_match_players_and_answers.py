@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchPlayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seat', models.PositiveSmallIntegerField()),
+                ('display_name', models.CharField(max_length=255)),
+                ('score', models.IntegerField(default=0)),
+                ('correct_selections_total', models.PositiveIntegerField(default=0)),
+                ('incorrect_selections_total', models.PositiveIntegerField(default=0)),
+                ('rounds_answered', models.PositiveSmallIntegerField(default=0)),
+                ('avg_response_ms', models.PositiveIntegerField(blank=True, null=True)),
+                ('position_final', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='players', to='game.match')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_players', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['seat'],
+                'unique_together': {('match', 'seat'), ('match', 'user')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RoundAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('selected_user_ids', models.JSONField(default=list)),
+                ('submitted_at', models.DateTimeField(blank=True, null=True)),
+                ('response_ms', models.PositiveIntegerField(blank=True, null=True)),
+                ('score_delta', models.IntegerField(default=0)),
+                ('correct_count', models.PositiveSmallIntegerField(default=0)),
+                ('incorrect_count', models.PositiveSmallIntegerField(default=0)),
+                ('selection_count', models.PositiveSmallIntegerField(default=0)),
+                ('match_player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='game.matchplayer')),
+                ('round', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='game.round')),
+            ],
+            options={
+                'unique_together': {('round', 'match_player')},
+            },
+        ),
+    ]
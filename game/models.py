@@ -1,3 +1,95 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+class Match(models.Model):
+    """One game (a fixed set of rounds) played in a room."""
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('revealing', 'Revealing'),
+        ('finished', 'Finished'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    # Kept when the room is reaped (rooms.tasks.reap_rooms)
+    room = models.ForeignKey(
+        'rooms.Room', on_delete=models.SET_NULL, null=True, related_name='matches'
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+    round_count = models.PositiveSmallIntegerField(default=10)
+    current_round_index = models.PositiveSmallIntegerField(default=0)
+    seed = models.BigIntegerField()  # replays the round selection (game.engine)
+    config = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    ended_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Match {self.pk} ({self.status})"
+
+class MatchPlayer(models.Model):
+    """A player's seat and running totals in one match."""
+    match = models.ForeignKey(Match, on_delete=models.CASCADE, related_name='players')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='match_players'
+    )
+    # Bit index in the match's player masks (game.engine, game.scoring)
+    seat = models.PositiveSmallIntegerField()
+    display_name = models.CharField(max_length=255)
+    score = models.IntegerField(default=0)
+    correct_selections_total = models.PositiveIntegerField(default=0)
+    incorrect_selections_total = models.PositiveIntegerField(default=0)
+    rounds_answered = models.PositiveSmallIntegerField(default=0)
+    avg_response_ms = models.PositiveIntegerField(null=True, blank=True)
+    position_final = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [['match', 'user'], ['match', 'seat']]
+        ordering = ['seat']
+
+    def __str__(self):
+        return f"{self.display_name} in match {self.match_id}"
+
+class Round(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('active', 'Active'),
+        ('revealed', 'Revealed'),
+        ('closed', 'Closed'),
+    ]
+
+    match = models.ForeignKey(Match, on_delete=models.CASCADE, related_name='rounds')
+    round_index = models.PositiveSmallIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    track = models.ForeignKey('spotify_sync.SpotifyTrack', on_delete=models.PROTECT, related_name='+')
+    # The players with evidence for the track: the answer to "who listened to this?"
+    truth_user_ids = models.JSONField(default=list)
+    # Why each of them counts, for the reveal: {user_id: [source_type, ...]}
+    evidence = models.JSONField(default=dict)
+    started_at = models.DateTimeField(null=True, blank=True)
+    deadline_at = models.DateTimeField(null=True, blank=True)
+    revealed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ['match', 'round_index']
+        ordering = ['round_index']
+
+    def __str__(self):
+        return f"Round {self.round_index} of match {self.match_id}"
+
+class RoundAnswer(models.Model):
+    """A player's final answer to a round, written with the round's scores."""
+    round = models.ForeignKey(Round, on_delete=models.CASCADE, related_name='answers')
+    match_player = models.ForeignKey(MatchPlayer, on_delete=models.CASCADE, related_name='answers')
+    selected_user_ids = models.JSONField(default=list)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    response_ms = models.PositiveIntegerField(null=True, blank=True)
+    score_delta = models.IntegerField(default=0)
+    correct_count = models.PositiveSmallIntegerField(default=0)
+    incorrect_count = models.PositiveSmallIntegerField(default=0)
+    selection_count = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['round', 'match_player']
+
+    def __str__(self):
+        return f"Answer by {self.match_player_id} to round {self.round_id}"
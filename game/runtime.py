@@ -0,0 +1,654 @@
+"""
+Match runtime: the timed phases a match runs through once it starts.
+
+    generating_rounds → round_active → round_reveal → scoreboard_interim
+                      → round_active → ... → round_reveal → final_results → ended
+
+A running match lives in Redis rather than the database:
+
+    match:{id}:state    JSON {phase, round_index, deadline (epoch ms), seq, ...}
+    match:{id}:rounds   JSON round payloads, written once at start
+    room:{code}:match   the room's running match id
+    matches:deadlines   sorted set: match id → its current deadline
+    match:{id}:answers:{round}   the round's answers, last write wins
+    match:{id}:receipts:{round}  acks by idempotency key, for retries
+
+Clients count down from the deadline themselves; nothing ticks per room.
+One clock per process (the run_match_clock command) polls the sorted set,
+and a poll claims what's due by pushing it a lease into the future, so any
+number of clocks can run and each transition is driven by one of them. If a
+clock dies mid-transition its lease runs out and another one retries; the
+state's ``seq`` guards the write, so a transition never lands twice.
+"""
+import asyncio
+import collections
+import json
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from GuessWho.redis_client import get_async_redis, get_redis
+from GuessWho.stats import percentile
+from rooms.frames import broadcast
+from rooms.state import queue_delta, room_op
+
+logger = logging.getLogger(__name__)
+
+DEADLINES_KEY = 'matches:deadlines'
+METRICS_KEY = 'matches:clock:metrics'
+# Safety net for a match no clock ever finishes
+STATE_TTL = 24 * 60 * 60
+# How long an ended match's state stays readable (late reconnects)
+ENDED_TTL = 5 * 60
+# Transition lag histogram bounds, in milliseconds
+LAG_BUCKETS_MS = (10, 25, 50, 100, 250, 1000)
+# Set in a round's answers hash once the clock has read it for scoring
+LOCKED_FIELD = 'locked'
+# Longest idempotency key a client may send
+MAX_ANSWER_KEY = 64
+
+# Take up to ARGV[3] due matches, pushing each a lease ahead so no other
+# clock takes it meanwhile. Returns [member, deadline, ...] followed by the
+# earliest deadline still waiting (or -1)
+_CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+local lease = tonumber(ARGV[1]) + tonumber(ARGV[2])
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], lease, due[i])
+end
+local nxt = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+due[#due + 1] = nxt[2] or '-1'
+return due
+"""
+
+# Write the next state only if nobody has moved the match on since it was read
+_COMMIT_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current or cjson.decode(current)['seq'] ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[5])
+if ARGV[4] == '' then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+else
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[3])
+end
+return 1
+"""
+
+# Store one player's answer if the round is still open. A key seen before
+# returns its first ack instead, so a retried submit never overwrites a
+# newer answer; a match that is no longer the room's running one is
+# 'stale'. Returns {status, ack or current round index}
+_ANSWER_SCRIPT = """
+local receipt = ARGV[1] .. ':' .. ARGV[4]
+if ARGV[4] ~= '' then
+    local seen = redis.call('HGET', KEYS[3], receipt)
+    if seen then
+        return {'duplicate', seen}
+    end
+end
+if redis.call('GET', KEYS[4]) ~= ARGV[9] then
+    return {'stale', '-1'}
+end
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return {'locked', '-1'}
+end
+local state = cjson.decode(raw)
+local now = tonumber(ARGV[5])
+if state['phase'] ~= 'round_active' or state['round_index'] ~= tonumber(ARGV[2])
+        or now >= state['deadline'] or redis.call('HEXISTS', KEYS[2], ARGV[8]) == 1 then
+    return {'locked', tostring(state['round_index'])}
+end
+local response_ms = math.max(0, now - (state['deadline'] - tonumber(ARGV[6])))
+redis.call('HSET', KEYS[2], ARGV[1], string.format(
+    '{"selected":%s,"submitted_at":%d,"response_ms":%d}', ARGV[3], now, response_ms))
+local ack = string.format(
+    '{"round_index":%d,"selected_user_ids":%s,"submitted_at":%d,"response_ms":%d}',
+    state['round_index'], ARGV[3], now, response_ms)
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[3], receipt, ack)
+end
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+redis.call('EXPIRE', KEYS[3], ARGV[7])
+return {'ok', ack}
+"""
+
+def _state_key(match_id):
+    return f'match:{match_id}:state'
+
+def _rounds_key(match_id):
+    return f'match:{match_id}:rounds'
+
+def _room_match_key(room_code):
+    return f'room:{room_code}:match'
+
+def answers_key(match_id, round_index):
+    """Hash of user id → JSON ``{selected, submitted_at, response_ms}`` for one round."""
+    return f'match:{match_id}:answers:{round_index}'
+
+def _receipts_key(match_id, round_index):
+    return f'match:{match_id}:receipts:{round_index}'
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _phase_seconds(phase):
+    return {
+        'generating_rounds': settings.MATCH_START_SECONDS,
+        'round_active': settings.MATCH_ANSWER_SECONDS,
+        'round_reveal': settings.MATCH_REVEAL_SECONDS,
+        'scoreboard_interim': settings.MATCH_SCOREBOARD_SECONDS,
+        'final_results': settings.MATCH_RESULTS_SECONDS,
+    }[phase]
+
+# ── Starting ─────────────────────────────────────────────────────
+
+def build_match_runtime(match, room_code):
+    """
+    Everything the clock needs to run ``match`` without the database: the
+    round payloads and the seating. Two queries; call after create_match.
+    """
+    from .models import MatchPlayer
+    rounds = [
+        {
+            'id': game_round.pk,
+            'track': {
+                'name': game_round.track.name,
+                'artist': game_round.track.artist_name,
+                'album_image_url': game_round.track.album_image_url,
+                # None until the track's audio is resolved: the round plays metadata-only
+                'youtube_video_id': game_round.track.youtube_video_id,
+                'preview_url': game_round.track.preview_url,
+            },
+            'truth_user_ids': game_round.truth_user_ids,
+            'evidence': game_round.evidence,
+        }
+        for game_round in match.rounds.select_related('track')
+    ]
+    players = list(MatchPlayer.objects.filter(match=match).values('user_id', 'display_name', 'seat'))
+    return {
+        'match_id': match.pk,
+        'room_id': match.room_id,
+        'room_code': room_code,
+        'rounds': rounds,
+        'players': players,
+    }
+
+async def start_match(runtime):
+    """Put a planned match on the clock. Returns its first state."""
+    match_id = runtime['match_id']
+    state = {
+        'match_id': match_id,
+        'room_id': runtime['room_id'],
+        'room_code': runtime['room_code'],
+        'phase': 'generating_rounds',
+        'round_index': 0,
+        'round_count': len(runtime['rounds']),
+        # Who may be picked in an answer
+        'user_ids': [player['user_id'] for player in runtime['players']],
+        'deadline': _now_ms() + int(_phase_seconds('generating_rounds') * 1000),
+        'seq': 1,
+    }
+    pipe = get_async_redis().pipeline(transaction=True)
+    pipe.set(_rounds_key(match_id), json.dumps(runtime['rounds']), ex=STATE_TTL)
+    pipe.set(_state_key(match_id), json.dumps(state), ex=STATE_TTL)
+    pipe.set(_room_match_key(runtime['room_code']), match_id, ex=STATE_TTL)
+    pipe.zadd(DEADLINES_KEY, {match_id: state['deadline']})
+    await pipe.execute()
+    return state
+
+async def load_match_state(room_code):
+    """The room's running match state, or None."""
+    r = get_async_redis()
+    match_id = await r.get(_room_match_key(room_code))
+    if not match_id:
+        return None
+    raw = await r.get(_state_key(match_id))
+    return json.loads(raw) if raw else None
+
+async def current_match_frame(room_code):
+    """
+    The frame for the phase the room's match is in, for a socket joining
+    mid-match. None when no match is running.
+    """
+    state = await load_match_state(room_code)
+    if state is None or state['phase'] == 'ended':
+        return None
+    rounds = json.loads(await get_async_redis().get(_rounds_key(state['match_id'])) or '[]')
+    return {**_phase_frame(state, rounds), 'type': 'match.state'}
+
+# ── Answers ──────────────────────────────────────────────────────
+
+class InvalidAnswer(ValueError):
+    """A round.answer frame that can't be stored; the message is for the player."""
+
+def clean_answer(data, user_ids):
+    """
+    Validate a round.answer frame against the match's players. Returns
+    ``(round_index, selected_user_ids, idempotency_key)``.
+    """
+    round_index = data.get('round_index')
+    if type(round_index) is not int or round_index < 0:
+        raise InvalidAnswer('Answer is missing its round.')
+    selected = data.get('selected_user_ids', [])
+    if not isinstance(selected, list) or any(type(user_id) is not int for user_id in selected):
+        raise InvalidAnswer('Pick players by their ids.')
+    selected = sorted(set(selected))
+    if not set(selected) <= set(user_ids):
+        raise InvalidAnswer('You can only pick players in this match.')
+    key = data.get('idempotency_key') or ''
+    if not isinstance(key, str) or len(key) > MAX_ANSWER_KEY:
+        raise InvalidAnswer(f'idempotency_key must be a string of at most {MAX_ANSWER_KEY} characters.')
+    return round_index, selected, key
+
+async def submit_answer(match_id, room_code, user_id, round_index, selected, key=''):
+    """
+    Store a player's answer for the open round: one Redis round trip and no
+    database. The clock saves the round's answers together when it closes
+    (score_rounds). Returns the frame for the player: ``round.answer.ack``,
+    or ``round.locked`` once the round's deadline has passed. Returns None
+    when ``match_id`` is no longer the room's running match.
+    """
+    status, payload = await get_async_redis().eval(
+        _ANSWER_SCRIPT, 4,
+        _state_key(match_id), answers_key(match_id, round_index), _receipts_key(match_id, round_index),
+        _room_match_key(room_code),
+        user_id, round_index, json.dumps(selected), key, _now_ms(),
+        int(settings.MATCH_ANSWER_SECONDS * 1000), STATE_TTL, LOCKED_FIELD, match_id,
+    )
+    if status == 'stale':
+        return None
+    if status == 'locked':
+        return {
+            'type': 'round.locked', 'v': 1, 'match_id': match_id, 'round_index': round_index,
+            'current_round_index': int(payload), 'idempotency_key': key,
+        }
+    return {
+        'type': 'round.answer.ack', 'v': 1, 'match_id': match_id, 'idempotency_key': key,
+        'duplicate': status == 'duplicate', **json.loads(payload),
+    }
+
+# ── Phases ───────────────────────────────────────────────────────
+
+def _next_state(state, phase, round_index=None, now_ms=None, **extra):
+    deadline = None
+    if phase != 'ended':
+        deadline = (now_ms or _now_ms()) + int(_phase_seconds(phase) * 1000)
+    return {
+        **state,
+        **extra,
+        'phase': phase,
+        'round_index': state['round_index'] if round_index is None else round_index,
+        'deadline': deadline,
+        'seq': state['seq'] + 1,
+    }
+
+def _phase_frame(state, rounds):
+    """The client frame announcing ``state``."""
+    index = state['round_index']
+    frame = {
+        'v': 1,
+        'match_id': state['match_id'],
+        'phase': state['phase'],
+        'round_index': index,
+        'round_count': state['round_count'],
+        'deadline': state['deadline'],
+    }
+    if state['phase'] == 'generating_rounds':
+        frame['type'] = 'match.generating'
+    elif state['phase'] == 'round_active':
+        frame.update(type='round.started', track=rounds[index]['track'])
+    elif state['phase'] == 'round_reveal':
+        frame.update(
+            type='round.reveal',
+            track=rounds[index]['track'],
+            truth_user_ids=rounds[index]['truth_user_ids'],
+            evidence=rounds[index]['evidence'],
+            scoreboard=state.get('scoreboard', []),
+        )
+    elif state['phase'] == 'scoreboard_interim':
+        frame.update(type='scoreboard.update', scoreboard=state.get('scoreboard', []))
+    else:
+        frame.update(type='match.finished', scoreboard=state.get('scoreboard', []))
+    return frame
+
+async def _advance(due, now_ms):
+    """
+    Do the work leaving each of the ``(state, rounds)`` pairs in ``due`` and
+    return the states that follow, by match id. The database side is one
+    thread hop and a few queries for the whole batch, however many rooms
+    are in it.
+    """
+    scoring = [state for state, _ in due if state['phase'] == 'round_active']
+    raw_answers = []
+    if scoring:
+        # Lock each round's answers as they're read (one MULTI), so every
+        # answer that was acked is one that gets scored
+        pipe = get_async_redis().pipeline(transaction=True)
+        for state in scoring:
+            key = answers_key(state['match_id'], state['round_index'])
+            pipe.hset(key, LOCKED_FIELD, 1)
+            pipe.expire(key, ENDED_TTL)
+            pipe.hgetall(key)
+        raw_answers = (await pipe.execute())[2::3]
+    boards, entered, finished = await _db(_apply_transitions)(due, raw_answers)
+
+    next_states = {}
+    for state, _ in due:
+        phase, index = state['phase'], state['round_index']
+        if phase == 'generating_rounds':
+            following = _next_state(state, 'round_active', 0, now_ms)
+        elif phase == 'round_active':
+            following = _next_state(state, 'round_reveal', now_ms=now_ms, scoreboard=boards[state['match_id']])
+        elif phase == 'round_reveal' and index + 1 < state['round_count']:
+            following = _next_state(state, 'scoreboard_interim', now_ms=now_ms)
+        elif phase == 'round_reveal':
+            following = _next_state(
+                state, 'final_results', now_ms=now_ms, scoreboard=boards[state['match_id']],
+                # A room that closed mid-match already gave its code back
+                release_code=state['room_id'] in finished,
+            )
+        elif phase == 'scoreboard_interim':
+            following = _next_state(state, 'round_active', index + 1, now_ms)
+        else:
+            following = _next_state(state, 'ended', now_ms=now_ms)
+        next_states[state['match_id']] = following
+
+        if state['room_id'] in entered:
+            await queue_delta(state['room_code'], [room_op(room_status='in_game')])
+        elif state['room_id'] in finished:
+            await queue_delta(state['room_code'], [room_op(room_status='finished')])
+    return next_states
+
+def _db(func):
+    # Not thread-sensitive: batches run their database work in parallel
+    return database_sync_to_async(func, thread_sensitive=False)
+
+def _apply_transitions(due, raw_answers):
+    """
+    Database side of a batch. Returns ``(boards, entered, finished)``: the
+    scoreboards by match id, and the ids of rooms moved to 'in_game' and to
+    'finished'.
+    """
+    states = [state for state, _ in due]
+    entering = [s for s in states if s['phase'] == 'generating_rounds']
+    scoring = [(s, rounds) for s, rounds in due if s['phase'] == 'round_active']
+    finishing = [s for s in states if s['phase'] == 'round_reveal' and s['round_index'] + 1 >= s['round_count']]
+    ending = [s for s in states if s['phase'] == 'final_results']
+
+    boards, entered, finished = {}, set(), set()
+    if entering:
+        entered = _enter_play(entering)
+    if scoring:
+        boards.update(_score(scoring, raw_answers))
+    if finishing:
+        final_boards, finished = _finish_matches(finishing)
+        boards.update(final_boards)
+    if ending:
+        _end_matches(ending)
+    return boards, entered, finished
+
+def _decode_answers(raw):
+    answers = {}
+    for user_id, value in raw.items():
+        if user_id == LOCKED_FIELD:
+            continue
+        answer = json.loads(value)
+        submitted_at = datetime.fromtimestamp(answer['submitted_at'] / 1000, tz=dt_timezone.utc)
+        answers[int(user_id)] = (answer['selected'], submitted_at, answer['response_ms'])
+    return answers
+
+def _enter_play(states):
+    from rooms.models import Room
+    from .models import Match
+    Match.objects.filter(
+        pk__in=[s['match_id'] for s in states], started_at__isnull=True,
+    ).update(started_at=timezone.now())
+    rooms = Room.objects.filter(pk__in=[s['room_id'] for s in states], status='starting')
+    room_ids = set(rooms.values_list('pk', flat=True))
+    Room.objects.filter(pk__in=room_ids, status='starting').update(status='in_game')
+    return room_ids
+
+def _score(scoring, raw_answers):
+    from .models import MatchPlayer, Round
+    from .scoring import build_scoreboard, score_rounds
+    batch = [
+        (
+            Round(
+                pk=rounds[state['round_index']]['id'], match_id=state['match_id'],
+                round_index=state['round_index'],
+                truth_user_ids=rounds[state['round_index']]['truth_user_ids'],
+            ),
+            _decode_answers(raw),
+        )
+        for (state, rounds), raw in zip(scoring, raw_answers)
+    ]
+    boards = {
+        state['match_id']: board
+        for (state, _), board in zip(scoring, score_rounds(batch))
+    }
+    # Rounds scored by a clock that died before saving the next state
+    rescored = [match_id for match_id, board in boards.items() if board is None]
+    if rescored:
+        players = {}
+        for player in MatchPlayer.objects.filter(match_id__in=rescored):
+            players.setdefault(player.match_id, []).append(player)
+        for match_id in rescored:
+            boards[match_id] = build_scoreboard(players.get(match_id, []))
+    return boards
+
+def _finish_matches(states):
+    from django.db import transaction
+    from rooms.models import Room
+    from .models import Match, MatchPlayer
+    from .scoring import build_scoreboard
+    now = timezone.now()
+    match_ids = [s['match_id'] for s in states]
+    with transaction.atomic():
+        players = {}
+        for player in MatchPlayer.objects.filter(match_id__in=match_ids):
+            players.setdefault(player.match_id, []).append(player)
+        boards, by_position = {}, {}
+        for match_id in match_ids:
+            boards[match_id] = build_scoreboard(players.get(match_id, []))
+            positions = {row['user_id']: row['position'] for row in boards[match_id]}
+            for player in players.get(match_id, []):
+                by_position.setdefault(positions[player.user_id], []).append(player.pk)
+        # One update per position (at most one per seat), not a CASE per player
+        for position, player_ids in by_position.items():
+            MatchPlayer.objects.filter(pk__in=player_ids).update(position_final=position)
+        Match.objects.filter(pk__in=match_ids).update(status='finished', ended_at=now)
+        rooms = Room.objects.select_for_update().filter(
+            pk__in=[s['room_id'] for s in states], status__in=['starting', 'in_game'],
+        )
+        room_ids = set(rooms.values_list('pk', flat=True))
+        Room.objects.filter(pk__in=room_ids).update(status='finished', ended_at=now)
+    return boards, room_ids
+
+def _end_matches(states):
+    from rooms.state import retire_room_code
+    pipe = get_redis().pipeline(transaction=False)
+    for state in states:
+        pipe.delete(_rounds_key(state['match_id']), _room_match_key(state['room_code']))
+    pipe.execute()
+    for state in states:
+        if state.get('release_code'):
+            retire_room_code(state['room_code'])
+
+# ── Clock ────────────────────────────────────────────────────────
+
+class MatchClock:
+    """
+    Drives every running match from one event loop: polls the deadline set,
+    claims what's due in batches and runs each batch as its own task.
+    """
+
+    def __init__(self, tick=None, batch=None, lease=None, concurrency=None):
+        self.tick = tick or settings.MATCH_CLOCK_TICK
+        self.batch = batch or settings.MATCH_CLOCK_BATCH
+        self.lease_ms = int((lease or settings.MATCH_CLOCK_LEASE) * 1000)
+        self.concurrency = concurrency or settings.MATCH_CLOCK_CONCURRENCY
+        self.running = set()
+        # Round payloads never change once a match starts
+        self.rounds = {}
+        # Recent samples for percentiles; Redis keeps the fleet-wide totals
+        self.lag_samples = collections.deque(maxlen=10000)
+        self.loop_lag_samples = collections.deque(maxlen=10000)
+        self.counters = collections.Counter()
+
+    async def run(self, stop):
+        """Poll until ``stop`` (an asyncio.Event) is set, then let running batches finish."""
+        r = get_async_redis()
+        wake = time.monotonic()
+        while not stop.is_set():
+            # How late the loop woke up: time it spent on other work
+            self.loop_lag_samples.append(max(0.0, time.monotonic() - wake) * 1000)
+            # Claim only what can start now; the rest stays in the set, where
+            # an idle clock can take it, rather than aging in a local queue
+            claimed, next_deadline = [], -1
+            if len(self.running) < self.concurrency:
+                claimed = await r.eval(_CLAIM_SCRIPT, 1, DEADLINES_KEY, _now_ms(), self.lease_ms, self.batch)
+                next_deadline = float(claimed.pop())
+            if claimed:
+                task = asyncio.ensure_future(self._drive(claimed[::2]))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            await self._flush_metrics(r)
+
+            # Sleep to the next deadline, but no longer than a tick, so a
+            # match started meanwhile waits at most one tick
+            delay = self.tick
+            if len(claimed) // 2 == self.batch and len(self.running) < self.concurrency:
+                delay = 0  # more is due: claim the next batch right away
+            elif next_deadline >= 0:
+                delay = min(delay, max(0.0, (next_deadline - _now_ms()) / 1000))
+            wake = time.monotonic() + delay
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+        await self._flush_metrics(r)
+
+    async def _drive(self, match_ids):
+        r = get_async_redis()
+        # The claim returns members as strings; states (and self.rounds) use ints
+        match_ids = [int(match_id) for match_id in match_ids]
+        try:
+            missing = [match_id for match_id in match_ids if match_id not in self.rounds]
+            pipe = r.pipeline(transaction=False)
+            for match_id in match_ids:
+                pipe.get(_state_key(match_id))
+            for match_id in missing:
+                pipe.get(_rounds_key(match_id))
+            values = await pipe.execute()
+            for match_id, raw in zip(missing, values[len(match_ids):]):
+                self.rounds[match_id] = json.loads(raw or '[]')
+
+            now = _now_ms()
+            due, fixes = [], r.pipeline(transaction=False)
+            for match_id, raw in zip(match_ids, values[:len(match_ids)]):
+                state = json.loads(raw) if raw else None
+                if state is None:
+                    self.rounds.pop(match_id, None)
+                    fixes.zrem(DEADLINES_KEY, match_id)  # expired or cleaned up
+                elif state['deadline'] is None or state['deadline'] > now:
+                    # Moved on since the claim was read; put the real deadline back
+                    if state['deadline'] is not None:
+                        fixes.zadd(DEADLINES_KEY, {match_id: state['deadline']})
+                else:
+                    due.append((state, self.rounds[match_id]))
+            if len(fixes):
+                await fixes.execute()
+            if not due:
+                return
+
+            next_states = await _advance(due, now)
+            pipe = r.pipeline(transaction=False)
+            for state, _ in due:
+                following = next_states[state['match_id']]
+                pipe.eval(
+                    _COMMIT_SCRIPT, 2, _state_key(state['match_id']), DEADLINES_KEY,
+                    state['seq'], json.dumps(following), state['match_id'],
+                    '' if following['deadline'] is None else following['deadline'],
+                    ENDED_TTL if following['phase'] == 'ended' else STATE_TTL,
+                )
+            committed = await pipe.execute()
+
+            layer, sends = get_channel_layer(), []
+            for (state, rounds), landed in zip(due, committed):
+                following = next_states[state['match_id']]
+                if not landed:
+                    self.counters['conflicts'] += 1
+                elif following['phase'] == 'ended':
+                    self.rounds.pop(state['match_id'], None)
+                else:
+                    sends.append(layer.group_send(
+                        f"room_{state['room_code']}",
+                        broadcast('match.event', _phase_frame(following, rounds)),
+                    ))
+            await asyncio.gather(*sends)
+
+            # Lag is measured once clients have been told
+            done = _now_ms()
+            for (state, _), landed in zip(due, committed):
+                if landed:
+                    self._count_transition(done - state['deadline'])
+        except Exception:
+            # The claims lapse after their lease and another poll retries
+            logger.exception('Match clock batch of %s failed', len(match_ids))
+            self.counters['errors'] += 1
+
+    def _count_transition(self, lag):
+        self.lag_samples.append(lag)
+        self.counters['transitions'] += 1
+        self.counters['lag_ms_total'] += lag
+        bucket = next((f'lag_le_{b}' for b in LAG_BUCKETS_MS if lag <= b), f'lag_gt_{LAG_BUCKETS_MS[-1]}')
+        self.counters[bucket] += 1
+
+    async def _flush_metrics(self, r):
+        # One round trip per poll, not one per transition
+        if not self.counters:
+            return
+        counters, self.counters = self.counters, collections.Counter()
+        pipe = r.pipeline(transaction=False)
+        for key, value in counters.items():
+            pipe.hincrby(METRICS_KEY, key, value)
+        await pipe.execute()
+
+    def summary(self):
+        """Percentiles of this clock's recent transition lag and loop lag, in ms."""
+        return {
+            'in_flight': len(self.running),
+            'lag_ms': _percentiles(self.lag_samples),
+            'loop_lag_ms': _percentiles(self.loop_lag_samples),
+        }
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    summary = {f'p{pct}': round(percentile(ordered, pct), 1) for pct in (50, 95, 99)}
+    summary['max'] = round(ordered[-1], 1)
+    return summary
+
+def get_clock_metrics():
+    """Fleet-wide transition counts and lag histogram (transition lag = fired − deadline)."""
+    raw = get_redis().hgetall(METRICS_KEY)
+    transitions = int(raw.get('transitions', 0))
+    buckets = {key: int(value) for key, value in raw.items() if key.startswith('lag_')
+               and key != 'lag_ms_total'}
+    return {
+        'transitions': transitions,
+        'conflicts': int(raw.get('conflicts', 0)),
+        'errors': int(raw.get('errors', 0)),
+        'lag_ms_mean': int(raw.get('lag_ms_total', 0)) / transitions if transitions else 0.0,
+        'lag_histogram': buckets,
+        'pending': get_redis().zcard(DEADLINES_KEY),
+    }
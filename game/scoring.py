@@ -0,0 +1,194 @@
+"""
+Round scoring.
+
+Guess sets and truth sets are masks over the match's seats
+(MatchPlayer.seat), so every answer in a round, or a batch of rounds from
+many rooms, is scored in one NumPy pass: popcount of ``guess & truth`` for
+the correct picks and of ``guess & ~truth`` for the wrong ones.
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .engine import POPCOUNT
+
+CORRECT_POINTS = 100
+# Per wrong pick, and only when more than one player was picked
+INCORRECT_PENALTY = 75
+
+
+def seat_mask(user_ids, seats):
+    """The mask of ``user_ids`` given ``{user_id: seat}``; ids without a seat are ignored."""
+    mask = 0
+    for user_id in user_ids:
+        seat = seats.get(user_id)
+        if seat is not None:
+            mask |= 1 << seat
+    return mask
+
+
+def score_masks(guesses, truths):
+    """
+    Score guess masks against truth masks, one truth per guess or one for all.
+
+    Returns int arrays ``(deltas, correct, incorrect, selected)``.
+    """
+    guesses = np.asarray(guesses, dtype=np.uint8)
+    truths = np.asarray(truths, dtype=np.uint8)
+    correct = POPCOUNT[guesses & truths].astype(np.int32)
+    incorrect = POPCOUNT[guesses & ~truths].astype(np.int32)
+    selected = correct + incorrect
+    deltas = CORRECT_POINTS * correct - np.where(selected > 1, INCORRECT_PENALTY * incorrect, 0)
+    return deltas, correct, incorrect, selected
+
+
+def rank_scores(scores):
+    """
+    Scoreboard positions with ties shared (1, 2, 2, 4). Rows of a 2-D array
+    (one per room) are ranked separately.
+    """
+    scores = np.asarray(scores)
+    # 1 + how many players in the room scored strictly more
+    return 1 + (scores[..., None, :] > scores[..., :, None]).sum(axis=-1)
+
+
+def score_round(game_round, answers, now=None):
+    """
+    Score a round at its deadline and save the results.
+
+    ``answers`` maps user ids to ``(selected_user_ids, submitted_at,
+    response_ms)``; a player without one gets the empty answer. Returns the
+    scoreboard, best first, or None when the round was already scored.
+    """
+    return score_rounds([(game_round, answers)], now)[0]
+
+
+def score_rounds(batch, now=None):
+    """
+    score_round for ``(round, answers)`` pairs from any number of matches.
+
+    One pass scores every answer in the batch, and the queries don't grow
+    with it: a locking select and an update claim the rounds, one bulk
+    insert saves every RoundAnswer and one update the players' totals.
+    Several rounds of one match add up, in batch order. Returns a
+    scoreboard (or None) per pair, each as of the end of its round.
+    """
+    from .models import MatchPlayer, Round, RoundAnswer
+
+    now = now or timezone.now()
+    round_ids = [game_round.pk for game_round, _ in batch]
+    with transaction.atomic():
+        # The status guard makes a second scorer (a retried deadline) a no-op;
+        # rows another scorer holds are skipped, so the ids locked here are
+        # exactly the rounds this call scores
+        claimed_ids = set(Round.objects.select_for_update(skip_locked=True).filter(
+            pk__in=round_ids, status__in=['pending', 'active'],
+        ).values_list('pk', flat=True))
+        if not claimed_ids:
+            return [None] * len(batch)
+        Round.objects.filter(pk__in=claimed_ids).update(status='revealed', revealed_at=now)
+        batch = [(game_round, answers) for game_round, answers in batch if game_round.pk in claimed_ids]
+
+        # In seat order (MatchPlayer.Meta.ordering)
+        players_by_match = {}
+        for player in MatchPlayer.objects.filter(match_id__in={r.match_id for r, _ in batch}):
+            players_by_match.setdefault(player.match_id, []).append(player)
+
+        # Flatten every answer in the batch, each beside its round's truth
+        entries, guesses, truths = [], [], []
+        for game_round, answers in batch:
+            game_round.status, game_round.revealed_at = 'revealed', now
+            players = players_by_match.get(game_round.match_id, [])
+            seats = {player.user_id: player.seat for player in players}
+            truth = seat_mask(game_round.truth_user_ids, seats)
+            for player in players:
+                pick = answers.get(player.user_id, ((), None, None))
+                entries.append((game_round, player, seats, pick))
+                guesses.append(seat_mask(pick[0], seats))
+                truths.append(truth)
+        deltas, correct, incorrect, selected = score_masks(guesses, truths)
+
+        # Each round's entries are contiguous, in batch order
+        rows, boards, timed = [], {}, {}
+        start = 0
+        for game_round, _ in batch:
+            players = players_by_match.get(game_round.match_id, [])
+            end = start + len(players)
+            for i in range(start, end):
+                _, player, seats, (selected_ids, submitted_at, response_ms) = entries[i]
+                player.score += int(deltas[i])
+                player.correct_selections_total += int(correct[i])
+                player.incorrect_selections_total += int(incorrect[i])
+                if response_ms is not None:
+                    total, count = timed.get(player, (0, 0))
+                    timed[player] = (total + response_ms, count + 1)
+                rows.append(RoundAnswer(
+                    round=game_round,
+                    match_player=player,
+                    selected_user_ids=sorted(user_id for user_id in selected_ids if user_id in seats),
+                    submitted_at=submitted_at,
+                    response_ms=response_ms,
+                    score_delta=int(deltas[i]),
+                    correct_count=int(correct[i]),
+                    incorrect_count=int(incorrect[i]),
+                    selection_count=int(selected[i]),
+                ))
+            boards[game_round.pk] = build_scoreboard(players, deltas[start:end])
+            start = end
+        for player, (total, count) in timed.items():
+            answered = player.rounds_answered
+            # Integer division, as the database does it below
+            player.avg_response_ms = ((player.avg_response_ms or 0) * answered + total) // (answered + count)
+            player.rounds_answered = answered + count
+        RoundAnswer.objects.bulk_create(rows)
+        _add_to_totals(claimed_ids, players_by_match)
+
+    return [boards.get(pk) for pk in round_ids]
+
+
+def _add_to_totals(round_ids, players_by_match):
+    # Fold the answers just saved into the players' running totals with one
+    # UPDATE. bulk_update would build a CASE per row and field, which costs
+    # seconds of Python for a batch of a few hundred rounds. A player has an
+    # answer in every claimed round of their match, so these are sums.
+    from .models import MatchPlayer, RoundAnswer
+    answers = RoundAnswer.objects.filter(
+        round_id__in=round_ids, match_player=OuterRef('pk'),
+    ).order_by().values('match_player')
+    timed = Exists(answers.filter(response_ms__isnull=False))
+
+    def summed(aggregate):
+        return Subquery(answers.annotate(total=aggregate).values('total'))
+
+    timed_count = summed(Count('response_ms'))
+    MatchPlayer.objects.filter(match_id__in=players_by_match).update(
+        score=F('score') + summed(Sum('score_delta')),
+        correct_selections_total=F('correct_selections_total') + summed(Sum('correct_count')),
+        incorrect_selections_total=F('incorrect_selections_total') + summed(Sum('incorrect_count')),
+        rounds_answered=F('rounds_answered') + timed_count,
+        avg_response_ms=Case(
+            When(timed, then=(
+                Coalesce('avg_response_ms', 0) * F('rounds_answered') + summed(Sum('response_ms'))
+            ) / (F('rounds_answered') + timed_count)),
+            default=F('avg_response_ms'),
+            output_field=IntegerField(),
+        ),
+    )
+
+
+def build_scoreboard(players, deltas=None):
+    """``[{user_id, display_name, score, delta, position}, ...]``, best first, ties by seat."""
+    scores = np.array([player.score for player in players], dtype=np.int64)
+    positions = rank_scores(scores)
+    order = np.lexsort(([player.seat for player in players], -scores))
+    return [
+        {
+            'user_id': players[i].user_id,
+            'display_name': players[i].display_name,
+            'score': int(scores[i]),
+            'delta': 0 if deltas is None else int(deltas[i]),
+            'position': int(positions[i]),
+        }
+        for i in order
+    ]
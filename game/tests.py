@@ -1,3 +1,348 @@
-from django.test import TestCase
+import json
+import random
+from unittest import mock
+import numpy as np
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from GuessWho.testing import FakeRedisMixin
+from rooms.models import Room
+from spotify_sync.models import SpotifyTrack
+from .engine import MAX_SHAPE_RUN, NotEnoughTracks, POPCOUNT, _bucket_quotas, plan_rounds
+from .models import Match, MatchPlayer, Round, RoundAnswer
+from . import runtime
+from .runtime import MatchClock, build_match_runtime, start_match
+from .scoring import rank_scores, score_masks, score_round, score_rounds, seat_mask
 
-# Create your tests here.
+CASES = 2000
+SEATS = 8
+
+
+def reference_score(guess, truth):
+    """The workplan's formula, on plain sets."""
+    correct = len(guess & truth)
+    incorrect = len(guess - truth)
+    negative = 0 if len(guess) <= 1 else 75 * incorrect
+    return 100 * correct - negative
+
+
+def random_set(rng, seats):
+    return {seat for seat in range(seats) if rng.random() < 0.4}
+
+
+def as_mask(seats):
+    return sum(1 << seat for seat in seats)
+
+
+class ScoreMaskTests(SimpleTestCase):
+    """Bitmask scoring against the workplan's rules."""
+
+    def test_workplan_examples(self):
+        a, b = {0}, {1}
+        # A: single bold guess, wrong
+        self.assertEqual(score_masks([as_mask(b)], as_mask(a))[0][0], 0)
+        # B: hedge with two guesses, one right one wrong
+        self.assertEqual(score_masks([as_mask(a | b)], as_mask(a))[0][0], 25)
+        # C: spam all in a 6-player room, 2 are correct
+        self.assertEqual(score_masks([as_mask(range(6))], as_mask({2, 4}))[0][0], -100)
+
+    def test_matches_set_formula(self):
+        rng = random.Random(21)
+        for _ in range(20):
+            seats = rng.randint(1, SEATS)
+            guesses = [random_set(rng, seats) for _ in range(CASES // 20)]
+            truths = [random_set(rng, seats) or {0} for _ in guesses]
+            deltas, correct, incorrect, selected = score_masks(
+                [as_mask(g) for g in guesses], [as_mask(t) for t in truths]
+            )
+            for i, (guess, truth) in enumerate(zip(guesses, truths)):
+                self.assertEqual(deltas[i], reference_score(guess, truth), (guess, truth))
+                self.assertEqual(correct[i], len(guess & truth))
+                self.assertEqual(incorrect[i], len(guess - truth))
+                self.assertEqual(selected[i], len(guess))
+
+    def test_single_and_empty_guesses_never_lose_points(self):
+        rng = random.Random(22)
+        for _ in range(CASES):
+            truth = as_mask(random_set(rng, SEATS) or {0})
+            self.assertEqual(score_masks([0], truth)[0][0], 0)
+            pick = 1 << rng.randrange(SEATS)
+            self.assertEqual(score_masks([pick], truth)[0][0], 100 if pick & truth else 0)
+
+    def test_extra_wrong_pick_costs_the_penalty(self):
+        rng = random.Random(23)
+        for _ in range(CASES):
+            truth = random_set(rng, SEATS) or {0}
+            wrong = set(range(SEATS)) - truth
+            guess = random_set(rng, SEATS)
+            if not wrong or len(guess) < 2:
+                continue
+            extra = rng.choice(sorted(wrong - guess or wrong))
+            if extra in guess:
+                continue
+            before = score_masks([as_mask(guess)], as_mask(truth))[0][0]
+            after = score_masks([as_mask(guess | {extra})], as_mask(truth))[0][0]
+            self.assertEqual(after, before - 75)
+
+    def test_select_all_never_beats_the_exact_truth(self):
+        rng = random.Random(24)
+        for _ in range(CASES):
+            seats = rng.randint(2, SEATS)
+            truth = as_mask(random_set(rng, seats) or {0})
+            everyone, _, _, _ = score_masks([(1 << seats) - 1], truth)
+            exact, _, _, _ = score_masks([truth], truth)
+            self.assertLessEqual(everyone[0], exact[0])
+
+    def test_seat_mask_ignores_unseated_users(self):
+        self.assertEqual(seat_mask([10, 30, 99], {10: 0, 20: 1, 30: 2}), 0b101)
+
+    def test_ranking_shares_ties(self):
+        self.assertEqual(list(rank_scores([50, 100, 50, -10])), [2, 1, 2, 4])
+        rng = random.Random(25)
+        for _ in range(200):
+            scores = [rng.randint(-300, 300) // 25 * 25 for _ in range(rng.randint(1, SEATS))]
+            expected = [1 + sum(other > score for other in scores) for score in scores]
+            self.assertEqual(list(rank_scores(scores)), expected)
+
+
+class ScoreRoundTests(TestCase):
+    """Scoring a round end to end, against the database."""
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'p{i}') for i in range(3)]
+        self.match = Match.objects.create(seed=1)
+        self.players = MatchPlayer.objects.bulk_create([
+            MatchPlayer(match=self.match, user=user, seat=seat, display_name=user.username)
+            for seat, user in enumerate(self.users)
+        ])
+        track = SpotifyTrack.objects.create(spotify_track_id='t1', name='Song', artist_name='Band')
+        self.round = Round.objects.create(
+            match=self.match, round_index=0, track=track, status='active',
+            truth_user_ids=[self.users[0].id],
+        )
+
+    def test_scores_persist_in_bulk(self):
+        a, b, c = (user.id for user in self.users)
+        answers = {
+            a: ([a], None, 1200),
+            b: ([a, b], None, 3000),
+            # c never answered
+        }
+        # The locking status guard and claim, players, one insert and one update, in a savepoint
+        with self.assertNumQueries(7):
+            board = score_round(self.round, answers)
+
+        self.assertEqual([(row['user_id'], row['score'], row['position']) for row in board],
+                         [(a, 100, 1), (b, 25, 2), (c, 0, 3)])
+        saved = {answer.match_player.user_id: answer for answer in
+                 RoundAnswer.objects.select_related('match_player')}
+        self.assertEqual((saved[b].score_delta, saved[b].correct_count, saved[b].incorrect_count),
+                         (25, 1, 1))
+        self.assertEqual(saved[c].selected_user_ids, [])
+        player = MatchPlayer.objects.get(user_id=b)
+        self.assertEqual((player.score, player.rounds_answered, player.avg_response_ms), (25, 1, 3000))
+
+    def test_second_scoring_is_a_no_op(self):
+        a = self.users[0].id
+        score_round(self.round, {a: ([a], None, 500)})
+        self.assertIsNone(score_round(self.round, {a: ([a], None, 500)}))
+        self.assertEqual(MatchPlayer.objects.get(user_id=a).score, 100)
+        self.assertEqual(RoundAnswer.objects.count(), 3)
+
+    def test_batch_scores_only_the_rounds_it_claims(self):
+        a = self.users[0].id
+        score_round(self.round, {a: ([a], None, 500)})
+        track = SpotifyTrack.objects.create(spotify_track_id='t2', name='Other', artist_name='Band')
+        second = Round.objects.create(match=self.match, round_index=1, track=track, status='active',
+                                      truth_user_ids=[a])
+        # The first round was scored already, with the same timestamp or not
+        boards = score_rounds([(self.round, {a: ([a], None, 500)}), (second, {a: ([a], None, 700)})],
+                              now=self.round.revealed_at)
+        self.assertIsNone(boards[0])
+        self.assertEqual(boards[1][0]['score'], 200)
+        self.assertEqual(RoundAnswer.objects.filter(round=self.round).count(), 3)
+        self.assertEqual(MatchPlayer.objects.get(user_id=a).score, 200)
+
+    def test_rounds_of_one_match_in_a_batch_add_up(self):
+        a, b, c = (user.id for user in self.users)
+        track = SpotifyTrack.objects.create(spotify_track_id='t2', name='Other', artist_name='Band')
+        second = Round.objects.create(match=self.match, round_index=1, track=track, status='active',
+                                      truth_user_ids=[b])
+        with self.assertNumQueries(7):
+            first_board, second_board = score_rounds([
+                (self.round, {a: ([a], None, 500), b: ([a, b], None, 3000)}),
+                (second, {a: ([b], None, 700), b: ([b], None, None)}),
+            ])
+        # Each board as of its own round
+        self.assertEqual([(row['user_id'], row['score'], row['delta']) for row in first_board],
+                         [(a, 100, 100), (b, 25, 25), (c, 0, 0)])
+        self.assertEqual([(row['user_id'], row['score'], row['delta']) for row in second_board],
+                         [(a, 200, 100), (b, 125, 100), (c, 0, 0)])
+        totals = {
+            player.user_id: (player.score, player.correct_selections_total, player.incorrect_selections_total,
+                             player.rounds_answered, player.avg_response_ms)
+            for player in MatchPlayer.objects.all()
+        }
+        self.assertEqual(totals, {
+            a: (200, 2, 0, 2, 600),
+            b: (125, 2, 1, 1, 3000),
+            c: (0, 0, 0, 0, None),
+        })
+
+
+def track_pool(per_bucket, seats=4):
+    """``per_bucket`` tracks with one, two and three owners each, as plan_rounds takes them."""
+    shapes = {1: [1, 2, 4, 8], 2: [3, 5, 6, 9, 10, 12], 3: [7, 11, 13, 14]}
+    owners = [shapes[bucket][i % len(shapes[bucket])]
+              for bucket, count in per_bucket.items() for i in range(count)]
+    return np.arange(1, len(owners) + 1, dtype=np.int64), np.array(owners, dtype=np.uint8), seats
+
+
+def shapes_of(plan):
+    return [min(int(POPCOUNT[mask]), 3) for _, mask in plan]
+
+
+class PlanRoundsTests(SimpleTestCase):
+    """Round planning on fixed pools and seeds."""
+
+    def test_quotas_follow_the_mix(self):
+        plenty = {1: 50, 2: 50, 3: 50}
+        # 5% wildcards round half up: none at 5 rounds, one at 10 and at 20
+        self.assertEqual(_bucket_quotas(5, plenty), {1: 3, 2: 1, 3: 1})
+        self.assertEqual(_bucket_quotas(10, plenty), {1: 5, 2: 3, 3: 1})
+        self.assertEqual(_bucket_quotas(20, plenty), {1: 10, 2: 6, 3: 3})
+        for round_count in (5, 10, 20):
+            quotas = _bucket_quotas(round_count, plenty)
+            for seed in range(20):
+                plan = plan_rounds(*track_pool(plenty), round_count=round_count, seed=seed)
+                shapes = shapes_of(plan)
+                self.assertEqual(len({track for track, _ in plan}), round_count)
+                self.assertTrue(all(shapes.count(b) >= quotas[b] for b in quotas), shapes)
+                runs = ''.join(map(str, shapes))
+                self.assertFalse(any(str(b) * (MAX_SHAPE_RUN + 1) in runs for b in quotas), runs)
+
+    def test_short_bucket_falls_back_to_the_nearest_size(self):
+        self.assertEqual(_bucket_quotas(10, {1: 20, 2: 20, 3: 0}), {1: 5, 2: 4, 3: 0})
+        self.assertEqual(_bucket_quotas(10, {1: 2, 2: 20, 3: 20}), {1: 2, 2: 6, 3: 1})
+        # Two short buckets pass their rounds along the chain
+        self.assertEqual(_bucket_quotas(10, {1: 20, 2: 1, 3: 0}), {1: 8, 2: 1, 3: 0})
+        plan = plan_rounds(*track_pool({1: 20, 2: 20}), seed=3)
+        self.assertEqual(shapes_of(plan).count(3), 0)
+        self.assertGreaterEqual(shapes_of(plan).count(2), 4)
+
+    def test_wildcards_fill_what_the_buckets_cant(self):
+        # Ten one-owner tracks: the quotas cover nine, the wildcard takes the last
+        track_ids, owners, seats = track_pool({1: 10})
+        plan = plan_rounds(track_ids, owners, seats, seed=5)
+        self.assertEqual(sorted(track for track, _ in plan), list(track_ids))
+
+    def test_same_seed_same_plan(self):
+        pool = track_pool({1: 30, 2: 30, 3: 30})
+        self.assertEqual(plan_rounds(*pool, seed=9), plan_rounds(*pool, seed=9))
+        self.assertNotEqual(plan_rounds(*pool, seed=9), plan_rounds(*pool, seed=10))
+
+    def test_not_enough_tracks(self):
+        track_ids, owners, seats = track_pool({1: 5, 2: 4})
+        with self.assertRaises(NotEnoughTracks):
+            plan_rounds(track_ids, owners, seats, seed=1)
+        # Excluded tracks don't count either
+        track_ids, owners, seats = track_pool({1: 6, 2: 6})
+        with self.assertRaises(NotEnoughTracks):
+            plan_rounds(track_ids, owners, seats, seed=1, exclude=track_ids[:3])
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    # Every phase is due as soon as it starts, so each _drive moves one step
+    MATCH_START_SECONDS=0, MATCH_ANSWER_SECONDS=0, MATCH_REVEAL_SECONDS=0,
+    MATCH_SCOREBOARD_SECONDS=0, MATCH_RESULTS_SECONDS=0, ROOM_DELTA_WINDOW=0,
+)
+class MatchClockTests(FakeRedisMixin, TransactionTestCase):
+    """A two-round match driven by the clock, against fakeredis."""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create(username=f'p{i}') for i in range(2)]
+        self.room = Room.objects.create(code='CLOCK', host_user=self.users[0], status='starting')
+        self.match = Match.objects.create(room=self.room, round_count=2, seed=1)
+        MatchPlayer.objects.bulk_create([
+            MatchPlayer(match=self.match, user=user, seat=seat, display_name=user.username)
+            for seat, user in enumerate(self.users)
+        ])
+        for index, user in enumerate(self.users):
+            track = SpotifyTrack.objects.create(spotify_track_id=f't{index}', name='Song', artist_name='Band')
+            Round.objects.create(match=self.match, round_index=index, track=track, truth_user_ids=[user.id])
+        self.runtime = build_match_runtime(self.match, self.room.code)
+        self.clock = MatchClock()
+
+    def stored_state(self):
+        return json.loads(self.redis.get(f'match:{self.match.pk}:state'))
+
+    async def run_to_end(self):
+        """Drive the match one transition at a time; returns the (phase, round) it went through."""
+        state = await start_match(self.runtime)
+        steps = [(state['phase'], state['round_index'])]
+        while state['phase'] != 'ended':
+            await self.clock._drive([str(self.match.pk)])
+            state = self.stored_state()
+            steps.append((state['phase'], state['round_index']))
+        return steps
+
+    @mock.patch('rooms.state.retire_room_code')
+    async def test_phases_run_in_order(self, retire):
+        first = self.users[0].id
+        answered = False
+
+        async def answer_first_round(due, now_ms):
+            nonlocal answered
+            if not answered and due[0][0]['phase'] == 'round_active':
+                answered = True
+                # As submit_answer stores it; the zero-second window is already shut to sockets
+                self.redis.hset(runtime.answers_key(self.match.pk, 0), first, json.dumps(
+                    {'selected': [first], 'submitted_at': now_ms, 'response_ms': 800}))
+            return await advance(due, now_ms)
+
+        advance = runtime._advance
+        with mock.patch.object(runtime, '_advance', answer_first_round):
+            steps = await self.run_to_end()
+        self.assertEqual(steps, [
+            ('generating_rounds', 0), ('round_active', 0), ('round_reveal', 0), ('scoreboard_interim', 0),
+            ('round_active', 1), ('round_reveal', 1), ('final_results', 1), ('ended', 1),
+        ])
+        self.assertEqual(self.clock.counters['transitions'], 7)
+        # The ended match's rounds don't stay cached in the long-lived clock
+        self.assertEqual(self.clock.rounds, {})
+        match = await Match.objects.aget(pk=self.match.pk)
+        room = await Room.objects.aget(pk=self.room.pk)
+        self.assertEqual((match.status, room.status), ('finished', 'finished'))
+        self.assertEqual(await MatchPlayer.objects.filter(user_id=first).values_list('score', flat=True).aget(), 100)
+        self.assertEqual(await Round.objects.filter(match=self.match, status='revealed').acount(), 2)
+        # The room was still in the game, so its code goes back to the pool
+        retire.assert_called_once_with(self.room.code)
+        self.assertIsNone(self.redis.get(f'room:{self.room.code}:match'))
+        self.assertIsNone(self.redis.zscore(runtime.DEADLINES_KEY, self.match.pk))
+
+    @mock.patch('rooms.state.retire_room_code')
+    async def test_closed_room_keeps_its_released_code(self, retire):
+        # Everyone left mid-match and remove_player already retired the code
+        await Room.objects.filter(pk=self.room.pk).aupdate(status='closed')
+        steps = await self.run_to_end()
+        self.assertEqual(steps[-2:], [('final_results', 1), ('ended', 1)])
+        retire.assert_not_called()
+        self.assertEqual((await Room.objects.aget(pk=self.room.pk)).status, 'closed')
+
+    async def test_conflicting_commit_is_dropped(self):
+        state = await start_match(self.runtime)
+        advance = runtime._advance
+
+        async def overtaken(due, now_ms):
+            following = await advance(due, now_ms)
+            # Another clock moves the match on before this one commits
+            self.redis.set(f'match:{self.match.pk}:state', json.dumps({**state, 'seq': state['seq'] + 1}))
+            return following
+
+        with mock.patch.object(runtime, '_advance', overtaken):
+            await self.clock._drive([str(self.match.pk)])
+        self.assertEqual(self.clock.counters['conflicts'], 1)
+        self.assertEqual(self.clock.counters['transitions'], 0)
+        stored = self.stored_state()
+        self.assertEqual((stored['phase'], stored['seq']), ('generating_rounds', state['seq'] + 1))
@@ -0,0 +1,91 @@
+"""
+Room code allocation.
+
+Free codes wait in a Redis set. allocate_room_code moves one into the leased
+set with a single script, so two creates can never get the same code and the
+cost doesn't depend on how many rooms exist. Codes go back to the pool when
+their room closes or is reaped.
+
+The pool is a random sample of the keyspace rather than all of it (28^5 is
+about 17M codes), topped back up by refill_code_pool. Refills skip codes that
+are leased or held by an active room, and the partial unique constraint on
+Room.code is the last line of defence.
+"""
+from django.conf import settings
+from GuessWho.redis_client import get_redis
+from .utils import generate_room_code
+
+POOL_KEY = 'rooms:codes:free'
+LEASED_KEY = 'rooms:codes:leased'
+# Set while a refill is queued, so a run of creates on a low pool queues one
+REFILL_QUEUED_KEY = 'rooms:codes:refill_queued'
+REFILL_QUEUED_TTL = 60
+
+# Pop a free code and lease it; also report how many are left
+_ALLOCATE_SCRIPT = """
+local code = redis.call('SPOP', KEYS[1])
+if code then
+    redis.call('SADD', KEYS[2], code)
+end
+return {code or false, redis.call('SCARD', KEYS[1])}
+"""
+
+# Add candidates to the pool unless someone holds them by now
+_FILL_SCRIPT = """
+local added = 0
+for _, code in ipairs(ARGV) do
+    if redis.call('SISMEMBER', KEYS[2], code) == 0 then
+        added = added + redis.call('SADD', KEYS[1], code)
+    end
+end
+return added
+"""
+
+# Un-lease a code and make it allocatable again
+_RELEASE_SCRIPT = """
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('SADD', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+def allocate_room_code():
+    """
+    Lease a free room code. Release it if the room is never created.
+
+    Returns None if no code is free even after refilling the pool inline,
+    which only happens when nearly the whole keyspace is in use.
+    """
+    r = get_redis()
+    code, left = r.eval(_ALLOCATE_SCRIPT, 2, POOL_KEY, LEASED_KEY)
+    if code is None:
+        # Empty pool (first run, or refills fell behind): fill it here
+        refill_code_pool()
+        code, left = r.eval(_ALLOCATE_SCRIPT, 2, POOL_KEY, LEASED_KEY)
+    if left < settings.ROOM_CODE_POOL_SIZE // 4 and r.set(
+        REFILL_QUEUED_KEY, 1, nx=True, ex=REFILL_QUEUED_TTL,
+    ):
+        from .tasks import refill_room_codes
+        refill_room_codes.delay()
+    return code
+
+def release_room_code(code):
+    """Return a closed or deleted room's code to the pool."""
+    get_redis().eval(_RELEASE_SCRIPT, 2, POOL_KEY, LEASED_KEY, code)
+
+def refill_code_pool(batch_size=1000):
+    """Top the pool up to ROOM_CODE_POOL_SIZE. Returns how many codes were added."""
+    from .models import ACTIVE_STATUSES, Room
+    r = get_redis()
+    added = 0
+    for _ in range(100):  # gives up rather than spin if the keyspace is nearly full
+        missing = settings.ROOM_CODE_POOL_SIZE - r.scard(POOL_KEY)
+        if missing <= 0:
+            break
+        candidates = {generate_room_code() for _ in range(min(missing, batch_size))}
+        candidates -= set(Room.objects.filter(
+            code__in=candidates, status__in=ACTIVE_STATUSES,
+        ).values_list('code', flat=True))
+        if candidates:
+            added += r.eval(_FILL_SCRIPT, 2, POOL_KEY, LEASED_KEY, *candidates)
+    return added
@@ -1,94 +1,182 @@
 import json
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
-from .models import Room, RoomPlayer
-
-class RoomConsumer(WebsocketConsumer):
+import logging
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.db import transaction
+from django.utils import timezone
+from game.engine import NotEnoughTracks, create_match
+from game.runtime import (
+    InvalidAnswer, build_match_runtime, clean_answer, current_match_frame, load_match_state,
+    start_match, submit_answer,
+)
+from .frames import broadcast, encode_frame
+from .models import Room
+from .presence import issue_resume_token, mark_absent, mark_present, resolve_resume_token
+from .state import aload_room_snapshot, join_op, queue_delta, room_op, update_op
+
+logger = logging.getLogger(__name__)
+
+class RoomConsumer(AsyncWebsocketConsumer):
     # handles websocket connections for a room
-    def connect(self):
+    # Room state comes from the cached snapshot (rooms.state); events that need
+    # the database do all of it in one database_sync_to_async hop, and channel
+    # layer calls are awaited directly on the event loop.
+    async def connect(self):
         self.room_code = self.scope['url_route']['kwargs']['room_code'] #extracts room code from URL 
         self.room_group_name = f'room_{self.room_code}'
         self.user = self.scope['user'] #extracts user from scope. scope = request in http
         if self.user.is_anonymous:
-            self.close()
+            await self.close()
             return
-        try:
-            self.room = Room.objects.get(code=self.room_code)
-            self.room_player = RoomPlayer.objects.get(room = self.room, user = self.user)
-        except (Room.DoesNotExist, RoomPlayer.DoesNotExist):
-            self.close()
+        self.user_id = self.user.id
+        # A resume token from an earlier socket only counts for the signed-in
+        # user it was issued to; it never stands in for the session
+        resume = parse_qs(self.scope.get('query_string', b'').decode()).get('resume', [None])[0]
+        if resume and await resolve_resume_token(self.room_code, resume) != self.user_id:
+            resume = None  # someone else's, or lapsed: leave it alone
+        snapshot = await aload_room_snapshot(self.room_code)
+        me = snapshot and next(
+            (p for p in snapshot['players'] if p['user_id'] == self.user_id), None
+        )
+        if me is None:
+            await self.close()  # not a member of this room
             return
-
-        async_to_sync(self.channel_layer.group_add)(self.room_group_name,self.channel_name) #adds this weksocket to a group named 'room_code'
-        self.accept()
-        self.room_player.connection_state = 'connected'
-        self.room_player.save(update_fields=['connection_state'])
-        self._broadcast_room_state()
-
-    def disconnect(self, close_code):
-        if hasattr(self, 'room_player'):
-            try:
-                # Refresh — leave_room view may have already deleted it
-                self.room_player.refresh_from_db()
-                room = self.room_player.room
-                was_host = self.room_player.is_host
-                self.room_player.delete()
-
-                if was_host:
-                    next_player = room.players.order_by('joined_at').first()
-                    if next_player:
-                        next_player.is_host = True
-                        next_player.save(update_fields=['is_host'])
-                    else:
-                        room.status = 'closed'
-                        room.save(update_fields=['status'])
-            except RoomPlayer.DoesNotExist:
-                pass  # Already removed by leave_room view
-
-        if hasattr(self, 'room_group_name'):
-            async_to_sync(self.channel_layer.group_discard)(
-                self.room_group_name, self.channel_name
-            )
-            self._broadcast_room_state()
-
-    def receive(self, text_data):
+        self.room_id = snapshot['room']['id']
+        self.is_host = me['is_host']
+        # The running match's id and players, loaded on the first answer; every
+        # submit checks it is still the room's match (room:{code}:match)
+        self.match = None
+
+        # Presence lives in Redis; RoomPlayer.connection_state is flushed later.
+        # This also cancels the grace-window removal of a returning player.
+        await mark_present(self.room_code, self.user_id, self.channel_name)
+        self.resume_token = await issue_resume_token(self.room_code, self.user_id, previous=resume)
+        me['connection_state'] = 'connected'
+        snapshot['resume_token'] = self.resume_token
+
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name) #adds this weksocket to a group named 'room_code'
+        await self.accept()
+        # The newcomer gets the full state; everyone else just the change
+        await self.send(text_data=encode_frame(snapshot))
+        if snapshot['room_status'] != 'lobby':
+            # Joining mid-match: where the match is and its deadline
+            frame = await current_match_frame(self.room_code)
+            if frame:
+                await self.send(text_data=encode_frame(frame))
+        await queue_delta(self.room_code, [join_op(me)])
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'resume_token'):
+            return  # rejected in connect, never joined the group
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        # The seat (and host role) is kept for ROOM_RECONNECT_GRACE seconds;
+        # rooms.tasks.sweep_dropped_players removes players who don't come back
+        if await mark_absent(self.room_code, self.user_id, self.channel_name, self.resume_token):
+            await queue_delta(self.room_code, [update_op(self.user_id, connection_state='disconnected')])
+
+    async def receive(self, text_data):
         """Handle incoming messages from clients."""
         data = json.loads(text_data)
         msg_type = data.get('type')
 
-        if msg_type == 'match.start':
-            self._handle_start_game()
-    
-    def _handle_start_game(self):
-        # Only the host can start
-        if not self.room_player.is_host:
-            self.send(text_data=json.dumps({
+        if msg_type == 'ping':
+            # Heartbeat: keeps this player's presence alive
+            revived = await mark_present(self.room_code, self.user_id, resume_token=self.resume_token)
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+            if revived:
+                await queue_delta(self.room_code, [update_op(self.user_id, connection_state='connected')])
+        elif msg_type == 'match.start':
+            await self._handle_start_game()
+        elif msg_type == 'round.answer':
+            await self._handle_answer(data)
+        elif msg_type == 'room.sync':
+            # Client saw a version gap and wants the full state
+            snapshot = await aload_room_snapshot(self.room_code)
+            await self.send(text_data=encode_frame(snapshot))
+
+    async def _handle_start_game(self):
+        # Only the host can start (is_host is kept current by room.delta)
+        if not self.is_host:
+            error = 'Only the host can start the game.'
+        else:
+            error, runtime = await self._start_game()
+        if error:
+            await self.send(text_data=json.dumps({
                 'type': 'error',
-                'message': 'Only the host can start the game.'
+                'message': error,
             }))
             return
 
-        # Refresh room state
-        self.room.refresh_from_db()
-        if self.room.status != 'lobby':
-            self.send(text_data=json.dumps({
+        # The match clock (game.runtime) takes it from here
+        try:
+            state = await start_match(runtime)
+        except Exception:
+            # Nothing was put on the clock: give the room back to its lobby
+            logger.exception('Could not start match %s in room %s', runtime['match_id'], self.room_code)
+            await self._cancel_start(runtime['match_id'])
+            await self.send(text_data=json.dumps({
                 'type': 'error',
-                'message': 'Game has already started.'
+                'message': 'The game could not be started. Try again.',
             }))
             return
+        await queue_delta(self.room_code, [room_op(room_status='starting')])
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            broadcast('match.starting', {
+                'type': 'match.starting',
+                'message': 'Game is starting!',
+                'match_id': state['match_id'],
+                'round_count': state['round_count'],
+                'deadline': state['deadline'],
+            }),
+        )
 
-        players = self.room.players.select_related(
-            'user__spotify_account'
-        ).all()
-        player_count = players.count()
+    async def _handle_answer(self, data):
+        # No database on this path: the answer goes to Redis and the match
+        # clock saves the round's answers in one batch when it closes
+        for _ in range(2):
+            if self.match is None:
+                state = await load_match_state(self.room_code)
+                if state is None or state['phase'] == 'ended':
+                    break
+                self.match = {'match_id': state['match_id'], 'user_ids': state['user_ids']}
+            if self.user_id not in self.match['user_ids']:
+                await self.send(text_data=json.dumps({'type': 'error', 'message': 'You are not playing in this match.'}))
+                return
+            try:
+                round_index, selected, key = clean_answer(data, self.match['user_ids'])
+            except InvalidAnswer as exc:
+                await self.send(text_data=json.dumps({'type': 'error', 'message': str(exc)}))
+                return
+            frame = await submit_answer(self.match['match_id'], self.room_code, self.user_id,
+                                        round_index, selected, key)
+            if frame is not None:
+                await self.send(text_data=encode_frame(frame))
+                return
+            # The cached match is no longer the room's (over, or replaced by
+            # a new one): look it up again
+            self.match = None
+        await self.send(text_data=json.dumps({'type': 'error', 'message': 'No round is open.'}))
+
+    # ── Database work (one thread hop per event) ──────────────────
+
+    @database_sync_to_async
+    def _start_game(self):
+        """
+        Check the start conditions, move the room to 'starting' and plan the
+        match (game.engine). Returns ``(error, runtime)``, the runtime being
+        what game.runtime.start_match needs.
+        """
+        room = Room.objects.get(pk=self.room_id)
+        if room.status != 'lobby':
+            return 'Game has already started.', None
+
+        players = list(room.players.select_related('user__spotify_account').order_by('joined_at'))
 
         # Check player count
-        if player_count < self.room.min_players:
-            self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': f'Need at least {self.room.min_players} players.'
-            }))
-            return
+        if len(players) < room.min_players:
+            return f'Need at least {room.min_players} players.', None
 
         # Check all synced
         all_synced = all(
@@ -97,73 +185,47 @@ class RoomConsumer(WebsocketConsumer):
             for p in players
         )
         if not all_synced:
-            self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'All players must be synced before starting.'
-            }))
-            return
-
-        # All checks passed — transition room
-        self.room.status = 'starting'
-        self.room.save(update_fields=['status'])
+            return 'All players must be synced before starting.', None
 
-        # Broadcast to everyone
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'match.starting',
-                'message': 'Game is starting!',
-            }
-        )
-    
-    def _broadcast_room_state(self):
-        # broadcast room state to all clients in room
-        self.room.refresh_from_db()
-        players = self.room.players.select_related(
-            'user__spotify_account'
-        ).order_by('joined_at') #orders players by when they joined
-
-        player_data = []
-        all_synced = True
-        for p in players:
-            spotify = getattr(p.user, 'spotify_account', None)
-            sync_status = spotify.sync_status if spotify else 'not_synced'
-            if sync_status != 'synced':
-                all_synced = False #if any player is not synced, set all_synced to False
-            player_data.append({
-                'user_id': p.user.id,
-                'display_name': p.display_name,
-                'is_host': p.is_host,
-                'sync_status': sync_status,
-                'connection_state': p.connection_state,
-            })
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'room.state',
-                'players': player_data,
-                'all_synced': all_synced,
-                'player_count': len(player_data),
-                'room_status': self.room.status,
-            } #sends message to all clients in room that the room state has changed
-        )
+        # All checks passed — transition room; the status guard stops a double
+        # start, and a match that can't be planned leaves the room in the lobby
+        try:
+            with transaction.atomic():
+                if not Room.objects.filter(pk=room.pk, status='lobby').update(status='starting'):
+                    return 'Game has already started.', None
+                match = create_match(room, [(p.user_id, p.display_name) for p in players])
+        except NotEnoughTracks:
+            return 'Not enough tracks between the players to start a game. Try syncing again.', None
+        return None, build_match_runtime(match, self.room_code)
+
+    @database_sync_to_async
+    def _cancel_start(self, match_id):
+        """Undo _start_game for a match that never reached the clock."""
+        from game.models import Match
+        with transaction.atomic():
+            Match.objects.filter(pk=match_id).update(status='cancelled', ended_at=timezone.now())
+            Room.objects.filter(pk=self.room_id, status='starting').update(status='lobby')
 
     # ── Group message handlers ────────────────────────────────
     # Called when a group_send message is received.
     # Method name matches the 'type' field (dots → underscores).
 
-    def room_state(self, event):
-        self.send(text_data=json.dumps({
-            'type':'room.state',
-            'players':event['players'],
-            'all_synced':event['all_synced'],
-            'player_count':event['player_count'],
-            'room_status':event['room_status'],
-        }))
-
-    def match_starting(self,event):
-        self.send(text_data=json.dumps({
-            'type':'match.starting',
-            'message':event['message'],
-        }))
\ No newline at end of file
+    # Frames arrive already encoded (rooms.frames), so handlers just forward them.
+
+    async def room_delta(self, event):
+        # Track host transfers without asking the database
+        for user_id, is_host in event.get('hosts', ()):
+            if user_id == self.user_id:
+                self.is_host = is_host
+        await self.send(text_data=event['text'])
+
+    async def match_starting(self,event):
+        await self.send(text_data=event['text'])
+
+    async def match_event(self, event):
+        # phase changes from the match clock (game.runtime)
+        await self.send(text_data=event['text'])
+
+    async def player_sync(self, event):
+        # pushed by spotify_sync.notify while a player's sync runs
+        await self.send(text_data=event['text'])
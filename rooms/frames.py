@@ -0,0 +1,23 @@
+"""
+Client-facing WebSocket frames.
+
+Group broadcasts are encoded once by the sender and travel through the
+channel layer as ``{'type': ..., 'text': frame}``; consumers forward the text
+as-is instead of rebuilding and re-encoding it for every socket.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # the stdlib gives the same frames, just slower
+    orjson = None
+
+def encode_frame(payload):
+    """Serialize a frame for ``send(text_data=...)``."""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(',', ':'))
+
+def broadcast(handler_type, frame):
+    """A group message for the ``handler_type`` handler, carrying ``frame`` encoded."""
+    return {'type': handler_type, 'text': encode_frame(frame)}
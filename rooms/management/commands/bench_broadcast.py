@@ -0,0 +1,93 @@
+import json
+import time
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rooms.frames import encode_frame
+from rooms.state import delta_event, join_op, update_op
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the CPU cost of one lobby broadcast: building the group message, '
+        'channels_redis (msgpack) encoding and decoding, and producing the frame '
+        'text for every recipient. Compares re-encoding the frame in each '
+        'consumer with forwarding a frame encoded once by the sender. Needs no '
+        'Redis; only the layer\'s serializer is used.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=8, help='Sockets in the room.')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Server processes the sockets are spread over (one layer message each).')
+        parser.add_argument('--ops', type=int, default=8, help='Ops in the delta.')
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        # Configured like the real layer, so the serializer is the one it uses
+        layer = RedisChannelLayer(**settings.CHANNEL_LAYERS['default'].get('CONFIG', {}))
+        ops = _sample_ops(options['ops'])
+        recipients, processes = options['recipients'], max(1, options['processes'])
+
+        def per_recipient():
+            # The message the sender used to publish, re-encoded by every consumer
+            event = {'type': 'room.delta', 'version': 42, 'ops': ops}
+            for _ in range(processes):
+                received = layer.deserialize(layer.serialize(dict(event, __asgi_channel__=['x'])))
+                for _ in range(recipients // processes):
+                    json.dumps({
+                        'type': 'room.delta',
+                        'version': received['version'],
+                        'ops': received['ops'],
+                    })
+
+        def encode_once():
+            event = delta_event(42, ops)
+            for _ in range(processes):
+                received = layer.deserialize(layer.serialize(dict(event, __asgi_channel__=['x'])))
+                for _ in range(recipients // processes):
+                    received.get('hosts', ())
+                    received['text']
+
+        frame = encode_frame({'type': 'room.delta', 'version': 42, 'ops': ops})
+        self.stdout.write(
+            f'{recipients} recipients over {processes} process(es), {len(ops)} ops, '
+            f'{len(frame)} byte frame, {options["iterations"]} broadcasts'
+        )
+        baseline = None
+        for name, broadcast in [('re-encode per recipient', per_recipient),
+                                ('encode once, forward', encode_once)]:
+            cost = _cpu_per_call(broadcast, options['iterations'])
+            baseline = baseline or cost
+            self.stdout.write(
+                f'  {name:<24} {cost * 1e6:7.1f} µs CPU/broadcast ({baseline / cost:.1f}x)'
+            )
+
+
+def _sample_ops(count):
+    # A lobby's worth of arrivals and sync-status updates
+    ops = []
+    for i in range(count):
+        if i % 2 == 0:
+            ops.append(join_op({
+                'user_id': 1000 + i,
+                'display_name': f'Player with a fairly long display name {i}',
+                'is_host': i == 0,
+                'sync_status': 'synced',
+                'connection_state': 'connected',
+            }))
+        else:
+            ops.append(update_op(
+                1000 + i, sync_status='syncing',
+                progress={'sources_done': 2, 'sources_total': 4, 'tracks': 137},
+            ))
+    return ops
+
+
+def _cpu_per_call(func, iterations):
+    for _ in range(min(iterations, 1000)):  # warm up
+        func()
+    started = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - started) / iterations
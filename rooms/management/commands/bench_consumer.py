@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.urls import re_path
+from django.utils.module_loading import import_string
+from GuessWho.stats import percentile
+from accounts.models import SpotifyAccount
+from rooms.models import Room, RoomPlayer
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Open lobby sockets against RoomConsumer in one event loop (the way one '
+        'Daphne process runs them) with an in-memory channel layer and a '
+        'throwaway test database, and report connections, messages and '
+        'disconnects per second plus queries per event. Needs Redis at '
+        'REDIS_URL for room state versions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=25)
+        parser.add_argument('--players', type=int, default=8, help='Sockets per room.')
+        parser.add_argument('--messages', type=int, default=5,
+                            help='Client messages each socket sends (and waits a reply for).')
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help='Sockets connecting or sending at the same time.')
+        parser.add_argument('--consumer', default='rooms.consumers.RoomConsumer',
+                            help='Dotted path of the consumer class to measure.')
+
+    def handle(self, *args, **options):
+        consumer = import_string(options['consumer'])
+        self.application = URLRouter([
+            re_path(r'ws/room/(?P<room_code>\w+)/$', consumer.as_asgi()),
+        ])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # Count queries on every connection, including the one in the ORM thread
+        self.queries = 0
+        connection_created.connect(self._count_queries)
+        try:
+            sockets = self._create_rooms(options['rooms'], options['players'])
+            layer = {'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {'capacity': 10_000},
+            }}
+            with override_settings(CHANNEL_LAYERS=layer):
+                asyncio.run(self._run(sockets, options['messages'], options['concurrency']))
+        finally:
+            connection_created.disconnect(self._count_queries)
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _count_queries(self, sender, connection, **kwargs):
+        def count(execute, sql, params, many, context):
+            self.queries += 1
+            return execute(sql, params, many, context)
+        connection.execute_wrappers.append(count)
+
+    def _create_rooms(self, room_count, players):
+        User.objects.bulk_create([
+            User(username=f'bench-{r}-{p}') for r in range(room_count) for p in range(players)
+        ])
+        users = {u.username: u for u in User.objects.filter(username__startswith='bench-')}
+        SpotifyAccount.objects.bulk_create([
+            SpotifyAccount(user=u, spotify_user_id=u.username, display_name=u.username,
+                           sync_status='synced')
+            for u in users.values()
+        ])
+        Room.objects.bulk_create([
+            Room(code=f'B{r:04d}', host_user=users[f'bench-{r}-0']) for r in range(room_count)
+        ])
+        rooms = {room.code: room for room in Room.objects.filter(code__startswith='B')}
+        RoomPlayer.objects.bulk_create([
+            RoomPlayer(room=rooms[f'B{r:04d}'], user=users[f'bench-{r}-{p}'],
+                       display_name=f'bench-{r}-{p}', is_host=(p == 0))
+            for r in range(room_count) for p in range(players)
+        ])
+        # (room code, user, is_host) per socket
+        return [
+            (f'B{r:04d}', users[f'bench-{r}-{p}'], p == 0)
+            for r in range(room_count) for p in range(players)
+        ]
+
+    async def _run(self, sockets, messages, concurrency):
+        gate = asyncio.Semaphore(concurrency)
+
+        async def timed(coro):
+            async with gate:
+                started = time.perf_counter()
+                await coro
+                return time.perf_counter() - started
+
+        async def connect(code, user):
+            communicator = WebsocketCommunicator(self.application, f'/ws/room/{code}/')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect(timeout=30)
+            assert connected, f'{user} was refused by room {code}'
+            return communicator
+
+        communicators = {}
+
+        async def open_socket(index, code, user):
+            communicators[index] = await connect(code, user)
+
+        pushed = [0, 0]  # frames, bytes
+
+        async def chat(communicator):
+            for _ in range(messages):
+                # Non-hosts asking to start get an error back
+                await communicator.send_json_to({'type': 'match.start'})
+                # Skip room broadcasts still queued from the connect phase
+                while True:
+                    text = await communicator.receive_from(timeout=30)
+                    if json.loads(text)['type'] == 'error':
+                        break
+                    pushed[0] += 1
+                    pushed[1] += len(text)
+
+        # ── Connect ──────────────────────────────────────────────
+        phases = []
+        start_queries = self.queries
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*[
+            timed(open_socket(i, code, user)) for i, (code, user, _) in enumerate(sockets)
+        ])
+        phases.append(('connect', len(sockets), time.perf_counter() - started,
+                       latencies, self.queries - start_queries))
+
+        # ── Messages ─────────────────────────────────────────────
+        talkers = [communicators[i] for i, (_, _, is_host) in enumerate(sockets) if not is_host]
+        start_queries = self.queries
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*[timed(chat(c)) for c in talkers])
+        phases.append(('message', len(talkers) * messages, time.perf_counter() - started,
+                       [s / max(messages, 1) for s in latencies], self.queries - start_queries))
+
+        # ── Disconnect ───────────────────────────────────────────
+        start_queries = self.queries
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*[
+            timed(c.disconnect(timeout=30)) for c in communicators.values()
+        ])
+        phases.append(('disconnect', len(sockets), time.perf_counter() - started,
+                       latencies, self.queries - start_queries))
+        self._drain(communicators.values(), pushed)
+
+        for name, events, elapsed, latencies, queries in phases:
+            latencies = sorted(latencies)
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f'  events:        {events} in {elapsed:.2f}s')
+            self.stdout.write(f'  throughput:    {events / elapsed:.0f}/s')
+            self.stdout.write(
+                f'  latency:       p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+                f'p95 {percentile(latencies, 95) * 1000:.1f} ms'
+            )
+            self.stdout.write(f'  queries/event: {queries / max(events, 1):.1f}')
+        self.stdout.write(f'room frames delivered: {pushed[0]} ({pushed[1] / 1024:.0f} KiB)')
+
+    def _drain(self, communicators, pushed):
+        # Frames pushed by the server that no client awaited
+        for communicator in communicators:
+            while not communicator.output_queue.empty():
+                message = communicator.output_queue.get_nowait()
+                if message.get('type') == 'websocket.send':
+                    pushed[0] += 1
+                    pushed[1] += len(message.get('text') or '')
@@ -0,0 +1,518 @@
+import asyncio
+import base64
+import json
+import os
+import secrets
+import time
+import tracemalloc
+from importlib import import_module
+from urllib.parse import urlsplit
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from game.models import Match
+from GuessWho.stats import percentile
+from accounts.models import SpotifyAccount
+from rooms.codes import allocate_room_code
+from rooms.models import Room, RoomPlayer
+from rooms.state import retire_room_code
+from spotify_sync.models import SpotifyTrack, UserTasteSnapshot
+from spotify_sync.snapshots import build_snapshot
+
+User = get_user_model()
+USER_PREFIX = 'loadtest-'
+# Tracks each player brings, enough for a two-player match to start
+TRACKS_PER_PLAYER = 8
+TIMEOUT = 30
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate N lobbies of up to 8 signed-in players joining, dropping and '
+        'resuming their seats, leaving and starting the match, and report '
+        'broadcast fan-out latency (p50/p95/p99), messages per second, DB '
+        'queries per event and memory per connection. Runs the ASGI app in '
+        'this process against a throwaway test database by default, or drives '
+        'a running Daphne over real sockets with --url (users, rooms and '
+        'sessions are then written to its database and removed afterwards, '
+        'so it needs DEBUG or --allow-destructive). Needs Redis at REDIS_URL.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--players', type=int, default=8, help='Players per room, 2 to 8.')
+        parser.add_argument('--reconnects', type=int, default=2,
+                            help='Players per room who drop and resume their seat.')
+        parser.add_argument('--think-ms', type=float, default=100.0,
+                            help="Pause between a room's scripted steps.")
+        parser.add_argument('--url',
+                            help='ws://host:port of a running Daphne. Omit to run the app in-process.')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory',
+                            help='Channel layer for in-process runs.')
+        parser.add_argument('--server-pid', type=int,
+                            help="With --url, Daphne's pid, so its memory per connection can be read.")
+        parser.add_argument('--tracemalloc', action='store_true',
+                            help='In-process: also measure Python heap per connection (slows the run).')
+        parser.add_argument('--allow-destructive', action='store_true',
+                            help="With --url and DEBUG off: write to (and clean up) the server's database anyway.")
+
+    def handle(self, *args, **options):
+        if not 2 <= options['players'] <= 8:
+            raise CommandError('--players must be between 2 and 8.')
+        if options['url'] and not (settings.DEBUG or options['allow_destructive']):
+            raise CommandError(
+                "--url writes users, rooms and sessions to the server's database; "
+                'run it with DEBUG on, or pass --allow-destructive.'
+            )
+        self.options = options
+        self.queries = None
+        self.session_keys = []
+        # Users are named per run, and only this run's users are ever deleted
+        self.user_prefix = f'{USER_PREFIX}{secrets.token_hex(4)}-'
+        self.user_ids = []
+        if options['url']:
+            self._run_against_server()
+        else:
+            self._run_in_process()
+
+    def _run_in_process(self):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # Count queries on every connection, including the ones in ORM threads
+        self.queries = 0
+        connection_created.connect(self._count_queries)
+        overrides = {}
+        if self.options['layer'] == 'memory':
+            overrides['CHANNEL_LAYERS'] = {'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {'capacity': 10_000},
+            }}
+        rooms = []
+        try:
+            rooms = self._create_rooms()
+            with override_settings(**overrides):
+                # The full stack, session auth included, as Daphne would run it
+                from GuessWho.asgi import application
+                transport = f'in-process, {self.options["layer"]} channel layer'
+                asyncio.run(self._drive(rooms, transport, lambda *a: _AppClient(application, *a)))
+        finally:
+            connection_created.disconnect(self._count_queries)
+            self._release_codes(rooms)
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _run_against_server(self):
+        base_url = self.options['url'].rstrip('/')
+        rooms = []
+        try:
+            rooms = self._create_rooms()
+            asyncio.run(self._drive(rooms, base_url, lambda *a: _SocketClient(base_url, *a)))
+        finally:
+            # Matches outlive their room and hold on to the tracks they played
+            Match.objects.filter(room__host_user__in=self.user_ids).delete()
+            # Rooms, seats and snapshots go with their users
+            User.objects.filter(pk__in=self.user_ids).delete()
+            SpotifyTrack.objects.filter(spotify_track_id__startswith=self.user_prefix).delete()
+            session_store = import_module(settings.SESSION_ENGINE).SessionStore
+            for key in self.session_keys:
+                session_store(key).delete()
+            self._release_codes(rooms)
+
+    def _count_queries(self, sender, connection, **kwargs):
+        def count(execute, sql, params, many, context):
+            self.queries += 1
+            return execute(sql, params, many, context)
+        connection.execute_wrappers.append(count)
+
+    # ── Setup ─────────────────────────────────────────────────────
+
+    def _create_rooms(self):
+        """Seat every player in their lobby; returns [(code, [(user_id, cookie), ...])], host first."""
+        room_count, players = self.options['rooms'], self.options['players']
+        prefix = self.user_prefix
+        User.objects.bulk_create([
+            User(username=f'{prefix}{r}-{p}') for r in range(room_count) for p in range(players)
+        ])
+        users = {u.username: u for u in User.objects.filter(username__startswith=prefix)}
+        self.user_ids = [u.pk for u in users.values()]
+        SpotifyAccount.objects.bulk_create([
+            SpotifyAccount(user=u, spotify_user_id=u.username, display_name=u.username,
+                           sync_status='synced')
+            for u in users.values()
+        ])
+        # Every player has their own tracks, so match.start can plan its rounds
+        SpotifyTrack.objects.bulk_create([
+            SpotifyTrack(spotify_track_id=f'{u.username}-{t}', name=f'Track {t}', artist_name=u.username)
+            for u in users.values() for t in range(TRACKS_PER_PLAYER)
+        ])
+        tracks = {}
+        for track in SpotifyTrack.objects.filter(spotify_track_id__startswith=prefix).only('spotify_track_id'):
+            tracks.setdefault(track.spotify_track_id.rsplit('-', 1)[0], []).append(track.pk)
+        snapshots = []
+        for u in users.values():
+            packed_ids, packed_sources, count = build_snapshot([(pk, 'recent') for pk in tracks[u.username]])
+            snapshots.append(UserTasteSnapshot(user=u, track_ids=packed_ids, sources=packed_sources,
+                                               track_count=count))
+        UserTasteSnapshot.objects.bulk_create(snapshots)
+        rooms = Room.objects.bulk_create([
+            Room(code=allocate_room_code(), host_user=users[f'{prefix}{r}-0'], max_players=players)
+            for r in range(room_count)
+        ])
+        RoomPlayer.objects.bulk_create([
+            RoomPlayer(room=rooms[r], user=users[f'{prefix}{r}-{p}'],
+                       display_name=f'{prefix}{r}-{p}', is_host=(p == 0))
+            for r in range(room_count) for p in range(players)
+        ])
+
+        # Signed-in sessions, so sockets authenticate the way browsers do
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        cookies = {}
+        self.session_keys = []
+        for user in users.values():
+            session = session_store()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            self.session_keys.append(session.session_key)
+            cookies[user.pk] = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+        return [
+            (rooms[r].code, [
+                (users[f'{prefix}{r}-{p}'].pk, cookies[users[f'{prefix}{r}-{p}'].pk])
+                for p in range(players)
+            ])
+            for r in range(room_count)
+        ]
+
+    def _release_codes(self, rooms):
+        for code, _ in rooms:
+            retire_room_code(code)
+
+    # ── Scenario ──────────────────────────────────────────────────
+
+    async def _drive(self, rooms, transport, make_client):
+        run = _Run()
+        all_joined = _Countdown(len(rooms))
+        measured = asyncio.Event()
+        pid = self.options['server_pid'] if self.options['url'] else os.getpid()
+        rss_before = _rss(pid)
+        if self.options['tracemalloc'] and not self.options['url']:
+            tracemalloc.start()
+        heap_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        start_queries = self.queries
+
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(self._play_room(run, code, [make_client(run, code, *seat) for seat in seats],
+                                                all_joined, measured))
+            for code, seats in rooms
+        ]
+        # Memory is read while every socket is open
+        await all_joined.wait()
+        sockets = sum(len(seats) for _, seats in rooms) - run.failures
+        rss_after = _rss(pid)
+        heap_after = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        tracemalloc.stop()
+        measured.set()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        queries = None if start_queries is None else self.queries - start_queries
+
+        latencies = sorted(run.fan_out_latencies())
+        events = sum(len(times) for times in run.triggers.values())
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{len(rooms)} rooms x {self.options["players"]} players ({transport})'
+        ))
+        counts = {kind: sum(len(t) for (k, _, _), t in run.triggers.items() if k == kind)
+                  for kind in ('join', 'drop', 'start')}
+        self.stdout.write(
+            f'  events:            {events} in {elapsed:.2f}s '
+            f'({counts["join"]} joins, {counts["drop"]} drops, {counts["start"]} starts)'
+        )
+        self.stdout.write(
+            f'  fan-out latency:   p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+            f'p95 {percentile(latencies, 95) * 1000:.1f} ms, '
+            f'p99 {percentile(latencies, 99) * 1000:.1f} ms ({len(latencies)} deliveries)'
+        )
+        self.stdout.write(
+            f'  messages:          {run.frames / elapsed:.0f}/s '
+            f'({run.frames} frames, {run.bytes / 1024:.0f} KiB)'
+        )
+        self.stdout.write(
+            '  queries/event:     ' + (
+                f'{queries / max(events, 1):.2f}' if queries is not None
+                else 'n/a (queries run in the server process)'
+            )
+        )
+        memory = []
+        if rss_before is not None and rss_after is not None:
+            memory.append(f'{(rss_after - rss_before) / max(sockets, 1) / 1024:.1f} KiB RSS')
+        if heap_before is not None:
+            memory.append(f'{(heap_after - heap_before) / max(sockets, 1) / 1024:.1f} KiB Python heap')
+        self.stdout.write('  memory/connection: ' + (', '.join(memory) or 'n/a (pass --server-pid)'))
+        if run.failures:
+            self.stdout.write(self.style.WARNING(f'  failures:          {run.failures}'))
+            for error in sorted(run.errors)[:3]:
+                self.stdout.write(self.style.WARNING(f'    {error}'))
+
+    async def _play_room(self, run, code, clients, all_joined, measured):
+        think = self.options['think_ms'] / 1000
+        reconnects = min(self.options['reconnects'], len(clients) - 1)
+        host, open_clients = clients[0], []
+        try:
+            # Join one by one, so every arrival fans out to the players already in
+            for client in clients:
+                run.trigger('join', code, client.user_id)
+                await client.open()
+                open_clients.append(client)
+                await asyncio.sleep(think)
+        except Exception as exc:
+            run.fail(exc)
+        all_joined.count_down()
+        await measured.wait()
+        try:
+            # Drop and resume the seat, as a flaky connection would
+            for client in clients[1:1 + reconnects]:
+                run.trigger('drop', code, client.user_id)
+                await client.close()
+                await asyncio.sleep(think)
+                run.trigger('join', code, client.user_id)
+                await client.open(resume=client.resume_token)
+                await asyncio.sleep(think)
+            # Someone leaves for good
+            if len(clients) > 1 + reconnects:
+                leaver = clients[-1]
+                run.trigger('drop', code, leaver.user_id)
+                await leaver.close()
+                open_clients.remove(leaver)
+                await asyncio.sleep(think)
+            run.trigger('start', code, None)
+            await host.send({'type': 'match.start'})
+            await asyncio.wait_for(
+                asyncio.gather(*[c.started.wait() for c in open_clients]), TIMEOUT,
+            )
+        except Exception as exc:
+            run.fail(exc)
+        finally:
+            for client in open_clients:
+                await client.close()
+
+
+class _Run:
+    """Trigger times of each room event, and when each player saw it."""
+
+    def __init__(self):
+        self.triggers = {}  # (kind, code, user_id) → [sent at, ...]
+        self.receipts = []  # (kind, code, user_id, received at)
+        self.frames = 0
+        self.bytes = 0
+        self.failures = 0
+        self.errors = set()
+
+    def trigger(self, kind, code, user_id):
+        self.triggers.setdefault((kind, code, user_id), []).append(time.perf_counter())
+
+    def fail(self, exc):
+        self.failures += 1
+        self.errors.add(f'{type(exc).__name__}: {exc}')
+
+    def fan_out_latencies(self):
+        for kind, code, user_id, received in self.receipts:
+            # Matched to the latest trigger before it (a seat can join twice)
+            sent = [t for t in self.triggers.get((kind, code, user_id), []) if t <= received]
+            if sent:
+                yield received - sent[-1]
+
+
+class _Countdown:
+    def __init__(self, count):
+        self.count = count
+        self.done = asyncio.Event()
+        if count <= 0:
+            self.done.set()
+
+    def count_down(self):
+        self.count -= 1
+        if self.count <= 0:
+            self.done.set()
+
+    async def wait(self):
+        await self.done.wait()
+
+
+class _Client:
+    """One player's socket; records when each room broadcast reaches it."""
+
+    def __init__(self, run, code, user_id, cookie):
+        self.run = run
+        self.code = code
+        self.user_id = user_id
+        self.cookie = cookie
+        self.resume_token = None
+        self.started = asyncio.Event()
+        self._snapshot = None
+
+    async def open(self, resume=None):
+        path = f'/ws/room/{self.code}/' + (f'?resume={resume}' if resume else '')
+        self._snapshot = asyncio.get_running_loop().create_future()
+        await self._connect(path)
+        # The server sends the full room state (and our resume token) on accept
+        await asyncio.wait_for(self._snapshot, TIMEOUT)
+
+    def on_frame(self, text):
+        received = time.perf_counter()
+        self.run.frames += 1
+        self.run.bytes += len(text)
+        msg = json.loads(text)
+        if msg['type'] == 'room.state':
+            self.resume_token = msg.get('resume_token', self.resume_token)
+            if not self._snapshot.done():
+                self._snapshot.set_result(None)
+        elif msg['type'] == 'room.delta':
+            for op in msg['ops']:
+                if op['op'] == 'join':
+                    self._receipt('join', op['player']['user_id'], received)
+                elif op['op'] == 'update' and op['fields'].get('connection_state') == 'disconnected':
+                    self._receipt('drop', op['user_id'], received)
+        elif msg['type'] == 'match.starting':
+            self.run.receipts.append(('start', self.code, None, received))
+            self.started.set()
+
+    def _receipt(self, kind, user_id, received):
+        if user_id != self.user_id:  # fan-out to the other players
+            self.run.receipts.append((kind, self.code, user_id, received))
+
+    def on_refused(self, reason):
+        if self._snapshot and not self._snapshot.done():
+            self._snapshot.set_exception(ConnectionError(f'{self.code}: socket closed ({reason})'))
+
+
+class _AppClient(_Client):
+    """Drives the ASGI application in this event loop."""
+
+    def __init__(self, application, *args):
+        super().__init__(*args)
+        self.application = application
+        self.communicator = None
+        self.reader = None
+
+    async def _connect(self, path):
+        self.communicator = WebsocketCommunicator(
+            self.application, path, headers=[(b'cookie', self.cookie.encode())],
+        )
+        connected, _ = await self.communicator.connect(timeout=TIMEOUT)
+        if not connected:
+            self.on_refused('rejected')
+            return
+        self.reader = asyncio.create_task(self._read(self.communicator))
+
+    async def _read(self, communicator):
+        while True:
+            message = await communicator.output_queue.get()
+            if message['type'] == 'websocket.send':
+                self.on_frame(message['text'])
+            elif message['type'] == 'websocket.close':
+                return
+
+    async def send(self, payload):
+        await self.communicator.send_json_to(payload)
+
+    async def close(self):
+        await self.communicator.disconnect(timeout=TIMEOUT)
+        self.reader.cancel()
+
+
+class _SocketClient(_Client):
+    """
+    A real WebSocket to a running server.
+
+    Just enough RFC 6455 for this traffic: masked text frames out, whole text
+    frames in. autobahn's asyncio client can't be used here, since Daphne has
+    already set txaio up for Twisted in this process.
+    """
+
+    def __init__(self, base_url, *args):
+        super().__init__(*args)
+        self.base_url = base_url
+        self.writer = None
+        self.reader = None
+
+    async def _connect(self, path):
+        parts = urlsplit(self.base_url)
+        port = parts.port or 80
+        stream, self.writer = await asyncio.open_connection(parts.hostname, port)
+        self.writer.write((
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {parts.hostname}:{port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            f'Cookie: {self.cookie}\r\n\r\n'
+        ).encode())
+        status = (await stream.readuntil(b'\r\n\r\n')).split(b'\r\n', 1)[0]
+        if b' 101 ' not in status:
+            self.writer.close()
+            self.on_refused(status.decode())
+            return
+        self.reader = asyncio.create_task(self._read(stream))
+
+    async def _read(self, stream):
+        message = b''
+        while True:
+            head = await stream.readexactly(2)
+            opcode, length = head[0] & 0x0F, head[1] & 0x7F
+            if length == 126:
+                length = int.from_bytes(await stream.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await stream.readexactly(8), 'big')
+            payload = await stream.readexactly(length)
+            if opcode == 0x8:  # close
+                return
+            if opcode == 0x9:  # ping
+                self._write(0xA, payload)
+            elif opcode in (0x0, 0x1):
+                message += payload
+                if head[0] & 0x80:  # final fragment
+                    self.on_frame(message.decode())
+                    message = b''
+
+    def _write(self, opcode, payload):
+        # Client frames are always masked
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        elif length < 1 << 16:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 127]) + length.to_bytes(8, 'big')
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.writer.write(header + mask + masked)
+
+    async def send(self, payload):
+        self._write(0x1, json.dumps(payload).encode())
+
+    async def close(self):
+        self._write(0x8, (1000).to_bytes(2, 'big'))
+        try:
+            # The server answers with its own close frame
+            await asyncio.wait_for(self.reader, TIMEOUT)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.writer.close()
+
+
+def _rss(pid):
+    """Resident memory of a process in bytes, or None where /proc isn't available."""
+    if pid is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
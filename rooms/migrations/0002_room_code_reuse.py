@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='room',
+            name='code',
+            field=models.CharField(blank=True, max_length=5),
+        ),
+        migrations.AddConstraint(
+            model_name='room',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['lobby', 'starting', 'in_game'])), fields=('code',), name='unique_active_room_code'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0002_room_code_reuse'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=5)),
+                ('created_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('player_ids', models.JSONField(default=list)),
+            ],
+            options={
+                'verbose_name_plural': 'room history',
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='room',
+            name='rooms_room_status_19affd_idx',
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='ended_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_seen_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(condition=models.Q(('status__in', ['lobby', 'starting', 'in_game'])), fields=['status', 'last_seen_at'], name='room_active_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(condition=models.Q(('status__in', ['lobby', 'starting', 'in_game']), _negated=True), fields=['status', 'ended_at'], name='room_ended_idx'),
+        ),
+        migrations.AddField(
+            model_name='roomhistory',
+            name='host_user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,5 +1,9 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
+
+# A room holds its code while in one of these; afterwards the code can be reused
+ACTIVE_STATUSES = ['lobby', 'starting', 'in_game']
 
 class Room(models.Model):
     STATUS_CHOICES = [
@@ -10,14 +14,34 @@ class Room(models.Model):
         ('closed', 'Closed'),
     ]
 
-    code = models.CharField(max_length=5,unique=True,blank=True)
+    code = models.CharField(max_length=5,blank=True)
     host_user = models.ForeignKey(settings.AUTH_USER_MODEL,on_delete=models.CASCADE,related_name='hosted_rooms')
     status = models.CharField(max_length=20,choices=STATUS_CHOICES,default='lobby')
     created_at = models.DateTimeField(auto_now_add=True)
     min_players = models.IntegerField(default=2)
     max_players = models.IntegerField(default=8)
+    # Last presence flush that found someone connected (see rooms.tasks)
+    last_seen_at = models.DateTimeField(default=timezone.now)
+    ended_at = models.DateTimeField(null=True, blank=True)
     class Meta:
-        indexes = [models.Index(fields=['status']),] #this index is used to speed up queries that filter by status
+        # Partial indexes: only live rooms are looked up by status, and only
+        # ended ones by the reaper, so neither grows with the other
+        indexes = [
+            models.Index(
+                fields=['status', 'last_seen_at'], condition=models.Q(status__in=ACTIVE_STATUSES),
+                name='room_active_status_idx',
+            ),
+            models.Index(
+                fields=['status', 'ended_at'], condition=~models.Q(status__in=ACTIVE_STATUSES),
+                name='room_ended_idx',
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['code'], condition=models.Q(status__in=ACTIVE_STATUSES),
+                name='unique_active_room_code',
+            ),
+        ]
     def __str__(self):
         return f"Room {self.code} ({self.status})"
 
@@ -51,3 +75,19 @@ class RoomPlayer(models.Model):
     def __str__(self):
         host_tag = " (HOST)" if self.is_host else ""
         return f"{self.display_name} in {self.room.code}{host_tag}"
+
+class RoomHistory(models.Model):
+    """One row per finished room, kept after the room and its players are reaped."""
+    code = models.CharField(max_length=5)
+    host_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='+'
+    )
+    created_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    player_ids = models.JSONField(default=list)
+
+    class Meta:
+        verbose_name_plural = 'room history'
+
+    def __str__(self):
+        return f"Room {self.code} ({self.ended_at:%Y-%m-%d})"
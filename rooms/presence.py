@@ -0,0 +1,125 @@
+"""
+Live presence for lobby sockets, kept in Redis instead of RoomPlayer rows.
+
+Each room has a hash of ``user_id → expiry (epoch ms)``. A socket's connect
+and every heartbeat push its expiry ROOM_PRESENCE_TTL seconds ahead; a
+player is connected while their expiry is in the future. The flush_presence
+task copies the result into RoomPlayer.connection_state now and then, so the
+database only sees real state changes.
+
+A player whose socket drops keeps their seat for ROOM_RECONNECT_GRACE
+seconds: they are queued in a sorted set by deadline, and the
+sweep_dropped_players task removes whoever hasn't come back by then.
+Reconnecting sockets present the resume token handed out at connect. A
+token is only honoured for the signed-in user it was issued to, and lives
+about as long as the grace window: heartbeats keep it alive while the
+socket is open, and it lapses with the seat once the socket drops.
+"""
+import secrets
+import time
+from django.conf import settings
+from GuessWho.redis_client import get_async_redis, get_redis
+
+# Rooms that have (or recently had) presence entries, for the flush task
+INDEX_KEY = 'rooms:presence'
+# 'code:user_id' → deadline (epoch seconds) for players inside their grace window
+DROPPED_KEY = 'rooms:dropped'
+
+# Only the socket that registered last may mark the player absent, so a
+# stale socket closing after a reconnect doesn't drop the new one
+_ABSENT_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1] .. ':channel') ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1], ARGV[1] .. ':channel')
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('EXPIRE', KEYS[3], ARGV[6])
+end
+return 1
+"""
+
+def presence_key(room_code):
+    return f'room:{room_code}:presence'
+
+def dropped_member(room_code, user_id):
+    return f'{room_code}:{user_id}'
+
+def _resume_key(token):
+    return f'room:resume:{token}'
+
+def _resume_ttl():
+    # Outlives a heartbeat gap, then the grace window once the socket drops
+    return settings.ROOM_PRESENCE_TTL + settings.ROOM_RECONNECT_GRACE
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def is_live(expiry, now_ms=None):
+    return expiry is not None and int(expiry) > (now_ms or _now_ms())
+
+async def mark_present(room_code, user_id, channel_name=None, resume_token=None):
+    """
+    Record a connect (with ``channel_name``) or a heartbeat, and cancel any
+    pending grace-window removal; a heartbeat also keeps the socket's
+    ``resume_token`` alive. Returns True when the player was not live before.
+    """
+    now = _now_ms()
+    key = presence_key(room_code)
+    pipe = get_async_redis().pipeline(transaction=True)
+    pipe.hget(key, user_id)
+    pipe.hset(key, user_id, now + settings.ROOM_PRESENCE_TTL * 1000)
+    if channel_name:
+        pipe.hset(key, f'{user_id}:channel', channel_name)
+    pipe.sadd(INDEX_KEY, room_code)
+    pipe.zrem(DROPPED_KEY, dropped_member(room_code, user_id))
+    if resume_token:
+        pipe.expire(_resume_key(resume_token), _resume_ttl())
+    previous = (await pipe.execute())[0]
+    return not is_live(previous, now)
+
+async def mark_absent(room_code, user_id, channel_name, resume_token=None):
+    """
+    Start the grace window for a closed socket. Returns False (and does
+    nothing) when a newer socket for the same player has taken over.
+    """
+    grace = settings.ROOM_RECONNECT_GRACE
+    return bool(await get_async_redis().eval(
+        _ABSENT_SCRIPT, 3,
+        presence_key(room_code), DROPPED_KEY, _resume_key(resume_token or ''),
+        user_id, channel_name, time.time() + grace, dropped_member(room_code, user_id),
+        resume_token or '', grace,
+    ))
+
+async def issue_resume_token(room_code, user_id, previous=None):
+    """Hand out a fresh resume token for this seat, retiring ``previous``."""
+    token = secrets.token_urlsafe(24)
+    pipe = get_async_redis().pipeline(transaction=True)
+    pipe.set(_resume_key(token), dropped_member(room_code, user_id), ex=_resume_ttl())
+    if previous:
+        pipe.delete(_resume_key(previous))
+    await pipe.execute()
+    return token
+
+async def resolve_resume_token(room_code, token):
+    """Return the user id a resume token holds a seat for in this room, or None."""
+    seat = await get_async_redis().get(_resume_key(token))
+    if not seat:
+        return None
+    code, user_id = seat.rsplit(':', 1)
+    return int(user_id) if code == room_code else None
+
+def connection_states(raw_presence, user_ids, now_ms=None):
+    """Map each user id to 'connected' or 'disconnected' from an HGETALL result."""
+    now_ms = now_ms or _now_ms()
+    return {
+        user_id: 'connected' if is_live(raw_presence.get(str(user_id)), now_ms) else 'disconnected'
+        for user_id in user_ids
+    }
+
+def read_presence(room_codes):
+    """HGETALL several rooms' presence hashes in one round trip."""
+    pipe = get_redis().pipeline(transaction=False)
+    for code in room_codes:
+        pipe.hgetall(presence_key(code))
+    return dict(zip(room_codes, pipe.execute()))
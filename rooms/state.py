@@ -0,0 +1,358 @@
+"""
+Versioned room state for lobby sockets.
+
+Every change to a room's players goes out as a ``room.delta``: the room's
+next version (a Redis counter shared by every process) and a list of ops.
+Clients apply deltas in version order and send ``room.sync`` for a full
+``room.state`` snapshot when they see a gap.
+
+Snapshots are cached in Redis, tagged with the version they were built at.
+Every change bumps the version, so a cached snapshot is valid exactly while
+its version is current and nothing has to be deleted on writes. Publishing a
+delta rolls the cached snapshot forward when it is one version behind, so
+a busy lobby doesn't rebuild from the database after every change. The
+lobby view and the consumer both read through load_room_snapshot.
+
+Ops:
+    {'op': 'join', 'player': {...}}             add or replace a player
+    {'op': 'leave', 'user_id': ...}             remove a player
+    {'op': 'update', 'user_id': ..., 'fields': {...}}
+    {'op': 'room', 'fields': {'room_status': ...}}
+"""
+import asyncio
+import json
+import weakref
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from GuessWho.redis_client import get_async_redis, get_redis
+from .codes import release_room_code
+from .frames import broadcast
+from .presence import connection_states, presence_key
+
+# Version counters outlive a lobby by a day, then expire with it
+VERSION_TTL = 24 * 60 * 60
+SNAPSHOT_TTL = 60 * 60
+
+# Delta fields that also change between versions (sync progress goes out
+# unversioned), so a snapshot must not keep them: they would go stale there
+_UNVERSIONED_FIELDS = frozenset({'progress'})
+
+# Store a freshly built snapshot only if no change landed while it was built
+_CACHE_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+# Per event loop: room code → ops waiting for the coalescing window to close
+_buffers = weakref.WeakKeyDictionary()
+
+def _version_key(room_code):
+    return f'room:{room_code}:version'
+
+def _snapshot_key(room_code):
+    return f'room:{room_code}:snapshot'
+
+def _group_name(room_code):
+    return f'room_{room_code}'
+
+# ── Ops ──────────────────────────────────────────────────────────
+
+def player_entry(room_player):
+    """Lobby view of one RoomPlayer (select_related user__spotify_account)."""
+    spotify = getattr(room_player.user, 'spotify_account', None)
+    return {
+        'user_id': room_player.user_id,
+        'display_name': room_player.display_name,
+        'is_host': room_player.is_host,
+        'sync_status': spotify.sync_status if spotify else 'not_synced',
+        'connection_state': room_player.connection_state,
+    }
+
+def join_op(player):
+    """``player`` is a player_entry dict."""
+    return {'op': 'join', 'player': player}
+
+def leave_op(user_id):
+    return {'op': 'leave', 'user_id': user_id}
+
+def update_op(user_id, **fields):
+    return {'op': 'update', 'user_id': user_id, 'fields': fields}
+
+def room_op(**fields):
+    return {'op': 'room', 'fields': fields}
+
+def merge_ops(ops, new_ops):
+    """Fold ``new_ops`` into ``ops`` so each player appears at most once."""
+    for op in new_ops:
+        if op['op'] == 'update':
+            earlier = _find_player_op(ops, op['user_id'])
+            if earlier and earlier['op'] == 'join':
+                earlier['player'].update(op['fields'])
+                continue
+            if earlier and earlier['op'] == 'update':
+                earlier['fields'].update(op['fields'])
+                continue
+        elif op['op'] in ('join', 'leave'):
+            # The newest join/leave supersedes anything earlier for that player
+            user_id = op['player']['user_id'] if op['op'] == 'join' else op['user_id']
+            earlier = _find_player_op(ops, user_id)
+            if earlier:
+                ops.remove(earlier)
+        elif op['op'] == 'room':
+            earlier = next((o for o in ops if o['op'] == 'room'), None)
+            if earlier:
+                earlier['fields'].update(op['fields'])
+                continue
+        ops.append(op)
+    return ops
+
+def _find_player_op(ops, user_id):
+    for op in ops:
+        if op['op'] == 'join' and op['player']['user_id'] == user_id:
+            return op
+        if op['op'] in ('leave', 'update') and op['user_id'] == user_id:
+            return op
+    return None
+
+# ── Snapshots ────────────────────────────────────────────────────
+
+def build_room_snapshot(room_code):
+    """Serialize the active room with this code and its players, or None if there is none."""
+    from .models import ACTIVE_STATUSES, Room
+    # Codes are reused, so only an active room owns one
+    room = Room.objects.filter(code=room_code, status__in=ACTIVE_STATUSES).first()
+    if room is None:
+        return None
+    players = room.players.select_related('user__spotify_account').order_by('joined_at') #orders players by when they joined
+    return {
+        'room': {
+            'id': room.pk,
+            'code': room.code,
+            'status': room.status,
+            'host_user_id': room.host_user_id,
+            'min_players': room.min_players,
+            'max_players': room.max_players,
+        },
+        'players': [player_entry(p) for p in players],
+    }
+
+def load_room_snapshot(room_code):
+    """
+    The room's ``room.state`` message, from the cache when it is current.
+
+    Costs one Redis round trip on a hit; returns None for an unknown room.
+    """
+    pipe = get_redis().pipeline(transaction=True)
+    pipe.get(_version_key(room_code))
+    pipe.get(_snapshot_key(room_code))
+    pipe.hgetall(presence_key(room_code))
+    version, cached, presence = pipe.execute()
+    version = int(version or 0)
+    cached = json.loads(cached) if cached else None
+    if cached is None or cached['version'] != version:
+        data = build_room_snapshot(room_code)
+        if data is None:
+            return None
+        cached = {'version': version, **data}
+        get_redis().eval(*_cache_args(room_code, cached))
+    return _room_state(cached, presence)
+
+async def aload_room_snapshot(room_code):
+    """Async load_room_snapshot; only a cache miss touches the database."""
+    pipe = get_async_redis().pipeline(transaction=True)
+    pipe.get(_version_key(room_code))
+    pipe.get(_snapshot_key(room_code))
+    pipe.hgetall(presence_key(room_code))
+    version, cached, presence = await pipe.execute()
+    version = int(version or 0)
+    cached = json.loads(cached) if cached else None
+    if cached is None or cached['version'] != version:
+        data = await database_sync_to_async(build_room_snapshot)(room_code)
+        if data is None:
+            return None
+        cached = {'version': version, **data}
+        await get_async_redis().eval(*_cache_args(room_code, cached))
+    return _room_state(cached, presence)
+
+def _advance_snapshot(cached, version, ops):
+    # Only the snapshot right before this delta can take it; anything older
+    # has missed a change and is left to be rebuilt
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    if cached['version'] != version - 1:
+        return None
+    players = {p['user_id']: p for p in cached['players']}
+    for op in ops:
+        if op['op'] == 'join':
+            players[op['player']['user_id']] = _versioned(op['player'])
+        elif op['op'] == 'leave':
+            players.pop(op['user_id'], None)
+        elif op['op'] == 'update' and op['user_id'] in players:
+            players[op['user_id']].update(_versioned(op['fields']))
+        elif op['op'] == 'room' and 'room_status' in op['fields']:
+            cached['room']['status'] = op['fields']['room_status']
+    cached['version'] = version
+    cached['players'] = list(players.values())
+    return cached
+
+def _versioned(fields):
+    return {name: value for name, value in fields.items() if name not in _UNVERSIONED_FIELDS}
+
+def _cache_args(room_code, cached):
+    # The version was read before the database, so a change racing the
+    # build leaves a snapshot that is at worst newer than its tag
+    return (
+        _CACHE_SCRIPT, 2, _version_key(room_code), _snapshot_key(room_code),
+        cached['version'], json.dumps(cached), SNAPSHOT_TTL,
+    )
+
+def _room_state(cached, presence):
+    # Connection state is live in Redis; the column only lags behind it
+    states = connection_states(presence, [p['user_id'] for p in cached['players']])
+    players = [dict(p, connection_state=states[p['user_id']]) for p in cached['players']]
+    return {
+        'type': 'room.state',
+        'version': cached['version'],
+        'room': cached['room'],
+        'players': players,
+        'all_synced': all(p['sync_status'] == 'synced' for p in players),
+        'player_count': len(players),
+        'room_status': cached['room']['status'],
+    }
+
+# ── Membership ───────────────────────────────────────────────────
+
+def admit_player(user, room_code, display_name, leave_current=False):
+    """
+    Seat ``user`` in the lobby with this code, checking capacity, membership
+    and seats in other rooms under one set of row locks.
+
+    Returns ``(outcome, room_player)``: 'joined' or 'member' with their seat
+    here, 'confirm' with their seat in another room (call again with
+    ``leave_current=True`` to give it up), or 'full' / 'missing' with None.
+    """
+    from .models import ACTIVE_STATUSES, Room, RoomPlayer
+    with transaction.atomic():
+        # Always user, then room. The user lock stops one person taking seats
+        # in two rooms at once; the room lock queues everyone joining it
+        get_user_model().objects.select_for_update().only('pk').get(pk=user.pk)
+        room = Room.objects.select_for_update().filter(code=room_code, status='lobby').first()
+        if room is None:
+            return 'missing', None
+        current = RoomPlayer.objects.filter(
+            user=user, room__status__in=ACTIVE_STATUSES,
+        ).select_related('room').first()
+        if current and current.room_id == room.pk:
+            return 'member', current
+        if room.players.count() >= room.max_players:
+            return 'full', None
+        if current and not leave_current:
+            return 'confirm', current
+        if current:
+            remove_player(current)
+        room_player = RoomPlayer.objects.create(room=room, user=user, display_name=display_name)
+        # Queued after the leave above, so the old lobby hears first
+        ops = [join_op(player_entry(room_player))]
+        transaction.on_commit(lambda: publish_delta(room.code, ops))
+    return 'joined', room_player
+
+def remove_player(room_player):
+    """
+    Remove a player from their room, transferring host if needed, and tell
+    the lobby. Inside a transaction the lobby is told (and a closed room's
+    code retired) only once it commits.
+    """
+    room = room_player.room
+    was_host = room_player.is_host
+    room_player.delete()
+    ops = [leave_op(room_player.user_id)]
+
+    if was_host:
+        next_player = room.players.order_by('joined_at').first()
+        if next_player:
+            next_player.is_host = True
+            next_player.save(update_fields=['is_host'])
+            ops.append(update_op(next_player.user_id, is_host=True))
+        else:
+            room.status = 'closed'
+            room.ended_at = timezone.now()
+            room.save(update_fields=['status', 'ended_at'])
+            ops.append(room_op(room_status='closed'))
+    closed = room.status == 'closed'
+
+    def announce():
+        publish_delta(room.code, ops)
+        if closed:
+            retire_room_code(room.code)
+
+    transaction.on_commit(announce)
+
+def retire_room_code(room_code):
+    """Forget a finished room's cached state and put its code back in the pool."""
+    # The snapshot goes first, so the next room with this code can't inherit it
+    get_redis().delete(_snapshot_key(room_code))
+    release_room_code(room_code)
+
+# ── Publishing ───────────────────────────────────────────────────
+
+async def queue_delta(room_code, ops):
+    """
+    Buffer ops for a room; everything queued within ROOM_DELTA_WINDOW seconds
+    is merged and sent as one versioned delta.
+    """
+    buffers = _buffers.setdefault(asyncio.get_running_loop(), {})
+    if room_code in buffers:
+        merge_ops(buffers[room_code], ops)
+        return
+    buffers[room_code] = merge_ops([], ops)
+    asyncio.get_running_loop().create_task(_flush_after(room_code, buffers))
+
+async def _flush_after(room_code, buffers):
+    await asyncio.sleep(settings.ROOM_DELTA_WINDOW)
+    ops = buffers.pop(room_code)
+    r = get_async_redis()
+    pipe = r.pipeline()
+    pipe.incr(_version_key(room_code))
+    pipe.expire(_version_key(room_code), VERSION_TTL)
+    pipe.get(_snapshot_key(room_code))
+    version, _, cached = await pipe.execute()
+    cached = _advance_snapshot(cached, version, ops)
+    if cached:
+        await r.eval(*_cache_args(room_code, cached))
+    await get_channel_layer().group_send(_group_name(room_code), delta_event(version, ops))
+
+def publish_delta(room_code, ops):
+    """Send a delta right away, for sync callers (views, Celery tasks)."""
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.incr(_version_key(room_code))
+    pipe.expire(_version_key(room_code), VERSION_TTL)
+    pipe.get(_snapshot_key(room_code))
+    version, _, cached = pipe.execute()
+    cached = _advance_snapshot(cached, version, ops)
+    if cached:
+        r.eval(*_cache_args(room_code, cached))
+    async_to_sync(get_channel_layer().group_send)(_group_name(room_code), delta_event(version, ops))
+
+def delta_event(version, ops):
+    """
+    The channel-layer message for a room delta, its frame already encoded:
+    consumers forward ``text`` and only look at ``hosts`` (host transfers)
+    themselves.
+    """
+    event = broadcast('room.delta', {'type': 'room.delta', 'version': version, 'ops': ops})
+    hosts = [
+        [op['user_id'], op['fields']['is_host']]
+        for op in ops if op['op'] == 'update' and 'is_host' in op['fields']
+    ]
+    if hosts:
+        event['hosts'] = hosts
+    return event
@@ -0,0 +1,169 @@
+import time
+from datetime import timedelta
+from celery import shared_task
+from GuessWho.redis_client import get_redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .presence import DROPPED_KEY, INDEX_KEY, dropped_member, is_live, presence_key, read_presence
+from .state import publish_delta, remove_player, retire_room_code, update_op
+
+# Drop a room from the presence index once its hash is empty, unless a
+# connect re-added an entry in the meantime
+_PRUNE_SCRIPT = """
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+@shared_task
+def flush_presence():
+    """
+    Copy Redis presence into RoomPlayer.connection_state.
+
+    Runs on a beat schedule. Only rows whose state actually changed are
+    written, in at most two UPDATEs per run, plus one stamping
+    Room.last_seen_at for rooms with someone connected. Players whose
+    heartbeats stopped without a close frame are announced to their lobby
+    here, and get the same grace window as a clean disconnect.
+    """
+    from .models import ACTIVE_STATUSES, Room, RoomPlayer
+    r = get_redis()
+    codes = sorted(r.smembers(INDEX_KEY))
+    if not codes:
+        return {'rooms': 0, 'connected': 0, 'disconnected': 0}
+    presence = read_presence(codes)
+    now = int(time.time() * 1000)
+
+    players = RoomPlayer.objects.filter(
+        room__code__in=codes, room__status__in=ACTIVE_STATUSES,
+    ).values_list('pk', 'room__code', 'user_id', 'connection_state')
+    to_connect, to_disconnect, ops, dropped = [], [], {}, {}
+    active_codes, seen_codes = set(), set()
+    for pk, code, user_id, stored in players:
+        active_codes.add(code)
+        expiry = presence[code].get(str(user_id))
+        live = 'connected' if is_live(expiry, now) else 'disconnected'
+        if live == 'connected':
+            seen_codes.add(code)
+        if live == stored:
+            continue
+        if live == 'connected':
+            to_connect.append(pk)
+        else:
+            to_disconnect.append(pk)
+            if expiry is not None:
+                # Heartbeats stopped without a close frame, so nobody has said so yet
+                ops.setdefault(code, []).append(update_op(user_id, connection_state='disconnected'))
+                dropped[dropped_member(code, user_id)] = int(expiry) / 1000 + settings.ROOM_RECONNECT_GRACE
+    if to_connect:
+        RoomPlayer.objects.filter(pk__in=to_connect).update(connection_state='connected')
+    if to_disconnect:
+        RoomPlayer.objects.filter(pk__in=to_disconnect).update(connection_state='disconnected')
+    if seen_codes:
+        Room.objects.filter(code__in=seen_codes, status__in=ACTIVE_STATUSES).update(
+            last_seen_at=timezone.now(),
+        )
+    if dropped:
+        r.zadd(DROPPED_KEY, dropped, nx=True)
+    for code, room_ops in ops.items():
+        publish_delta(code, room_ops)
+
+    # Forget rooms that are over, and rooms nobody is connected to
+    pipe = r.pipeline(transaction=False)
+    for code in codes:
+        if code in active_codes:
+            pipe.eval(_PRUNE_SCRIPT, 2, presence_key(code), INDEX_KEY, code)
+        else:
+            pipe.delete(presence_key(code))
+            pipe.srem(INDEX_KEY, code)
+    pipe.execute()
+    return {'rooms': len(codes), 'connected': len(to_connect), 'disconnected': len(to_disconnect)}
+
+@shared_task
+def sweep_dropped_players():
+    """
+    Remove players whose reconnect grace window ran out, transferring host
+    and closing empty rooms like a normal leave. Runs on a beat schedule.
+    """
+    from .models import ACTIVE_STATUSES, RoomPlayer
+    r = get_redis()
+    swept = 0
+    for member in r.zrangebyscore(DROPPED_KEY, '-inf', time.time()):
+        # ZREM is the claim, so overlapping sweeps never remove a player twice
+        if not r.zrem(DROPPED_KEY, member):
+            continue
+        code, user_id = member.rsplit(':', 1)
+        if is_live(r.hget(presence_key(code), user_id)):
+            continue  # came back just in time
+        room_player = RoomPlayer.objects.select_related('room').filter(
+            room__code=code, user_id=user_id, room__status__in=ACTIVE_STATUSES,
+        ).first()
+        if room_player:
+            remove_player(room_player)
+            swept += 1
+    return swept
+
+@shared_task
+def refill_room_codes():
+    """Top the free room-code pool back up; queued when allocation finds it running low."""
+    from .codes import REFILL_QUEUED_KEY, refill_code_pool
+    try:
+        return refill_code_pool()
+    finally:
+        get_redis().delete(REFILL_QUEUED_KEY)
+
+@shared_task
+def reap_rooms():
+    """
+    Clear out rooms nobody will come back to. Runs on a beat schedule.
+
+    Lobbies nobody has been connected to for ROOM_ABANDONED_AFTER seconds
+    are deleted and their codes recycled. Closed rooms are deleted. Finished
+    rooms are archived to RoomHistory once ROOM_ARCHIVE_AFTER has passed.
+    Each batch of at most ROOM_REAP_BATCH rooms is its own transaction.
+    """
+    from .models import Room
+    now = timezone.now()
+    abandoned = Room.objects.filter(
+        status='lobby', last_seen_at__lt=now - timedelta(seconds=settings.ROOM_ABANDONED_AFTER),
+    )
+    finished = Room.objects.filter(
+        status='finished', ended_at__lt=now - timedelta(seconds=settings.ROOM_ARCHIVE_AFTER),
+    )
+    return {
+        'abandoned': _reap_in_batches(abandoned, recycle_codes=True),
+        'closed': _reap_in_batches(Room.objects.filter(status='closed')),
+        'archived': _reap_in_batches(finished, archive=True),
+    }
+
+def _reap_in_batches(rooms, recycle_codes=False, archive=False):
+    from .models import RoomHistory, RoomPlayer
+    reaped = 0
+    while True:
+        with transaction.atomic():
+            # Locked rooms (a join in progress) are left for the next run
+            batch = list(rooms.select_for_update(skip_locked=True).order_by('pk')[:settings.ROOM_REAP_BATCH])
+            if not batch:
+                return reaped
+            pks = [room.pk for room in batch]
+            if archive:
+                player_ids = {}
+                for room_id, user_id in RoomPlayer.objects.filter(room_id__in=pks).values_list('room_id', 'user_id'):
+                    player_ids.setdefault(room_id, []).append(user_id)
+                RoomHistory.objects.bulk_create([
+                    RoomHistory(
+                        code=room.code, host_user_id=room.host_user_id, created_at=room.created_at,
+                        ended_at=room.ended_at, player_ids=player_ids.get(room.pk, []),
+                    )
+                    for room in batch
+                ])
+            RoomPlayer.objects.filter(room_id__in=pks).delete()
+            rooms.model.objects.filter(pk__in=pks).delete()
+            if recycle_codes:
+                codes = [room.code for room in batch]
+                transaction.on_commit(lambda codes=codes: [retire_room_code(code) for code in codes])
+        reaped += len(batch)
+        if len(batch) < settings.ROOM_REAP_BATCH:
+            return reaped
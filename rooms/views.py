@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.db import IntegrityError, transaction
+from django.shortcuts import render, redirect
+from django.http import Http404, JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from .models import Room, RoomPlayer
-from .utils import generate_room_code
+from .codes import allocate_room_code, release_room_code
+from .models import ACTIVE_STATUSES, Room, RoomPlayer
+from .state import admit_player, join_op, load_room_snapshot, player_entry, publish_delta, remove_player
+from spotify_sync.scheduling import schedule_sync
 
 
 # ── Helpers ──────────────────────────────────────────────────
@@ -12,24 +16,17 @@ def get_active_room_membership(user):
     """Return the user's RoomPlayer in any active (non-closed/finished) room, or None."""
     return RoomPlayer.objects.filter(
         user=user,
-        room__status__in=['lobby', 'starting', 'in_game'],
+        room__status__in=ACTIVE_STATUSES,
     ).select_related('room').first()
 
 
-def _leave_room_cleanup(room_player):
-    """Remove a player from their room, transferring host if needed."""
-    room = room_player.room
-    was_host = room_player.is_host
-    room_player.delete()
-
-    if was_host:
-        next_player = room.players.order_by('joined_at').first()
-        if next_player:
-            next_player.is_host = True
-            next_player.save(update_fields=['is_host'])
-        else:
-            room.status = 'closed'
-            room.save(update_fields=['status'])
+def get_room_membership(user, room_code):
+    """Return the user's RoomPlayer in the active room with this code, or None."""
+    return RoomPlayer.objects.filter(
+        user=user,
+        room__code=room_code,
+        room__status__in=ACTIVE_STATUSES,
+    ).select_related('room').first()
 
 
 # ── Views ────────────────────────────────────────────────────
@@ -50,28 +47,43 @@ def create_room(request):
                 'action': 'create',
             })
         # User confirmed — leave old room first
-        _leave_room_cleanup(existing)
-
-    for _ in range(10):
-        code = generate_room_code()
-        if not Room.objects.filter(code=code, status='lobby').exists():
+        remove_player(existing)
+
+    # Pool codes are free, so this only retries if a code was taken behind the
+    # pool's back. A leased code is released whenever its room isn't created
+    room = None
+    for _ in range(3):
+        code = allocate_room_code()
+        if code is None:
+            break  # no free codes at all, so retrying won't find one
+        try:
+            with transaction.atomic():
+                room = Room.objects.create(code=code, host_user=request.user)
             break
-    else:
+        except IntegrityError:
+            release_room_code(code)
+        except BaseException:
+            release_room_code(code)
+            raise
+    if room is None:
         return render(request, 'landing.html', {
             'error': 'Could not generate a unique room code. Try again.'
         })
 
-    room = Room.objects.create(code=code, host_user=request.user)
     display_name = getattr(
         getattr(request.user, 'spotify_account', None),
         'display_name', request.user.username
     )
-    RoomPlayer.objects.create(
+    room_player = RoomPlayer.objects.create(
         room=room,
         user=request.user,
         display_name=display_name,
         is_host=True,
     )
+    # Bumps the room version, so a cached snapshot left under a reused code is stale
+    publish_delta(room.code, [join_op(player_entry(room_player))])
+    # Stale data gets refreshed now, on the lobby queue
+    schedule_sync(request.user.id)
 
     return redirect('rooms:lobby', room_code=room.code)
 
@@ -87,73 +99,67 @@ def join_room(request):
             'error': 'Please enter a room code.'
         })
 
-    room = Room.objects.filter(code=code, status='lobby').first()
+    display_name = getattr(
+        getattr(request.user, 'spotify_account', None),
+        'display_name', request.user.username
+    )
+    # Capacity, membership and other-room checks all happen under the
+    # room's lock, so a burst of joins can't overfill it
+    outcome, room_player = admit_player(
+        request.user, code, display_name,
+        leave_current=request.POST.get('confirm') == '1',
+    )
 
-    if not room:
+    if outcome == 'missing':
         return render(request, 'landing.html', {
             'error': f'Room "{code}" not found or already started.'
         })
 
-    current_count = room.players.count()
-    if current_count >= room.max_players:
+    if outcome == 'full':
         return render(request, 'landing.html', {
             'error': 'That room is full.'
         })
 
-    if room.players.filter(user=request.user).exists():
-        return redirect('rooms:lobby', room_code=room.code)
-
-    # Check if user is already in a different room
-    existing = get_active_room_membership(request.user)
-    if existing:
-        if request.POST.get('confirm') != '1':
-            return JsonResponse({
-                'confirm_needed': True,
-                'current_room': existing.room.code,
-                'target_room': code,
-                'action': 'join',
-            })
-        _leave_room_cleanup(existing)
+    if outcome == 'member':
+        return redirect('rooms:lobby', room_code=code)
 
-    display_name = getattr(
-        getattr(request.user, 'spotify_account', None),
-        'display_name', request.user.username
-    )
+    if outcome == 'confirm':
+        return JsonResponse({
+            'confirm_needed': True,
+            'current_room': room_player.room.code,
+            'target_room': code,
+            'action': 'join',
+        })
 
-    RoomPlayer.objects.create(
-        room=room,
-        user=request.user,
-        display_name=display_name,
-    )
+    schedule_sync(request.user.id)
 
-    return redirect('rooms:lobby', room_code=room.code)
+    return redirect('rooms:lobby', room_code=code)
 
 
 @login_required(login_url='/')
 def lobby(request, room_code):
-    room = get_object_or_404(Room, code=room_code)
+    # Served from the Redis snapshot the consumer also uses
+    snapshot = load_room_snapshot(room_code)
+    if snapshot is None:
+        raise Http404('No such room.')
 
-    room_player = room.players.filter(user=request.user).first()
-    if not room_player:
+    me = next((p for p in snapshot['players'] if p['user_id'] == request.user.id), None)
+    if me is None:
         return redirect('landing')
 
-    players = room.players.select_related('user__spotify_account').all()
-    is_host = room_player.is_host
-
     return render(request, 'lobby.html', {
-        'room': room,
-        'players': players,
-        'is_host': is_host,
+        'room': snapshot['room'],
+        'players': snapshot['players'],
+        'is_host': me['is_host'],
+        'heartbeat_ms': settings.ROOM_PRESENCE_TTL * 1000 // 3,
     })
 
 
 @login_required(login_url='/')
 def leave_room(request, room_code):
-    room = get_object_or_404(Room, code=room_code)
-    room_player = room.players.filter(user=request.user).first()
-
+    room_player = get_room_membership(request.user, room_code)
     if room_player:
-        _leave_room_cleanup(room_player)
+        remove_player(room_player)
 
     return redirect('landing')
 
@@ -164,12 +170,8 @@ def beacon_leave_room(request, room_code):
     if request.method != 'POST' or not request.user.is_authenticated:
         return HttpResponse(status=204)
 
-    room = Room.objects.filter(code=room_code).first()
-    if not room:
-        return HttpResponse(status=204)
-
-    room_player = room.players.filter(user=request.user).first()
+    room_player = get_room_membership(request.user, room_code)
     if room_player:
-        _leave_room_cleanup(room_player)
+        remove_player(room_player)
 
     return HttpResponse(status=204)
\ No newline at end of file
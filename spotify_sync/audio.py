@@ -0,0 +1,174 @@
+"""
+Round audio: the YouTube video each SpotifyTrack plays as.
+
+A lookup (search, then pick the closest match) takes seconds, so it never
+runs while a match starts. Tracks are resolved in the background right
+after a player's sync (tasks.prewarm_track_audio) and the result is kept on
+the track: ``youtube_video_id``, with ``youtube_resolved_at`` also set for
+tracks that have no video. A round whose track has no video yet plays
+metadata-only.
+
+The backend is the AUDIO_RESOLVER setting, a dotted path to an
+AudioResolver subclass; spotify_sync.fake_youtube has an offline stand-in.
+With no backend set, or one whose package isn't installed, nothing is
+looked up and every round plays metadata-only.
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+try:
+    import yt_dlp
+except ImportError:  # only the YtDlpResolver backend needs it
+    yt_dlp = None
+
+logger = logging.getLogger(__name__)
+
+_resolver = None
+
+class AudioResolver:
+    """Finds the video a track plays as. Backends implement ``resolve``."""
+
+    def resolve(self, name, artist, duration_ms, timeout):
+        """
+        The video id for a track, or None when it has none. Should give up
+        after ``timeout`` seconds; raise on errors, and the track is retried
+        on a later pass.
+        """
+        raise NotImplementedError
+
+class YtDlpResolver(AudioResolver):
+    """YouTube search through yt-dlp, picking the result closest in length."""
+
+    # Search results weighed per track
+    candidates = 5
+    # A result further than this from the track's length is a cover, live cut or mix
+    max_length_gap = 15
+
+    def __init__(self):
+        if yt_dlp is None:
+            raise ImproperlyConfigured('YtDlpResolver needs the yt-dlp package.')
+
+    def resolve(self, name, artist, duration_ms, timeout):
+        options = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'extract_flat': 'in_playlist',
+            'socket_timeout': timeout,
+        }
+        with yt_dlp.YoutubeDL(options) as ydl:
+            found = ydl.extract_info(f'ytsearch{self.candidates}:{artist} - {name}', download=False)
+        entries = [entry for entry in (found or {}).get('entries') or [] if entry.get('id')]
+        if not entries or not duration_ms:
+            return entries[0]['id'] if entries else None
+        length = duration_ms / 1000
+        best = min(entries, key=lambda entry: abs((entry.get('duration') or 0) - length))
+        if abs((best.get('duration') or 0) - length) > self.max_length_gap:
+            return None
+        return best['id']
+
+def get_resolver():
+    """This process's AUDIO_RESOLVER backend, or None when audio lookups are off."""
+    global _resolver
+    if _resolver is None or _resolver[0] != settings.AUDIO_RESOLVER:
+        backend = None
+        if settings.AUDIO_RESOLVER:
+            try:
+                backend = import_string(settings.AUDIO_RESOLVER)()
+            except ImproperlyConfigured as exc:
+                # Said once per process, not on every sync
+                logger.warning('Audio lookups are off: %s', exc)
+        _resolver = (settings.AUDIO_RESOLVER, backend)
+    return _resolver[1]
+
+def unresolved_tracks(track_ids):
+    """The tracks among ``track_ids`` that need a lookup: never looked up, or a miss gone stale."""
+    from .models import SpotifyTrack
+    retry_misses = timezone.now() - timedelta(days=settings.AUDIO_MISS_RETRY_DAYS)
+    return SpotifyTrack.objects.filter(
+        Q(youtube_resolved_at__isnull=True) | Q(youtube_video_id__isnull=True, youtube_resolved_at__lt=retry_misses),
+        pk__in=track_ids,
+    ).only('name', 'artist_name', 'duration_ms')
+
+def resolve_tracks(track_ids, resolver=None, workers=None, timeout=None):
+    """
+    Look up the video for every track in ``track_ids`` that needs one, up
+    to ``workers`` at a time, and save what was found in one batch.
+
+    A lookup that fails or runs past ``timeout`` seconds leaves its track
+    unresolved (metadata-only) for the next pass. Returns counts:
+    ``{'found', 'missing', 'failed', 'timed_out'}``, all zero when audio
+    lookups are off.
+    """
+    from .models import SpotifyTrack
+    counts = {'found': 0, 'missing': 0, 'failed': 0, 'timed_out': 0}
+    resolver = resolver or get_resolver()
+    if resolver is None:
+        return counts
+    tracks = list(unresolved_tracks(track_ids))
+    if not tracks:
+        return counts
+    found, failed, timed_out = _fan_out(
+        resolver, tracks,
+        workers or settings.AUDIO_RESOLVER_WORKERS, timeout or settings.AUDIO_RESOLVER_TIMEOUT,
+    )
+    now = timezone.now()
+    hits, misses = [], []
+    for track in tracks:
+        if track.pk not in found:
+            continue
+        track.youtube_video_id, track.youtube_resolved_at = found[track.pk], now
+        (hits if track.youtube_video_id else misses).append(track)
+    SpotifyTrack.objects.bulk_update(hits, ['youtube_video_id', 'youtube_resolved_at'])
+    SpotifyTrack.objects.filter(pk__in=[track.pk for track in misses]).update(
+        youtube_video_id=None, youtube_resolved_at=now,
+    )
+    counts.update(found=len(hits), missing=len(misses), failed=failed, timed_out=timed_out)
+    if failed or timed_out:
+        logger.warning('Audio lookups: %s failed, %s timed out of %s', failed, timed_out, len(tracks))
+    return counts
+
+def _fan_out(resolver, tracks, workers, timeout):
+    """
+    Run the lookups on a bounded thread pool (they wait on the network, not
+    the CPU). Returns ``(found, failed, timed_out)``: video ids or None by
+    track id, and how many lookups failed or were given up on.
+    """
+    started = {}
+
+    def lookup(track):
+        started[track.pk] = time.monotonic()
+        return resolver.resolve(track.name, track.artist_name, track.duration_ms, timeout)
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='audio')
+    futures = {pool.submit(lookup, track): track.pk for track in tracks}
+    pending, stuck = set(futures), set()
+    found, failed = {}, 0
+    try:
+        while pending:
+            running = [started[futures[f]] for f in pending if futures[f] in started]
+            wake = min(running) + timeout - time.monotonic() if running else timeout
+            done, pending = wait(pending, timeout=max(0.0, wake), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    found[futures[future]] = future.result()
+                except Exception:
+                    logger.debug('Audio lookup failed for track %s', futures[future], exc_info=True)
+                    failed += 1
+            # Give up on lookups past their timeout; their threads finish on their own
+            now = time.monotonic()
+            overdue = {f for f in pending if futures[f] in started and now - started[futures[f]] > timeout}
+            pending -= overdue
+            stuck = {f for f in stuck | overdue if not f.done()}
+            if len(stuck) >= workers:
+                break  # every worker is hung; the rest wait for the next pass
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return found, failed, len(tracks) - len(found) - failed
@@ -0,0 +1,268 @@
+import asyncio
+import math
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from GuessWho.redis_client import get_async_redis, get_redis
+
+# Redis keys shared by every web and worker process
+BUCKET_KEY = 'spotify:ratelimit:bucket'
+BACKOFF_KEY = 'spotify:ratelimit:backoff'
+METRICS_KEY = 'spotify:ratelimit:metrics'
+
+# Token bucket refilled from Redis' own clock, so workers on different hosts agree.
+# Returns 0 when a token was taken, otherwise the milliseconds to wait.
+_ACQUIRE_SCRIPT = """
+local backoff = redis.call('PTTL', KEYS[2])
+if backoff > 0 then return backoff end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+# Only ever extend the global backoff window, never shorten it
+_BACKOFF_SCRIPT = """
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], '1', 'PX', ARGV[1])
+end
+return 1
+"""
+
+_session = None
+_async_clients = weakref.WeakKeyDictionary()
+
+class SpotifyRateLimited(Exception):
+    """Spotify asked us to back off for longer than the caller is willing to wait."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Spotify rate limited, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+def get_session():
+    """Return this process's shared keep-alive session for Spotify calls."""
+    global _session
+    if _session is None:
+        # Created lazily so each forked Celery worker gets its own pool
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
+
+def get_async_client():
+    """Return the shared keep-alive httpx client for Spotify calls from async views."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        # Like the Redis client, a connection pool belongs to one event loop
+        client = httpx.AsyncClient(
+            timeout=settings.SPOTIFY_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+        )
+        _async_clients[loop] = client
+    return client
+
+def acquire_rate_limit(max_wait):
+    """Block until the shared bucket grants a request, or raise SpotifyRateLimited."""
+    r = get_redis()
+    waited = 0.0
+    while True:
+        wait_ms = r.eval(
+            _ACQUIRE_SCRIPT, 2, BUCKET_KEY, BACKOFF_KEY,
+            settings.SPOTIFY_RATE_LIMIT_PER_SECOND, settings.SPOTIFY_RATE_LIMIT_BURST,
+        )
+        if not wait_ms:
+            break
+        wait = wait_ms / 1000
+        if waited + wait > max_wait:
+            raise SpotifyRateLimited(max(1, round(wait)))
+        time.sleep(wait)
+        waited += wait
+    pipe = r.pipeline()
+    pipe.hincrby(METRICS_KEY, 'requests', 1)
+    if waited:
+        pipe.hincrby(METRICS_KEY, 'delayed', 1)
+        pipe.hincrbyfloat(METRICS_KEY, 'wait_seconds', waited)
+    pipe.execute()
+
+async def aacquire_rate_limit(max_wait):
+    """Async acquire_rate_limit: waits on the event loop instead of a thread."""
+    r = get_async_redis()
+    waited = 0.0
+    while True:
+        wait_ms = await r.eval(
+            _ACQUIRE_SCRIPT, 2, BUCKET_KEY, BACKOFF_KEY,
+            settings.SPOTIFY_RATE_LIMIT_PER_SECOND, settings.SPOTIFY_RATE_LIMIT_BURST,
+        )
+        if not wait_ms:
+            break
+        wait = wait_ms / 1000
+        if waited + wait > max_wait:
+            raise SpotifyRateLimited(max(1, round(wait)))
+        await asyncio.sleep(wait)
+        waited += wait
+    pipe = r.pipeline()
+    pipe.hincrby(METRICS_KEY, 'requests', 1)
+    if waited:
+        pipe.hincrby(METRICS_KEY, 'delayed', 1)
+        pipe.hincrbyfloat(METRICS_KEY, 'wait_seconds', waited)
+    await pipe.execute()
+
+def parse_retry_after(value):
+    """
+    Seconds to back off from a Retry-After header: delay-seconds or an
+    HTTP date (RFC 9110). At least 1, so the backoff key always gets a TTL.
+    """
+    if not value:
+        return 1
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 1
+    if not math.isfinite(seconds):
+        return 1
+    return max(1, math.ceil(seconds))
+
+def _record_throttle(retry_after):
+    """Start (or extend) the global backoff after a 429 from Spotify."""
+    r = get_redis()
+    r.eval(_BACKOFF_SCRIPT, 1, BACKOFF_KEY, int(retry_after * 1000))
+    r.hincrby(METRICS_KEY, 'throttled', 1)
+
+async def _arecord_throttle(retry_after):
+    r = get_async_redis()
+    await r.eval(_BACKOFF_SCRIPT, 1, BACKOFF_KEY, int(retry_after * 1000))
+    await r.hincrby(METRICS_KEY, 'throttled', 1)
+
+def record_reschedule():
+    """Count a task that was rescheduled instead of waiting out a backoff."""
+    get_redis().hincrby(METRICS_KEY, 'rescheduled', 1)
+
+def get_rate_limit_metrics():
+    """Counters for requests, 429s, inline waits and rescheduled tasks."""
+    raw = get_redis().hgetall(METRICS_KEY)
+    return {
+        'requests': int(raw.get('requests', 0)),
+        'throttled': int(raw.get('throttled', 0)),
+        'delayed': int(raw.get('delayed', 0)),
+        'wait_seconds': float(raw.get('wait_seconds', 0)),
+        'rescheduled': int(raw.get('rescheduled', 0)),
+    }
+
+def spotify_request(method, url, max_wait=None, **kwargs):
+    """
+    Send a rate-limited request to Spotify and return the response.
+
+    429s set the shared backoff; they are retried inline while the total
+    wait stays under ``max_wait`` seconds, and raise SpotifyRateLimited after.
+    """
+    if max_wait is None:
+        max_wait = settings.SPOTIFY_RATE_LIMIT_MAX_WAIT
+    deadline = time.monotonic() + max_wait
+    while True:
+        acquire_rate_limit(max(0.0, deadline - time.monotonic()))
+        resp = get_session().request(
+            method, url, timeout=settings.SPOTIFY_REQUEST_TIMEOUT, **kwargs
+        )
+        if resp.status_code != 429:
+            return resp
+        retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        _record_throttle(retry_after)
+        if time.monotonic() + retry_after > deadline:
+            raise SpotifyRateLimited(retry_after)
+
+def spotify_get(path, access_token, params=None, max_wait=None):
+    """GET a Web API path (e.g. '/me/top/tracks') and return the decoded JSON."""
+    data, _ = spotify_get_if_changed(path, access_token, params, max_wait=max_wait)
+    return data
+
+def spotify_get_if_changed(path, access_token, params=None, etag=None, max_wait=None):
+    """
+    Conditional GET using a previously stored ETag.
+
+    Returns ``(data, etag)``; ``data`` is None when Spotify answers 304.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = spotify_request(
+        'GET', f'{settings.SPOTIFY_API_BASE}{path}',
+        max_wait=max_wait, headers=headers, params=params,
+    )
+    if resp.status_code == 304:
+        return None, etag
+    resp.raise_for_status()
+    return resp.json(), resp.headers.get('ETag')
+
+def spotify_token_request(data, max_wait=None):
+    """POST to the accounts token endpoint (code exchange or refresh) and return the JSON."""
+    resp = spotify_request(
+        'POST', f'{settings.SPOTIFY_ACCOUNTS_BASE}/api/token',
+        max_wait=max_wait,
+        data=data,
+        auth=(settings.SPOTIFY_CLIENT_ID, settings.SPOTIFY_CLIENT_SECRET),
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+# ── Async variants (login views) ─────────────────────────────────
+
+async def aspotify_request(method, url, max_wait=None, **kwargs):
+    """Async spotify_request over the shared httpx client; same 429 handling."""
+    if max_wait is None:
+        max_wait = settings.SPOTIFY_RATE_LIMIT_MAX_WAIT
+    deadline = time.monotonic() + max_wait
+    while True:
+        await aacquire_rate_limit(max(0.0, deadline - time.monotonic()))
+        resp = await get_async_client().request(method, url, **kwargs)
+        if resp.status_code != 429:
+            return resp
+        retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        await _arecord_throttle(retry_after)
+        if time.monotonic() + retry_after > deadline:
+            raise SpotifyRateLimited(retry_after)
+
+async def aspotify_get(path, access_token, params=None, max_wait=None):
+    """Async spotify_get."""
+    resp = await aspotify_request(
+        'GET', f'{settings.SPOTIFY_API_BASE}{path}',
+        max_wait=max_wait,
+        headers={'Authorization': f'Bearer {access_token}'},
+        params=params,
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+async def aspotify_token_request(data, max_wait=None):
+    """Async spotify_token_request."""
+    resp = await aspotify_request(
+        'POST', f'{settings.SPOTIFY_ACCOUNTS_BASE}/api/token',
+        max_wait=max_wait,
+        data=data,
+        auth=(settings.SPOTIFY_CLIENT_ID, settings.SPOTIFY_CLIENT_SECRET),
+    )
+    resp.raise_for_status()
+    return resp.json()
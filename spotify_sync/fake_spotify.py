@@ -0,0 +1,217 @@
+"""
+Offline stand-in for the Spotify Web API and accounts token endpoint.
+
+Serves realistic ``/v1/me``, ``/v1/me/top/tracks``,
+``/v1/me/player/recently-played`` and ``/api/token`` responses from a local
+HTTP server, with configurable latency and 429 injection. Point the client
+at it with ``SPOTIFY_API_BASE = server.api_base`` and
+``SPOTIFY_ACCOUNTS_BASE = server.accounts_base``.
+
+Tokens encode the Spotify user id: the authorization code ``<id>`` and
+refresh token ``refresh-<id>`` both yield the access token ``access-<id>``.
+"""
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class FakeSpotifyServer:
+    """
+    Threaded fake Spotify server.
+
+    ``latency`` (seconds) is added to every response, with up to
+    ``jitter`` extra. Every ``throttle_every``-th request is answered with
+    429 and ``Retry-After: retry_after``, and requests for a path in
+    ``fail_paths`` (``'/v1/me/player/recently-played'``, say) get a 500.
+    Users draw their tracks from a shared, popularity-skewed catalogue so
+    their top lists overlap the way real friend groups do.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, throttle_every=0, retry_after=1,
+                 catalogue_size=3000, seed=0, fail_paths=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fail_paths = set(fail_paths)
+        self.seed = seed
+        self.catalogue = [_fake_track(i) for i in range(catalogue_size)]
+        # Zipf-like weights: low indexes are the hits everyone listens to
+        self.cum_weights = list(itertools.accumulate(
+            1 / (i + 1) ** 0.8 for i in range(catalogue_size)
+        ))
+        self.started_at = datetime.now(timezone.utc)
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._httpd.server_port}'
+
+    @property
+    def api_base(self):
+        return f'{self.base_url}/v1'
+
+    @property
+    def accounts_base(self):
+        return self.base_url
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ── Canned data ──────────────────────────────────────────────
+
+    def top_tracks(self, user_id, time_range, limit):
+        rng = random.Random(f'{self.seed}:{user_id}:{time_range}')
+        picks = {}
+        while len(picks) < min(limit, 50):
+            for idx in self._draw(rng, 50):
+                picks.setdefault(idx, self.catalogue[idx])
+        return list(picks.values())[:min(limit, 50)]
+
+    def recent_plays(self, user_id, limit, after=None):
+        rng = random.Random(f'{self.seed}:{user_id}:recent')
+        plays = []
+        for n, idx in enumerate(self._draw(rng, 50)):
+            played_at = self.started_at - timedelta(minutes=4 * n + 1)
+            plays.append({
+                'track': self.catalogue[idx],
+                'played_at': played_at.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            })
+        if after:
+            cutoff = datetime.fromtimestamp(int(after) / 1000, tz=timezone.utc)
+            plays = [p for p in plays if _parse_played_at(p['played_at']) > cutoff]
+        return plays[:limit]
+
+    def _draw(self, rng, k):
+        return rng.choices(range(len(self.catalogue)), cum_weights=self.cum_weights, k=k)
+
+    # ── HTTP plumbing ────────────────────────────────────────────
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._dispatch(self, 'GET')
+
+            def do_POST(self):
+                server._dispatch(self, 'POST')
+
+        return Handler
+
+    def _dispatch(self, handler, method):
+        with self._lock:
+            self.requests += 1
+            throttle = self.throttle_every and self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if method == 'POST':
+            length = int(handler.headers.get('Content-Length') or 0)
+            body = handler.rfile.read(length).decode()
+        if throttle:
+            return self._reply(handler, 429, {'error': {'status': 429}},
+                               headers={'Retry-After': str(self.retry_after)})
+
+        url = urlparse(handler.path)
+        if url.path in self.fail_paths:
+            return self._reply(handler, 500, {'error': {'status': 500}})
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if method == 'POST' and url.path == '/api/token':
+            return self._token(handler, {k: v[0] for k, v in parse_qs(body).items()})
+
+        auth = handler.headers.get('Authorization', '')
+        if not auth.startswith('Bearer access-'):
+            return self._reply(handler, 401, {'error': {'status': 401}})
+        user_id = auth[len('Bearer access-'):]
+
+        if url.path == '/v1/me':
+            return self._reply(handler, 200, {
+                'id': user_id,
+                'display_name': f'Fake {user_id}',
+                'images': [],
+            })
+        if url.path == '/v1/me/top/tracks':
+            items = self.top_tracks(user_id, query.get('time_range', 'medium_term'),
+                                    int(query.get('limit', 20)))
+            payload = {'items': items, 'total': len(items), 'limit': len(items)}
+            etag = '"%s"' % hashlib.md5(json.dumps(payload).encode()).hexdigest()
+            if handler.headers.get('If-None-Match') == etag:
+                return self._reply(handler, 304, None, headers={'ETag': etag})
+            return self._reply(handler, 200, payload, headers={'ETag': etag})
+        if url.path == '/v1/me/player/recently-played':
+            plays = self.recent_plays(user_id, int(query.get('limit', 20)), query.get('after'))
+            cursors = None
+            if plays:
+                newest = _parse_played_at(plays[0]['played_at'])
+                cursors = {'after': str(int(newest.timestamp() * 1000))}
+            return self._reply(handler, 200, {'items': plays, 'cursors': cursors})
+        return self._reply(handler, 404, {'error': {'status': 404}})
+
+    def _token(self, handler, form):
+        if form.get('grant_type') == 'authorization_code':
+            user_id = form.get('code', '')
+        elif form.get('grant_type') == 'refresh_token':
+            user_id = form.get('refresh_token', '').removeprefix('refresh-')
+        else:
+            return self._reply(handler, 400, {'error': 'unsupported_grant_type'})
+        return self._reply(handler, 200, {
+            'access_token': f'access-{user_id}',
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'refresh_token': f'refresh-{user_id}',
+            'scope': 'user-top-read user-read-recently-played',
+        })
+
+    def _reply(self, handler, status, payload, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+def _fake_track(idx):
+    track_id = f'fake{idx:018d}'
+    return {
+        'id': track_id,
+        'name': f'Track {idx}',
+        'artists': [{'name': f'Artist {idx % 400}'}],
+        'album': {'images': [{'url': f'https://i.example.com/{track_id}.jpg'}]},
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+        'preview_url': None,
+        'duration_ms': 150000 + (idx * 7919) % 120000,
+    }
+
+def _parse_played_at(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=timezone.utc)
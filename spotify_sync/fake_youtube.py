@@ -0,0 +1,52 @@
+"""
+Offline stand-in for YouTube lookups (spotify_sync.audio).
+
+Point AUDIO_RESOLVER at ``spotify_sync.fake_youtube.FakeYouTubeResolver``
+to run locally, or pass an instance to resolve_tracks. Video ids are
+derived from the track, so the same track always resolves the same way.
+"""
+import base64
+import hashlib
+import itertools
+import random
+import threading
+import time
+from .audio import AudioResolver
+
+class FakeYouTubeResolver(AudioResolver):
+    """
+    Answers every lookup after ``latency`` seconds, with up to ``jitter``
+    extra. Every ``miss_every``-th lookup finds no video, every
+    ``fail_every``-th raises and every ``hang_every``-th sleeps for
+    ``hang_for`` seconds, past any sensible timeout.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, miss_every=0, fail_every=0, hang_every=0,
+                 hang_for=30.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.miss_every = miss_every
+        self.fail_every = fail_every
+        self.hang_every = hang_every
+        self.hang_for = hang_for
+        self.random = random.Random(seed)
+        self.calls = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def resolve(self, name, artist, duration_ms, timeout):
+        with self.lock:
+            call = next(self.calls)
+            delay = self.latency + self.random.random() * self.jitter
+        if self.hang_every and call % self.hang_every == 0:
+            time.sleep(self.hang_for)
+        time.sleep(delay)
+        if self.fail_every and call % self.fail_every == 0:
+            raise ConnectionError('fake YouTube lookup failed')
+        if self.miss_every and call % self.miss_every == 0:
+            return None
+        return video_id_for(name, artist)
+
+def video_id_for(name, artist):
+    """The 11-character id the fake gives a track."""
+    digest = hashlib.sha1(f'{artist} - {name}'.encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:11]
@@ -0,0 +1,170 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test.utils import override_settings
+from accounts.models import SpotifyAccount
+from spotify_sync.client import METRICS_KEY, get_rate_limit_metrics
+from spotify_sync.fake_spotify import FakeSpotifyServer
+from spotify_sync.models import SpotifyTrack, UserTrackEvidence
+from spotify_sync.tasks import sync_spotify_data
+from GuessWho import redis_client
+from GuessWho.redis_client import get_redis
+from GuessWho.stats import percentile
+
+User = get_user_model()
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = (
+        'Run N concurrent user syncs against a throwaway test database and the '
+        'local fake Spotify server, and report throughput, latency, queries and '
+        'rows written. Needs Redis at REDIS_URL for the shared rate limiter; the '
+        'run keeps its keys in a database index of its own (--redis-db), so the '
+        'live rate-limit metrics and token cache are left alone.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--passes', type=int, default=2,
+                            help='Sync every user this many times; later passes exercise the delta path.')
+        parser.add_argument('--latency-ms', type=float, default=80.0)
+        parser.add_argument('--jitter-ms', type=float, default=40.0)
+        parser.add_argument('--throttle-every', type=int, default=0,
+                            help='Answer every Nth fake request with 429 (0 disables).')
+        parser.add_argument('--retry-after', type=int, default=1)
+        parser.add_argument('--rate-limit', type=float, default=None,
+                            help='Override SPOTIFY_RATE_LIMIT_PER_SECOND for the run.')
+        parser.add_argument('--redis-db', type=int, default=15,
+                            help="Redis database index for the run's keys, instead of the one in REDIS_URL.")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            # The shared-cache in-memory test DB can't take concurrent writers;
+            # a file with IMMEDIATE transactions makes them queue instead
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tempfile.gettempdir(), 'bench_sync.sqlite3'
+            )
+            connection.settings_dict['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # Test-database user ids overlap real ones, so tokens and metrics go to
+        # a database index of their own; the clients are rebuilt for it
+        redis_url = urlsplit(settings.REDIS_URL)._replace(path=f'/{options["redis_db"]}').geturl()
+        own_redis = mock.patch.multiple(redis_client, _client=None, _async_clients=weakref.WeakKeyDictionary())
+        own_redis.start()
+        redis_settings = override_settings(REDIS_URL=redis_url)
+        redis_settings.enable()
+        get_redis().delete(METRICS_KEY)
+        fake = FakeSpotifyServer(
+            latency=options['latency_ms'] / 1000,
+            jitter=options['jitter_ms'] / 1000,
+            throttle_every=options['throttle_every'],
+            retry_after=options['retry_after'],
+        )
+        try:
+            overrides = {
+                'SPOTIFY_API_BASE': fake.api_base,
+                'SPOTIFY_ACCOUNTS_BASE': fake.accounts_base,
+            }
+            if options['rate_limit']:
+                overrides['SPOTIFY_RATE_LIMIT_PER_SECOND'] = options['rate_limit']
+                overrides['SPOTIFY_RATE_LIMIT_BURST'] = int(options['rate_limit'] * 2)
+            with fake, override_settings(**overrides):
+                user_ids = self._create_users(options['users'])
+                for n in range(1, options['passes'] + 1):
+                    self._run_pass(n, user_ids, options['concurrency'])
+            self.stdout.write(
+                f'fake spotify: {fake.requests} requests, {fake.throttled} answered 429'
+            )
+            self.stdout.write(f'rate limiter: {get_rate_limit_metrics()}')
+        finally:
+            get_redis().close()
+            redis_settings.disable()
+            own_redis.stop()
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _create_users(self, count):
+        User.objects.bulk_create([User(username=f'bench-{i}') for i in range(count)])
+        users = list(User.objects.filter(username__startswith='bench-'))
+        SpotifyAccount.objects.bulk_create([
+            SpotifyAccount(
+                user=user,
+                spotify_user_id=user.username,
+                display_name=user.username,
+                # No access token yet: the first sync goes through the refresh path
+                refresh_token=f'refresh-{user.username}',
+            )
+            for user in users
+        ])
+        for user in users:
+            get_redis().delete(f'spotify:token:{user.id}')
+        return [user.id for user in users]
+
+    def _run_pass(self, number, user_ids, concurrency):
+        results = []
+        lock = threading.Lock()
+
+        def run_one(user_id):
+            stats = {'queries': 0, 'writes': 0}
+            write_cursors = []
+
+            def count(execute, sql, params, many, context):
+                stats['queries'] += 1
+                if sql.lstrip().upper().startswith(WRITE_PREFIXES):
+                    stats['writes'] += 1
+                    # rowcount of INSERT ... RETURNING is only final once rows are fetched
+                    write_cursors.append(context['cursor'])
+                return execute(sql, params, many, context)
+
+            started = time.perf_counter()
+            # apply() runs the task in this thread, so the numbers measure the
+            # pipeline rather than the broker
+            with connection.execute_wrapper(count):
+                outcome = sync_spotify_data.apply(args=[user_id])
+            stats['seconds'] = time.perf_counter() - started
+            stats['ok'] = outcome.successful()
+            stats['error'] = None if stats['ok'] else repr(outcome.result)
+            stats['rows'] = sum(max(cursor.rowcount, 0) for cursor in write_cursors)
+            connection.close()
+            with lock:
+                results.append(stats)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run_one, user_ids))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(r['seconds'] for r in results)
+        failed = sum(not r['ok'] for r in results)
+        self.stdout.write(self.style.MIGRATE_HEADING(f'pass {number}'))
+        self.stdout.write(f'  syncs:        {len(results)} ({failed} failed) in {elapsed:.2f}s')
+        errors = {r['error'] for r in results if r['error']}
+        for error in sorted(errors)[:3]:
+            self.stdout.write(self.style.WARNING(f'  error:        {error}'))
+        self.stdout.write(f'  throughput:   {len(results) / elapsed:.1f} syncs/s')
+        self.stdout.write(
+            f'  latency:      p50 {percentile(latencies, 50) * 1000:.0f} ms, '
+            f'p95 {percentile(latencies, 95) * 1000:.0f} ms'
+        )
+        self.stdout.write(
+            f'  queries/sync: {statistics.mean(r["queries"] for r in results):.1f} '
+            f'({statistics.mean(r["writes"] for r in results):.1f} writes)'
+        )
+        self.stdout.write(f'  rows written: {sum(r["rows"] for r in results)}')
+        self.stdout.write(
+            f'  tables:       {SpotifyTrack.objects.count()} tracks, '
+            f'{UserTrackEvidence.objects.count()} evidence rows'
+        )
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:50
+
+import sys
+from array import array
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Frozen copies of spotify_sync.snapshots.SOURCE_BITS and the blob layout as
+# of this migration, so later changes to that module can't alter it
+SOURCE_BITS = {'top_short': 1, 'top_medium': 2, 'top_long': 4, 'recent': 8}
+
+
+def pack(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def backfill_snapshots(apps, schema_editor):
+    # Users synced before snapshots existed would otherwise wait for their next change
+    UserTasteSnapshot = apps.get_model('spotify_sync', 'UserTasteSnapshot')
+    UserTrackEvidence = apps.get_model('spotify_sync', 'UserTrackEvidence')
+    rows = {}
+    for user_id, track_id, source_type in UserTrackEvidence.objects.values_list(
+        'user_id', 'track_id', 'source_type'
+    ).iterator():
+        rows.setdefault(user_id, []).append((track_id, source_type))
+    snapshots = []
+    for user_id, evidence in rows.items():
+        masks = {}
+        for track_id, source_type in evidence:
+            masks[track_id] = masks.get(track_id, 0) | SOURCE_BITS[source_type]
+        track_ids = sorted(masks)
+        snapshots.append(UserTasteSnapshot(
+            user_id=user_id,
+            track_ids=pack('q', track_ids),
+            sources=pack('B', [masks[t] for t in track_ids]),
+            track_count=len(track_ids),
+        ))
+    UserTasteSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_sync', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTasteSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_ids', models.BinaryField()),
+                ('sources', models.BinaryField()),
+                ('track_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='taste_snapshot', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_sync', '0002_usertastesnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spotifytrack',
+            name='youtube_resolved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spotifytrack',
+            name='youtube_video_id',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
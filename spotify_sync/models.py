@@ -9,6 +9,9 @@ class SpotifyTrack(models.Model):
     preview_url = models.URLField(max_length=1000, blank=True, null=True)
     external_url = models.URLField(max_length=1000, blank=True, null=True)
     duration_ms = models.IntegerField(null=True, blank=True)
+    # Round audio (spotify_sync.audio); resolved_at without a video id is a lookup that found none
+    youtube_video_id = models.CharField(max_length=32, blank=True, null=True)
+    youtube_resolved_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -38,4 +41,23 @@ class UserTrackEvidence(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.user} → {self.track} ({self.source_type})"
\ No newline at end of file
+        return f"{self.user} → {self.track} ({self.source_type})"
+
+class UserTasteSnapshot(models.Model):
+    """
+    Packed copy of one user's evidence, rebuilt at sync time.
+
+    ``track_ids`` holds the user's SpotifyTrack ids as a sorted little-endian
+    int64 array and ``sources`` one byte per track: the OR of the
+    ``SOURCE_BITS`` of every source it appeared in. See spotify_sync.snapshots.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='taste_snapshot'
+    )
+    track_ids = models.BinaryField()
+    sources = models.BinaryField()
+    track_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} ({self.track_count} tracks)"
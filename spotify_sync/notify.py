@@ -0,0 +1,75 @@
+import logging
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+class SyncStatusPublisher:
+    """
+    Pushes one user's sync status to the lobby group of every active room they are in.
+
+    Status transitions (syncing → synced/failed) go out immediately, as
+    versioned room deltas (see rooms.state). Progress updates in between are
+    plain ``player.sync`` messages, coalesced to at most one per
+    ``min_interval`` seconds, and a pending one is dropped when a newer status
+    supersedes it, so a fast sync produces a single update per transition.
+    """
+
+    def __init__(self, user_id, min_interval=0.5):
+        self.user_id = user_id
+        self.min_interval = min_interval
+        self._codes = None
+        self._pending = None
+        self._last_status = None
+        self._last_sent_at = 0.0
+
+    def update(self, sync_status, **progress):
+        self._pending = {
+            'user_id': self.user_id,
+            'sync_status': sync_status,
+            'progress': progress,
+        }
+        if (sync_status != self._last_status
+                or time.monotonic() - self._last_sent_at >= self.min_interval):
+            self.flush()
+
+    def flush(self):
+        if self._pending is None:
+            return
+        event, self._pending = self._pending, None
+        transition = event['sync_status'] != self._last_status
+        self._last_status = event['sync_status']
+        self._last_sent_at = time.monotonic()
+        try:
+            codes = self._room_codes()
+            if not codes:
+                return
+            if transition:
+                from rooms.state import publish_delta, update_op
+                for code in codes:
+                    publish_delta(code, [update_op(
+                        self.user_id, sync_status=event['sync_status'], progress=event['progress'],
+                    )])
+            else:
+                from rooms.frames import broadcast
+                # Encoded once for every lobby and socket it goes to
+                message = broadcast('player.sync', {'type': 'room.sync_status', **event})
+                async_to_sync(self._send)([f'room_{code}' for code in codes], message)
+        except Exception:
+            # A lobby missing one live update must never fail the sync itself
+            logger.exception('Could not publish sync status for user %s', self.user_id)
+
+    def _room_codes(self):
+        if self._codes is None:
+            from rooms.models import ACTIVE_STATUSES, RoomPlayer
+            codes = RoomPlayer.objects.filter(
+                user_id=self.user_id, room__status__in=ACTIVE_STATUSES,
+            ).values_list('room__code', flat=True)
+            self._codes = list(codes)
+        return self._codes
+
+    async def _send(self, groups, event):
+        channel_layer = get_channel_layer()
+        for group in groups:
+            await channel_layer.group_send(group, event)
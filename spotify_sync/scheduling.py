@@ -0,0 +1,50 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from GuessWho.redis_client import get_redis
+
+def _queued_key(user_id):
+    return f'spotify:sync-queued:{user_id}'
+
+def schedule_sync(user_id, force=False):
+    """
+    Enqueue sync_spotify_data for a user unless it would be redundant.
+
+    Skips users synced within SPOTIFY_SYNC_FRESHNESS seconds (unless
+    ``force``) and users who already have a sync queued or running. Users
+    sitting in a lobby go to SPOTIFY_SYNC_LOBBY_QUEUE, ahead of background
+    refreshes, even when a background sync is already queued for them.
+    Returns the queue used, or None when nothing was enqueued.
+    """
+    from accounts.models import SpotifyAccount
+    from rooms.models import RoomPlayer
+    from .tasks import sync_spotify_data
+    account = SpotifyAccount.objects.filter(user_id=user_id).values(
+        'sync_status', 'last_synced_at'
+    ).first()
+    if account is None:
+        return None
+    fresh_since = timezone.now() - timedelta(seconds=settings.SPOTIFY_SYNC_FRESHNESS)
+    if (not force and account['sync_status'] == 'synced'
+            and account['last_synced_at'] and account['last_synced_at'] > fresh_since):
+        return None
+    in_lobby = RoomPlayer.objects.filter(user_id=user_id, room__status='lobby').exists()
+    queue = settings.SPOTIFY_SYNC_LOBBY_QUEUE if in_lobby else settings.SPOTIFY_SYNC_QUEUE
+    # One queued-or-running sync per user, the key holding its queue; the
+    # task releases the key when it ends
+    r = get_redis()
+    if not r.set(_queued_key(user_id), queue, nx=True, ex=settings.SPOTIFY_SYNC_DEDUPE_TTL):
+        if not in_lobby:
+            return None
+        # Waiting behind background refreshes (queued at login, say): send
+        # another one ahead of them. The later of the two finds nothing new
+        # past the cursors, so it's cheap
+        previous = r.set(_queued_key(user_id), queue, xx=True, get=True, keepttl=True)
+        if previous != settings.SPOTIFY_SYNC_QUEUE:
+            return None
+    sync_spotify_data.apply_async(args=[user_id], queue=queue)
+    return queue
+
+def release_sync(user_id):
+    """Allow the next schedule_sync for this user to enqueue again."""
+    get_redis().delete(_queued_key(user_id))
@@ -0,0 +1,72 @@
+"""
+Per-user taste snapshots: which tracks a user has, and from which sources.
+
+Readers that need evidence for a whole room load one UserTasteSnapshot row
+per player and decode it straight into arrays, instead of pulling every
+UserTrackEvidence row through the ORM.
+"""
+import sys
+from array import array
+
+# One bit per evidence source; a track's mask ORs every source it was seen in
+SOURCE_BITS = {
+    'top_short': 1,
+    'top_medium': 2,
+    'top_long': 4,
+    'recent': 8,
+}
+
+def pack_array(typecode, values):
+    """Encode integers as a little-endian array blob."""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_array(typecode, blob):
+    """Decode a blob written by pack_array."""
+    values = array(typecode)
+    values.frombytes(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def build_snapshot(evidence_rows):
+    """
+    Turn ``(track_id, source_type)`` pairs into ``(track_ids, sources)`` blobs,
+    sorted by track id.
+    """
+    masks = {}
+    for track_id, source_type in evidence_rows:
+        masks[track_id] = masks.get(track_id, 0) | SOURCE_BITS[source_type]
+    track_ids = sorted(masks)
+    return pack_array('q', track_ids), pack_array('B', [masks[t] for t in track_ids]), len(track_ids)
+
+def write_taste_snapshot(user_id):
+    """Rebuild a user's snapshot from their evidence (call inside the sync transaction)."""
+    from .models import UserTasteSnapshot, UserTrackEvidence
+    track_ids, sources, count = build_snapshot(
+        UserTrackEvidence.objects.filter(user_id=user_id).values_list('track_id', 'source_type')
+    )
+    UserTasteSnapshot.objects.bulk_create(
+        [UserTasteSnapshot(user_id=user_id, track_ids=track_ids, sources=sources, track_count=count)],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['track_ids', 'sources', 'track_count', 'updated_at'],
+    )
+
+def load_taste_snapshots(user_ids):
+    """
+    Load snapshots for several users in one query.
+
+    Returns ``{user_id: (track_ids, sources)}`` with ``array('q')`` and
+    ``array('B')`` values; users without a snapshot are left out.
+    """
+    from .models import UserTasteSnapshot
+    rows = UserTasteSnapshot.objects.filter(user_id__in=list(user_ids)).values_list(
+        'user_id', 'track_ids', 'sources'
+    )
+    return {
+        user_id: (unpack_array('q', track_ids), unpack_array('B', sources))
+        for user_id, track_ids, sources in rows
+    }
@@ -1,86 +1,280 @@
+import hashlib
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from celery import shared_task
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
-import requests
+from django.utils.dateparse import parse_datetime
+from .audio import get_resolver, resolve_tracks, unresolved_tracks
+from .client import SpotifyRateLimited, record_reschedule, spotify_get, spotify_get_if_changed
+from .notify import SyncStatusPublisher
+from .scheduling import release_sync
+from .snapshots import load_taste_snapshots, write_taste_snapshot
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
-@shared_task
-def sync_spotify_data(user_id):
+# How many plays the 'recent' evidence set holds (Spotify's maximum page size)
+RECENT_LIMIT = 50
+
+# (source_type, endpoint, params) for every endpoint a sync pulls
+SYNC_SOURCES = [
+    ('top_short',  '/me/top/tracks', {'time_range': 'short_term', 'limit': 50}),
+    ('top_medium', '/me/top/tracks', {'time_range': 'medium_term', 'limit': 50}),
+    ('top_long',   '/me/top/tracks', {'time_range': 'long_term', 'limit': 50}),
+    ('recent',     '/me/player/recently-played', {'limit': RECENT_LIMIT}),
+]
+
+# SpotifyTrack columns refreshed from the API on every sync
+TRACK_UPDATE_FIELDS = [
+    'name', 'artist_name', 'album_image_url', 'preview_url',
+    'external_url', 'duration_ms', 'updated_at',
+]
+
+@shared_task(bind=True, max_retries=5)
+def sync_spotify_data(self, user_id):
     from accounts.models import SpotifyAccount
     from accounts.utils import refresh_spotify_token
-    from spotify_sync.models import SpotifyTrack, UserTrackEvidence
     user = User.objects.get(pk=user_id)
     spotify_account = SpotifyAccount.objects.get(user=user)
     # Mark as syncing
     spotify_account.sync_status = 'syncing'
     spotify_account.save(update_fields=['sync_status'])
+    # Live status for every lobby this user is sitting in
+    publisher = SyncStatusPublisher(user_id)
+    total = len(SYNC_SOURCES)
+    publisher.update('syncing', sources_done=0, sources_total=total)
     try:
         # Refresh token if needed
         access_token = refresh_spotify_token(spotify_account)
-        headers = {'Authorization': f'Bearer {access_token}'}
-        # ── Fetch top tracks for all 3 time ranges ──────────────────
-        time_ranges = [
-            ('top_short',  'short_term'),
-            ('top_medium', 'medium_term'),
-            ('top_long',   'long_term'),
-        ]
-        for source_type, time_range in time_ranges:
-            resp = requests.get(
-                'https://api.spotify.com/v1/me/top/tracks',
-                headers=headers,
-                params={'time_range': time_range, 'limit': 50},
-            )
-            resp.raise_for_status()
-            items = resp.json().get('items', [])
-            for rank, item in enumerate(items, start=1):
-                _upsert_track_and_evidence(user, item, source_type, source_rank=rank)
-        # ── Fetch recently played ────────────────────────────────────
-        resp = requests.get(
-            'https://api.spotify.com/v1/me/player/recently-played',
-            headers=headers,
-            params={'limit': 50},
+        # ── Fetch all four sources concurrently ─────────────────────
+        cursors = spotify_account.sync_cursors or {}
+        changed, new_cursors, errors = _fetch_sources(
+            access_token, cursors,
+            on_progress=lambda done: publisher.update('syncing', sources_done=done, sources_total=total),
         )
-        resp.raise_for_status()
-        play_history = resp.json().get('items', [])
-        for entry in play_history:
-            item = entry['track']
-            played_at = entry['played_at']  # ISO 8601 string
-            _upsert_track_and_evidence(user, item, 'recent', seen_at=played_at)
+        throttled = [exc for exc in errors.values() if isinstance(exc, SpotifyRateLimited)]
+        if throttled:
+            # Retry the whole sync later; cursors make the repeat cheap
+            raise max(throttled, key=lambda exc: exc.retry_after)
+        if len(errors) == len(SYNC_SOURCES):
+            raise next(iter(errors.values()))
+        if errors:
+            logger.warning(
+                'Partial Spotify sync for user %s, failed sources: %s',
+                user_id, ', '.join(sorted(errors)),
+            )
+        # ── Write only what changed, in one batch ────────────────────
+        tracks, evidence = _collect_sync_batch(changed)
+        if changed:
+            # A delta of new plays is merged into 'recent'; full lists replace their source
+            incremental_recent = 'recent' in changed and 'after' in cursors.get('recent', {})
+            _write_sync_batch(
+                user, tracks, evidence,
+                sources=[s for s in changed if not (s == 'recent' and incremental_recent)],
+                trim_recent=incremental_recent,
+            )
         # ── Mark synced ──────────────────────────────────────────────
         spotify_account.sync_status = 'synced'
         spotify_account.last_synced_at = timezone.now()
-        spotify_account.save(update_fields=['sync_status', 'last_synced_at'])
+        spotify_account.sync_cursors = new_cursors
+        spotify_account.save(update_fields=['sync_status', 'last_synced_at', 'sync_cursors'])
+        publisher.update('synced', sources_done=total - len(errors), sources_total=total)
+        release_sync(user_id)
+        # Resolve round audio now, so a match start finds it cached; same queue
+        # as this sync, so a player waiting in a lobby is warmed first
+        if get_resolver() is not None:
+            queue = (self.request.delivery_info or {}).get('routing_key') or settings.SPOTIFY_SYNC_QUEUE
+            prewarm_track_audio.apply_async(args=[user_id], queue=queue)
+        return {
+            'changed_sources': sorted(changed),
+            'tracks': len(tracks),
+            'evidence': len(evidence),
+            'failed_sources': {source: str(exc) for source, exc in errors.items()},
+        }
+    except SpotifyRateLimited as exc:
+        if self.request.retries < self.max_retries:
+            # Stay 'syncing' and reschedule once the shared backoff has passed
+            record_reschedule()
+            raise self.retry(exc=exc, countdown=exc.retry_after + random.randint(0, 3))
+        spotify_account.sync_status = 'failed'
+        spotify_account.save(update_fields=['sync_status'])
+        publisher.update('failed', sources_done=0, sources_total=total)
+        release_sync(user_id)
+        raise
     except Exception as exc:
         spotify_account.sync_status = 'failed'
         spotify_account.save(update_fields=['sync_status'])
+        publisher.update('failed', sources_done=0, sources_total=total)
+        release_sync(user_id)
         raise exc   # re-raise so Celery marks the task as FAILURE
-def _upsert_track_and_evidence(user, track_item, source_type, source_rank=None, seen_at=None):
-    """Helper: upsert SpotifyTrack, then upsert UserTrackEvidence."""
-    from spotify_sync.models import SpotifyTrack, UserTrackEvidence
-    from django.utils.dateparse import parse_datetime
+
+@shared_task
+def prewarm_track_audio(user_id):
+    """
+    Resolve the round audio for a synced user's tracks that don't have it
+    yet, strongest evidence first, up to AUDIO_PREWARM_LIMIT of them.
+    A no-op while audio lookups are off (spotify_sync.audio.get_resolver).
+    """
+    if get_resolver() is None:
+        return {'found': 0, 'missing': 0, 'failed': 0, 'timed_out': 0}
+    track_ids, sources = load_taste_snapshots([user_id]).get(user_id, ([], []))
+    # Tracks in more of the user's lists are likelier picks
+    ranked = [track_id for _, track_id in sorted(
+        zip(sources, track_ids), key=lambda pair: -bin(pair[0]).count('1')
+    )]
+    needed = set(unresolved_tracks(ranked).values_list('pk', flat=True))
+    picked = [track_id for track_id in ranked if track_id in needed]
+    return resolve_tracks(picked[:settings.AUDIO_PREWARM_LIMIT])
+
+def _fetch_sources(access_token, cursors, on_progress=None):
+    """
+    Fetch every SYNC_SOURCES endpoint in parallel over the shared session.
+
+    Returns ``(changed, new_cursors, errors)``: item lists for sources that
+    have new data, the cursors to store for next time, and exceptions keyed
+    by source_type, so one slow or failing endpoint doesn't sink the others.
+    ``on_progress(done)`` is called as each source finishes.
+    """
+    with ThreadPoolExecutor(max_workers=len(SYNC_SOURCES)) as pool:
+        futures = {
+            source_type: pool.submit(
+                _fetch_source, access_token, source_type, path, params,
+                cursors.get(source_type, {}),
+            )
+            for source_type, path, params in SYNC_SOURCES
+        }
+        if on_progress:
+            for done, _ in enumerate(as_completed(futures.values()), start=1):
+                on_progress(done)
+    changed, new_cursors, errors = {}, dict(cursors), {}
+    for source_type, future in futures.items():
+        try:
+            items, new_cursors[source_type] = future.result()
+        except Exception as exc:
+            errors[source_type] = exc
+            continue
+        if items is not None:
+            changed[source_type] = items
+    return changed, new_cursors, errors
+
+def _fetch_source(access_token, source_type, path, params, cursor):
+    """Fetch one source as a delta against ``cursor``. Returns (items or None, new cursor)."""
+    if source_type == 'recent':
+        # Only ask for plays newer than the last one we stored
+        if cursor.get('after'):
+            params = {**params, 'after': cursor['after']}
+        items = spotify_get(path, access_token, params).get('items', [])
+        if not items:
+            return None, cursor
+        newest = max(parse_datetime(entry['played_at']) for entry in items)
+        return items, {'after': int(newest.timestamp() * 1000)}
+
+    # Top tracks: skip lists that are unchanged by ETag or by content hash
+    data, etag = spotify_get_if_changed(path, access_token, params, cursor.get('etag'))
+    if data is None:
+        return None, cursor
+    items = data.get('items', [])
+    digest = hashlib.sha1(
+        ','.join(item.get('id') or '' for item in items).encode()
+    ).hexdigest()
+    new_cursor = {'etag': etag, 'hash': digest}
+    if digest == cursor.get('hash'):
+        return None, new_cursor
+    return items, new_cursor
+
+def _track_fields(track_item):
+    """Helper: map a Spotify track object onto SpotifyTrack columns."""
     artists = track_item.get('artists', [])
     artist_name = ', '.join(a['name'] for a in artists) if artists else ''
     images = track_item.get('album', {}).get('images', [])
     album_image_url = images[0]['url'] if images else None
     external_urls = track_item.get('external_urls', {})
-    track, _ = SpotifyTrack.objects.update_or_create(
-        spotify_track_id=track_item['id'],
-        defaults={
-            'name': track_item['name'],
-            'artist_name': artist_name,
-            'album_image_url': album_image_url,
-            'preview_url': track_item.get('preview_url'),
-            'external_url': external_urls.get('spotify'),
-            'duration_ms': track_item.get('duration_ms'),
-        },
-    )
-    seen_at_parsed = parse_datetime(seen_at) if seen_at else None
-    UserTrackEvidence.objects.update_or_create(
-        user=user,
-        track=track,
-        source_type=source_type,
-        defaults={
-            'source_rank': source_rank,
-            'seen_at': seen_at_parsed,
-        },
-    )
\ No newline at end of file
+    return {
+        'name': track_item['name'],
+        'artist_name': artist_name,
+        'album_image_url': album_image_url,
+        'preview_url': track_item.get('preview_url'),
+        'external_url': external_urls.get('spotify'),
+        'duration_ms': track_item.get('duration_ms'),
+    }
+
+def _collect_sync_batch(responses):
+    """
+    Dedupe the raw endpoint items in memory.
+
+    Returns ``(tracks, evidence)`` where ``tracks`` maps spotify_track_id to
+    SpotifyTrack fields and ``evidence`` maps (spotify_track_id, source_type)
+    to (source_rank, seen_at).
+    """
+    tracks = {}
+    evidence = {}
+    for source_type, items in responses.items():
+        for rank, entry in enumerate(items, start=1):
+            if source_type == 'recent':
+                track_item = entry.get('track')
+                source_rank = None
+                seen_at = parse_datetime(entry['played_at'])  # ISO 8601 string
+            else:
+                track_item = entry
+                source_rank = rank
+                seen_at = None
+            if not track_item or not track_item.get('id'):
+                continue  # local files and unavailable tracks have no id
+            tracks[track_item['id']] = _track_fields(track_item)
+            # Recently played is newest first, so the first play of a track wins
+            evidence.setdefault((track_item['id'], source_type), (source_rank, seen_at))
+    return tracks, evidence
+
+def _write_sync_batch(user, tracks, evidence, sources, trim_recent=False):
+    """
+    Upsert tracks and evidence with a fixed number of statements, then delete
+    evidence rows for ``sources`` that were not in this batch. With
+    ``trim_recent``, 'recent' keeps only its RECENT_LIMIT newest plays.
+    The user's taste snapshot is rebuilt in the same transaction.
+    """
+    from spotify_sync.models import SpotifyTrack, UserTrackEvidence
+    with transaction.atomic():
+        SpotifyTrack.objects.bulk_create(
+            [SpotifyTrack(spotify_track_id=sid, **fields) for sid, fields in tracks.items()],
+            update_conflicts=True,
+            unique_fields=['spotify_track_id'],
+            update_fields=TRACK_UPDATE_FIELDS,
+        )
+        track_ids = dict(
+            SpotifyTrack.objects.filter(spotify_track_id__in=list(tracks))
+            .values_list('spotify_track_id', 'id')
+        )
+        UserTrackEvidence.objects.bulk_create(
+            [
+                UserTrackEvidence(
+                    user=user,
+                    track_id=track_ids[sid],
+                    source_type=source_type,
+                    source_rank=source_rank,
+                    seen_at=seen_at,
+                )
+                for (sid, source_type), (source_rank, seen_at) in evidence.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['user', 'track', 'source_type'],
+            update_fields=['source_rank', 'seen_at'],
+        )
+        # Keep the user's evidence set exact: drop rows that are no longer present
+        stale = Q()
+        for source_type in sources:
+            keep = [track_ids[sid] for sid, st in evidence if st == source_type]
+            stale |= Q(source_type=source_type) & ~Q(track_id__in=keep)
+        if stale:
+            UserTrackEvidence.objects.filter(user=user).filter(stale).delete()
+        if trim_recent:
+            overflow = list(
+                UserTrackEvidence.objects.filter(user=user, source_type='recent')
+                .order_by('-seen_at').values_list('pk', flat=True)[RECENT_LIMIT:]
+            )
+            if overflow:
+                UserTrackEvidence.objects.filter(pk__in=overflow).delete()
+        write_taste_snapshot(user.pk)
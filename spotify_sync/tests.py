@@ -1,3 +1,321 @@
-from django.test import TestCase
+import time
+import requests
+from datetime import timedelta
+from unittest import mock
+from email.utils import formatdate
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from GuessWho.testing import FakeRedisMixin
+from accounts.models import SpotifyAccount
+from rooms.models import Room, RoomPlayer
+from .audio import get_resolver, resolve_tracks
+from .client import (
+    BACKOFF_KEY, SpotifyRateLimited, get_rate_limit_metrics, parse_retry_after, spotify_get,
+    spotify_get_if_changed,
+)
+from .fake_spotify import FakeSpotifyServer
+from .fake_youtube import FakeYouTubeResolver, video_id_for
+from .models import SpotifyTrack, UserTrackEvidence
+from .scheduling import schedule_sync
+from .snapshots import write_taste_snapshot
+from .tasks import RECENT_LIMIT, prewarm_track_audio, sync_spotify_data
 
-# Create your tests here.
+
+class ResolveTracksTests(TestCase):
+    """The audio fan-out against the offline YouTube stand-in."""
+
+    def setUp(self):
+        self.tracks = SpotifyTrack.objects.bulk_create([
+            SpotifyTrack(spotify_track_id=f't{i}', name=f'Song {i}', artist_name='Band')
+            for i in range(12)
+        ])
+
+    def test_found_and_missing_are_cached(self):
+        counts = resolve_tracks([t.pk for t in self.tracks], FakeYouTubeResolver(latency=0, miss_every=4))
+        self.assertEqual(counts, {'found': 9, 'missing': 3, 'failed': 0, 'timed_out': 0})
+        hit = SpotifyTrack.objects.exclude(youtube_video_id=None).first()
+        self.assertEqual(hit.youtube_video_id, video_id_for(hit.name, hit.artist_name))
+        self.assertEqual(SpotifyTrack.objects.filter(youtube_resolved_at=None).count(), 0)
+        # Misses are remembered too, so a second pass looks nothing up
+        again = resolve_tracks([t.pk for t in self.tracks], FakeYouTubeResolver(latency=0))
+        self.assertEqual(again, {'found': 0, 'missing': 0, 'failed': 0, 'timed_out': 0})
+
+    def test_failures_and_hangs_are_left_for_the_next_pass(self):
+        resolver = FakeYouTubeResolver(latency=0.01, fail_every=5, hang_every=6, hang_for=2.0)
+        started = time.monotonic()
+        counts = resolve_tracks([t.pk for t in self.tracks], resolver, workers=4, timeout=0.2)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual((counts['failed'], counts['timed_out']), (2, 2))
+        self.assertEqual(SpotifyTrack.objects.filter(youtube_resolved_at=None).count(), 4)
+        self.assertEqual(resolve_tracks([t.pk for t in self.tracks], FakeYouTubeResolver(latency=0))['found'], 4)
+
+    @override_settings(AUDIO_RESOLVER='spotify_sync.fake_youtube.FakeYouTubeResolver', AUDIO_PREWARM_LIMIT=5)
+    def test_prewarm_takes_the_strongest_evidence_first(self):
+        user = User.objects.create(username='warm')
+        UserTrackEvidence.objects.bulk_create(
+            [UserTrackEvidence(user=user, track=t, source_type='recent') for t in self.tracks]
+            + [UserTrackEvidence(user=user, track=t, source_type='top_short') for t in self.tracks[7:]]
+        )
+        write_taste_snapshot(user.pk)
+        self.assertEqual(prewarm_track_audio(user.pk)['found'], 5)
+        resolved = SpotifyTrack.objects.exclude(youtube_video_id=None).values_list('pk', flat=True)
+        self.assertEqual(set(resolved), {t.pk for t in self.tracks[7:]})
+
+    @override_settings(AUDIO_RESOLVER='')
+    def test_no_backend_means_no_lookups(self):
+        self.assertIsNone(get_resolver())
+        with self.assertNumQueries(0):
+            self.assertEqual(prewarm_track_audio(1), {'found': 0, 'missing': 0, 'failed': 0, 'timed_out': 0})
+        self.assertEqual(SpotifyTrack.objects.filter(youtube_resolved_at=None).count(), 12)
+
+    @override_settings(AUDIO_RESOLVER='spotify_sync.audio.YtDlpResolver')
+    @mock.patch('spotify_sync.audio.yt_dlp', None)
+    def test_backend_without_its_package_turns_lookups_off(self):
+        with self.assertLogs('spotify_sync.audio', 'WARNING'):
+            self.assertIsNone(get_resolver())
+        self.assertEqual(resolve_tracks([t.pk for t in self.tracks])['found'], 0)
+
+
+
+class RetryAfterTests(FakeRedisMixin, SimpleTestCase):
+    """429 handling against the fake Spotify server."""
+
+    def test_header_forms(self):
+        self.assertEqual(parse_retry_after('3'), 3)
+        self.assertEqual(parse_retry_after('0'), 1)
+        self.assertEqual(parse_retry_after(None), 1)
+        self.assertEqual(parse_retry_after('soon'), 1)
+        self.assertIn(parse_retry_after(formatdate(time.time() + 30, usegmt=True)), range(29, 32))
+        self.assertEqual(parse_retry_after(formatdate(time.time() - 30, usegmt=True)), 1)
+
+    def _get_me(self, fake, max_wait):
+        with override_settings(SPOTIFY_API_BASE=fake.api_base):
+            return spotify_get('/me', 'access-u1', max_wait=max_wait)
+
+    def test_zero_retry_after_backs_off_a_second_and_retries(self):
+        with FakeSpotifyServer(throttle_every=2, retry_after=0) as fake:
+            self._get_me(fake, max_wait=5)
+            started = time.monotonic()
+            self.assertEqual(self._get_me(fake, max_wait=5)['id'], 'u1')
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+        self.assertEqual((fake.throttled, get_rate_limit_metrics()['throttled']), (1, 1))
+
+    def test_http_date_retry_after_past_max_wait_raises(self):
+        retry_at = formatdate(time.time() + 120, usegmt=True)
+        with FakeSpotifyServer(throttle_every=1, retry_after=retry_at) as fake:
+            with self.assertRaises(SpotifyRateLimited) as raised:
+                self._get_me(fake, max_wait=5)
+        self.assertGreaterEqual(raised.exception.retry_after, 119)
+        self.assertGreater(self.redis.pttl(BACKOFF_KEY), 100_000)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+@mock.patch('spotify_sync.tasks.sync_spotify_data.apply_async')
+class ScheduleSyncTests(FakeRedisMixin, TestCase):
+    """Which queue a user's sync lands on."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='player')
+        SpotifyAccount.objects.create(user=self.user, spotify_user_id='player', sync_status='pending')
+        host = User.objects.create(username='host')
+        self.room = Room.objects.create(code='SYNC1', host_user=host)
+        RoomPlayer.objects.create(room=self.room, user=host, display_name='host', is_host=True)
+
+    def queues(self, apply_async):
+        return [call.kwargs['queue'] for call in apply_async.call_args_list]
+
+    def test_joining_a_lobby_moves_a_queued_sync_ahead(self, apply_async):
+        # The login callback queues a background sync
+        self.assertEqual(schedule_sync(self.user.pk), settings.SPOTIFY_SYNC_QUEUE)
+        self.client.force_login(self.user)
+        self.client.post(reverse('rooms:join_room'), {'room_code': self.room.code})
+        self.assertEqual(self.queues(apply_async), [settings.SPOTIFY_SYNC_QUEUE, settings.SPOTIFY_SYNC_LOBBY_QUEUE])
+        # Already on the lobby queue: nothing more
+        self.assertIsNone(schedule_sync(self.user.pk))
+        self.assertEqual(apply_async.call_count, 2)
+
+    def test_queued_sync_is_not_repeated_outside_a_lobby(self, apply_async):
+        schedule_sync(self.user.pk)
+        self.assertIsNone(schedule_sync(self.user.pk))
+        self.assertEqual(self.queues(apply_async), [settings.SPOTIFY_SYNC_QUEUE])
+
+
+class SyncTestCase(FakeRedisMixin, TestCase):
+    """sync_spotify_data end to end against the fake Spotify server."""
+
+    def setUp(self):
+        super().setUp()
+        self.fake = FakeSpotifyServer().start()
+        self.addCleanup(self.fake.stop)
+        self.enterContext(override_settings(
+            SPOTIFY_API_BASE=self.fake.api_base, SPOTIFY_ACCOUNTS_BASE=self.fake.accounts_base,
+        ))
+        self.user = User.objects.create(username='u1')
+        self.account = SpotifyAccount.objects.create(user=self.user, spotify_user_id='u1',
+                                                     refresh_token='refresh-u1')
+
+    def sync(self):
+        return sync_spotify_data(self.user.pk)
+
+    def evidence(self, source_type):
+        """{spotify_track_id: (source_rank, seen_at)} for one source."""
+        rows = UserTrackEvidence.objects.filter(user=self.user, source_type=source_type).order_by('source_rank')
+        return {row.track.spotify_track_id: (row.source_rank, row.seen_at) for row in rows.select_related('track')}
+
+    def top_ids(self, time_range):
+        return [track['id'] for track in self.fake.top_tracks('u1', time_range, 50)]
+
+
+class SyncWriteTests(SyncTestCase):
+
+    def test_tracks_shared_across_sources_are_upserted_once(self):
+        upsert = SpotifyTrack.objects.bulk_create
+        with mock.patch.object(SpotifyTrack.objects, 'bulk_create', wraps=upsert) as bulk_create:
+            result = self.sync()
+        self.assertEqual(result['changed_sources'], ['recent', 'top_long', 'top_medium', 'top_short'])
+        self.assertEqual(list(self.evidence('top_short')), self.top_ids('short_term'))
+        self.assertEqual(self.evidence('top_short')[self.top_ids('short_term')[2]][0], 3)
+        listed = [track_id for source in ('top_short', 'top_medium', 'top_long', 'recent')
+                  for track_id in self.evidence(source)]
+        self.assertLess(len(set(listed)), len(listed))  # the sources overlap
+        # One upsert, each track in it once, however many sources list it
+        bulk_create.assert_called_once()
+        sent = [track.spotify_track_id for track in bulk_create.call_args.args[0]]
+        self.assertEqual(sorted(sent), sorted(set(listed)))
+        self.assertEqual(SpotifyTrack.objects.count(), len(set(listed)))
+
+    def test_evidence_dropped_from_a_source_is_deleted(self):
+        self.sync()
+        before = self.top_ids('short_term')
+        medium = self.evidence('top_medium')
+        top_tracks = self.fake.top_tracks
+        # The user's short-term list loses its first five tracks
+        self.fake.top_tracks = lambda user_id, time_range, limit: (
+            top_tracks(user_id, time_range, limit)[5 if time_range == 'short_term' else 0:]
+        )
+        result = self.sync()
+        self.assertEqual(result['changed_sources'], ['top_short'])
+        self.assertEqual(list(self.evidence('top_short')), before[5:])
+        # Ranks follow the new list
+        self.assertEqual(self.evidence('top_short')[before[5]][0], 1)
+        self.assertEqual(self.evidence('top_medium'), medium)
+        # The tracks themselves stay: other users and sources may have them
+        self.assertEqual(SpotifyTrack.objects.filter(spotify_track_id__in=before[:5]).count(), 5)
+
+
+class PartialSyncTests(SyncTestCase):
+    """One endpoint failing doesn't sink the others."""
+
+    RECENT = '/v1/me/player/recently-played'
+
+    def test_failed_source_is_reported_and_its_evidence_kept(self):
+        self.sync()
+        recent = self.evidence('recent')
+        self.account.refresh_from_db()
+        recent_cursor = self.account.sync_cursors['recent']
+        short = self.top_ids('short_term')
+        top_tracks = self.fake.top_tracks
+        self.fake.top_tracks = lambda user_id, time_range, limit: top_tracks(user_id, time_range, limit)[1:]
+        self.fake.fail_paths = {self.RECENT}
+        result = self.sync()
+        self.assertEqual(list(result['failed_sources']), ['recent'])
+        self.assertIn('500', result['failed_sources']['recent'])
+        self.assertEqual(result['changed_sources'], ['top_long', 'top_medium', 'top_short'])
+        self.assertEqual(self.evidence('recent'), recent)
+        self.assertEqual(list(self.evidence('top_short')), short[1:])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.sync_status, 'synced')
+        # Its cursor stays put, so the next sync asks for the same plays again
+        self.assertEqual(self.account.sync_cursors['recent'], recent_cursor)
+
+    def test_sync_fails_only_when_every_source_does(self):
+        self.fake.fail_paths = {self.RECENT, '/v1/me/top/tracks'}
+        with self.assertRaises(requests.HTTPError):
+            self.sync()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.sync_status, 'failed')
+        self.assertFalse(UserTrackEvidence.objects.exists())
+
+
+class RepeatSyncTests(SyncTestCase):
+    """A repeat sync only fetches and writes what changed since the cursors."""
+
+    def writes(self, queries, model):
+        """The INSERT, UPDATE and DELETE statements among ``queries`` that touch ``model``'s table."""
+        table = f'"{model._meta.db_table}"'
+        return [q['sql'] for q in queries
+                if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) and table in q['sql']]
+
+    def assertNothingWritten(self, queries):
+        self.assertEqual(self.writes(queries, SpotifyTrack), [])
+        self.assertEqual(self.writes(queries, UserTrackEvidence), [])
+
+    def test_unchanged_sources_are_skipped_by_etag(self):
+        self.sync()
+        bodies = []
+
+        def get_if_changed(*args, **kwargs):
+            data, etag = spotify_get_if_changed(*args, **kwargs)
+            bodies.append(data)
+            return data, etag
+
+        with mock.patch('spotify_sync.tasks.spotify_get_if_changed', get_if_changed), \
+                CaptureQueriesContext(connection) as queries:
+            result = self.sync()
+        self.assertEqual(result['changed_sources'], [])
+        self.assertNothingWritten(queries)
+        # Every top list came back 304, with no body
+        self.assertEqual(bodies, [None, None, None])
+
+    def test_unchanged_list_is_skipped_by_hash(self):
+        self.sync()
+        self.account.refresh_from_db()
+        # Without an ETag Spotify answers 200, but the ids hash the same
+        cursors = self.account.sync_cursors
+        etags = {source: cursor.pop('etag') for source, cursor in cursors.items() if 'etag' in cursor}
+        self.account.save(update_fields=['sync_cursors'])
+        with CaptureQueriesContext(connection) as queries:
+            result = self.sync()
+        self.assertEqual(result['changed_sources'], [])
+        self.assertNothingWritten(queries)
+        self.account.refresh_from_db()
+        self.assertEqual({source: self.account.sync_cursors[source]['etag'] for source in etags}, etags)
+
+    def test_new_plays_are_merged_and_recent_trimmed(self):
+        self.sync()
+        old = self.evidence('recent')
+        self.account.refresh_from_db()
+        after = self.account.sync_cursors['recent']['after']
+        # Thirty tracks the user hasn't played before, all after the last sync
+        new_plays = [
+            {'track': self.fake.catalogue[2000 + n],
+             'played_at': (self.fake.started_at + timedelta(minutes=30 - n)).strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+            for n in range(30)
+        ]
+        self.assertTrue({play['track']['id'] for play in new_plays}.isdisjoint(old))
+        recent_plays = self.fake.recent_plays
+        asked = []
+
+        def with_new_plays(user_id, limit, after=None):
+            asked.append(after)
+            return (new_plays + recent_plays(user_id, limit, after))[:limit]
+
+        self.fake.recent_plays = with_new_plays
+        result = self.sync()
+        self.assertEqual(result['changed_sources'], ['recent'])
+        self.assertEqual(asked, [str(after)])
+        # The 30 new plays, then the newest of the old ones up to the limit
+        newest_old = sorted(old, key=lambda track_id: old[track_id][1], reverse=True)
+        merged = self.evidence('recent')
+        self.assertEqual(len(merged), RECENT_LIMIT)
+        self.assertEqual(
+            set(merged),
+            {play['track']['id'] for play in new_plays} | set(newest_old[:RECENT_LIMIT - 30]),
+        )
+        self.account.refresh_from_db()
+        self.assertGreater(self.account.sync_cursors['recent']['after'], after)